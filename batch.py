@@ -0,0 +1,371 @@
+# %%
+import argparse
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+from dotenv import load_dotenv
+
+import fetch
+import headways
+import instrumentation
+from manifest import MANIFEST_FILENAME, Manifest
+
+logger = logging.getLogger(__name__)
+
+
+# %%
+# Batch settings, also set in the .env file:
+# BATCH_WORKERS is the number of worker processes (defaults to the number of CPUs).
+# BATCH_MAX_MEMORY_GB is the most memory (address space) each worker can use.  A route-date that
+# needs more fails with a MemoryError instead of slowing down the whole machine.
+load_dotenv()
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', os.cpu_count() or 1))
+BATCH_MAX_MEMORY_GB = float(os.getenv('BATCH_MAX_MEMORY_GB', 0)) or None
+
+# Seconds between saves of the manifest during a batch run (it is always saved at the end)
+MANIFEST_SAVE_SECONDS = 30
+
+# Columns of the summary returned by run_batch()
+BATCH_SUMMARY_COLUMNS = ['route_id', 'date', 'status', 'stops', 'seconds', 'error']
+
+
+# %%
+###########
+# Worker processes
+###########
+
+# Data loaded by each worker process, kept between the route-dates it runs
+_worker_routes = None
+_worker_feeds = {}
+_worker_vehicles = {}
+
+
+def _init_worker(routes:list, workers:int, max_memory_gb:float):
+    '''Runs once in each worker process before any route-dates.'''
+    global _worker_routes
+    _worker_routes = routes
+
+    # the forked worker inherits the parent's session and its open connections (from the HEAD
+    # requests in get_current_route_dates), so each worker starts its own connection pool
+    fetch._session = None
+
+    # the CTA API rate limit is shared by every worker
+    headways.cta_rate_limiter = fetch.TokenBucket(headways.CTA_API_RATE / workers)
+
+    if max_memory_gb:
+        try:
+            import resource
+            max_bytes = int(max_memory_gb * 1e9)
+            resource.setrlimit(resource.RLIMIT_AS, (max_bytes, max_bytes))
+        except (ImportError, ValueError, OSError) as e:
+            logger.warning(f'Could not limit worker memory to {max_memory_gb} GB: {e}')
+
+
+def _get_worker_feed(version_id:str):
+    # each feed version is loaded once per worker
+    if version_id not in _worker_feeds:
+        _worker_feeds[version_id] = headways.get_gtfs_feed(version_id)
+    return _worker_feeds[version_id]
+
+
+def _get_worker_vehicles(service_date_string:str) -> pd.DataFrame:
+    # each date's vehicles (for every route in the batch) are loaded once per worker.  Route-dates
+    # are sent to the workers in date order, so only the latest date is kept.
+    if service_date_string not in _worker_vehicles:
+        _worker_vehicles.clear()
+        _worker_vehicles[service_date_string] = headways.get_chn_vehicles(service_date_string, routes=_worker_routes)
+    return _worker_vehicles[service_date_string]
+
+
+def _get_route_pids(vehicles:pd.DataFrame) -> dict:
+    # pattern ids in the vehicle data for each route, to fingerprint the patterns each route used
+    route_pids = vehicles[['rt', 'pid']].drop_duplicates()
+    return {str(rt): [str(pid) for pid in df['pid']] for rt, df in route_pids.groupby('rt', observed=True)}
+
+
+def _run_route_date(
+    version_id:str, route_id:str, service_date_string:str, output_dir:str, output_format:str) -> dict:
+    '''Runs get_stats_all_stops() for one route-date in a worker process.  Errors are returned in
+    the result rather than raised, so one bad route-date doesn't stop the batch.  Routes without
+    vehicle data that day are 'skipped'.'''
+    start = time.perf_counter()
+    result = {'route_id': route_id, 'date': service_date_string, 'status': 'ok', 'stops': 0, 'error': None}
+    try:
+        # one stage per route-date, holding the timings of the headways stages it runs
+        with instrumentation.stage('route_date', route_id=route_id, date=service_date_string):
+            vehicles = _get_worker_vehicles(service_date_string)
+            stats_all_stops = headways.get_stats_all_stops(
+                _get_worker_feed(version_id), route_id, service_date_string, vehicles=vehicles, output_dir=output_dir,
+                output_format=output_format)
+            result['stops'] = len(stats_all_stops)
+            result['pids'] = _get_route_pids(vehicles.loc[vehicles['rt'] == route_id]).get(route_id, [])
+            result['patterns'] = headways.get_pattern_fingerprint(result['pids'])
+            if len(result['pids']) == 0:
+                # no vehicle data for the route that day, like routes left out in network mode
+                result['status'] = 'skipped'
+    except MemoryError:
+        # free this date's vehicles so the next route-date has a chance
+        _worker_vehicles.clear()
+        result.update(status='failed', error='MemoryError (over the worker memory limit)')
+    except Exception as e:
+        result.update(status='failed', error=f'{type(e).__name__}: {e}')
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def _run_network_date(
+    version_id:str, route_ids:list, service_date_string:str, output_dir:str, output_format:str) -> list:
+    '''Runs get_stats_network() for every route on one date in a worker process, and returns one
+    result per route.  Routes with nothing to summarize that day are 'skipped'.'''
+    start = time.perf_counter()
+    results = [
+        {'route_id': route_id, 'date': service_date_string, 'status': 'skipped', 'stops': 0, 'error': None}
+        for route_id in route_ids]
+    try:
+        with instrumentation.stage('network_date', routes=len(route_ids), date=service_date_string):
+            vehicles = _get_worker_vehicles(service_date_string)
+            stats_network = headways.get_stats_network(
+                _get_worker_feed(version_id), service_date_string, route_ids=route_ids, vehicles=vehicles,
+                output_dir=output_dir, output_format=output_format)
+            stops = stats_network['route_id'].value_counts() if len(stats_network) > 0 else pd.Series(dtype=int)
+            route_pids = _get_route_pids(vehicles)
+            for result in results:
+                if result['route_id'] in stops.index:
+                    result.update(status='ok', stops=int(stops[result['route_id']]))
+                result['pids'] = route_pids.get(result['route_id'], [])
+                result['patterns'] = headways.get_pattern_fingerprint(result['pids'])
+    except MemoryError:
+        # free this date's vehicles so the next date has a chance
+        _worker_vehicles.clear()
+        for result in results:
+            result.update(status='failed', error='MemoryError (over the worker memory limit)')
+    except Exception as e:
+        for result in results:
+            result.update(status='failed', error=f'{type(e).__name__}: {e}')
+    seconds = time.perf_counter() - start
+    for result in results:
+        result['seconds'] = seconds
+    return results
+
+
+# %%
+###########
+# Batch runs
+###########
+
+def get_bus_route_ids(version_id:str) -> list:
+    '''Parameters:\n
+    version_id is the GTFS schedule version, in the format "YYYYMMDD".\n
+    Data returned:\n
+    list of every bus route id in the schedule version (route_type 3).'''
+    routes = headways.get_gtfs_feed(version_id).routes
+    return sorted(routes.loc[routes['route_type'].astype(str) == '3', 'route_id'].unique())
+
+
+def get_date_strings(start_date:str, end_date:str) -> list:
+    '''Returns every date from start_date to end_date (inclusive) in the format "YYYY-MM-DD".'''
+    return [date.strftime('%Y-%m-%d') for date in pd.date_range(start_date, end_date)]
+
+
+def get_current_route_dates(
+    manifest:Manifest, route_ids:list, dates:list, version_id:str, output_format:str='geojson') -> tuple:
+    '''Parameters:\n
+    manifest is the Manifest of the output directory.\n
+    route_ids, dates, version_id and output_format are the same as run_batch().\n
+    Data returned:\n
+    (set of the (route_id, date) pairs that are already in the manifest with the same inputs,
+    dictionary of the vehicle fingerprint for each date).  A route-date is current if it was
+    calculated with the same GTFS version, the same vehicle files and the same stored patterns,
+    and its output files (in output_format) are still in place.'''
+    vehicle_fingerprints = dict(zip(dates, fetch.map_concurrently(headways.get_chn_vehicle_fingerprint, dates)))
+    pattern_fingerprints = {}
+
+    current = set()
+    for date in dates:
+        for route_id in route_ids:
+            entry = manifest.get(route_id, date)
+            if entry is None:
+                continue
+            pids = tuple(entry['pids'])
+            if pids not in pattern_fingerprints:
+                pattern_fingerprints[pids] = headways.get_pattern_fingerprint(list(pids))
+            fingerprints = {
+                'gtfs_version': version_id,
+                'vehicles': vehicle_fingerprints[date],
+                'patterns': pattern_fingerprints[pids],
+                'output_format': output_format}
+            if manifest.is_current(route_id, date, fingerprints):
+                current.add((route_id, date))
+    return current, vehicle_fingerprints
+
+
+def run_batch(
+    route_ids:list, dates:list, version_id:str, max_workers:int=None, max_memory_gb:float=None,
+    output_dir:str='headway_summaries', network:bool=False, force:bool=False,
+    output_format:str='geojson') -> pd.DataFrame:
+    '''Runs get_stats_all_stops() for every route and date, on a pool of worker processes.\n
+
+    Parameters:\n
+
+    route_ids is a list of route ids as strings (for example, ['55', '66']).\n
+
+    dates is a list of service dates in the format "YYYY-MM-DD".\n
+
+    version_id is the GTFS schedule version to use for all dates, in the format "YYYYMMDD".\n
+
+    max_workers is the number of worker processes (defaults to BATCH_WORKERS).\n
+
+    max_memory_gb is the most memory each worker can use (defaults to BATCH_MAX_MEMORY_GB, no
+    limit if that isn't set).  It is set as the worker's address space limit, which needs a
+    Unix-like system.\n
+
+    output_dir is the directory to export the geojson files to.\n
+
+    network runs each date as one task with get_stats_network(), which summarizes all the routes
+    from a single pass over that date's vehicle data, instead of one task per route-date.  It
+    is faster for many routes, but each worker needs memory for a whole network-day.\n
+
+    force recalculates every route-date, even ones that are current in the manifest.\n
+
+    output_format is 'geojson' or 'geoparquet' (see headways.export_route_summary()).\n
+
+    Each worker loads the feed once, and the vehicle data for each date once (for all routes in
+    the batch), and reuses them for every route-date it runs.  Route-dates are handed out in
+    date order so the workers move through the dates together.  Results are exported by
+    get_stats_all_stops() like a single run: one geojson per route-date plus a route linestring.\n
+
+    Completed route-dates are recorded in a manifest (MANIFEST_FILENAME in output_dir) with
+    fingerprints of their inputs:  the GTFS version, a checksum of the vehicle files (see
+    get_chn_vehicle_fingerprint()) and a fingerprint of the stored patterns the route used.
+    Route-dates whose inputs haven't changed since they were recorded are skipped, so a
+    daily run only calculates new or out of date route-dates.\n
+
+    Data returned:\n
+
+    Dataframe with one row per route-date: route_id, date, status ('ok', 'failed', 'current' if
+    it was up to date in the manifest, or 'skipped' if the route had no vehicle data or patterns
+    that day), number of stops, seconds taken and the error message for failed route-dates.
+    '''
+    max_workers = max_workers or BATCH_WORKERS
+    max_memory_gb = max_memory_gb or BATCH_MAX_MEMORY_GB
+    route_ids = [str(route_id) for route_id in route_ids]
+    dates = sorted(dates)
+    os.makedirs(output_dir, exist_ok=True)
+
+    manifest = Manifest(os.path.join(output_dir, MANIFEST_FILENAME))
+    current, vehicle_fingerprints = get_current_route_dates(
+        manifest, route_ids, dates, version_id, output_format)
+    if force:
+        current = set()
+    results = [
+        {'route_id': route_id, 'date': date, 'status': 'current', 'stops': None, 'seconds': 0, 'error': None}
+        for route_id, date in sorted(current)]
+    pending = {date: [route_id for route_id in route_ids if (route_id, date) not in current] for date in dates}
+    logger.info(f'{len(current)} route-dates are current, {sum(len(r) for r in pending.values())} to calculate')
+
+    def record(result):
+        if result['status'] in ['ok', 'skipped']:
+            outputs = []
+            if result['status'] == 'ok':
+                outputs = headways.get_route_summary_files(result['route_id'], result['date'], output_format)
+            fingerprints = {
+                'gtfs_version': version_id,
+                'vehicles': vehicle_fingerprints[result['date']],
+                'patterns': result['patterns'],
+                'output_format': output_format}
+            manifest.put(
+                result['route_id'], result['date'], result['status'], fingerprints,
+                pids=result['pids'], outputs=outputs)
+
+    last_saved = time.monotonic()
+    try:
+        with ProcessPoolExecutor(
+                max_workers=max_workers, initializer=_init_worker,
+                initargs=(route_ids, max_workers, max_memory_gb)) as executor:
+            if network:
+                futures = [
+                    executor.submit(_run_network_date, version_id, pending[date], date, output_dir, output_format)
+                    for date in dates if len(pending[date]) > 0]
+            else:
+                futures = [
+                    executor.submit(_run_route_date, version_id, route_id, date, output_dir, output_format)
+                    for date in dates for route_id in pending[date]]
+            for i, future in enumerate(as_completed(futures), start=1):
+                future_results = future.result() if network else [future.result()]
+                results.extend(future_results)
+                for result in future_results:
+                    record(result)
+                    logger.info(
+                        f"{i}/{len(futures)} route {result['route_id']} {result['date']}: {result['status']}"
+                        f" ({result['seconds']:.1f}s){' ' + result['error'] if result['error'] else ''}")
+                # save progress now and then, so an interrupted run doesn't have to start over
+                if time.monotonic() - last_saved > MANIFEST_SAVE_SECONDS:
+                    manifest.save()
+                    last_saved = time.monotonic()
+    finally:
+        manifest.save()
+
+    summary = pd.DataFrame(results, columns=BATCH_SUMMARY_COLUMNS)
+    return summary.sort_values(['date', 'route_id']).reset_index(drop=True)
+
+
+# %%
+def main():
+    parser = argparse.ArgumentParser(
+        description='Export headway summaries (get_stats_all_stops) for many routes and dates in parallel.')
+    parser.add_argument('--routes', nargs='+', required=True,
+                        help="route ids, or 'all' for every bus route in the GTFS schedule version")
+    parser.add_argument('--dates', nargs='+', help='service dates in the format YYYY-MM-DD')
+    parser.add_argument('--start-date', help='first service date (YYYY-MM-DD), used with --end-date')
+    parser.add_argument('--end-date', help='last service date (YYYY-MM-DD), inclusive')
+    parser.add_argument('--last-days', type=int,
+                        help='the service dates in the last N days up to yesterday (for a daily job)')
+    parser.add_argument('--gtfs-version', required=True, help='GTFS schedule version_id (YYYYMMDD)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help=f'worker processes (default BATCH_WORKERS, currently {BATCH_WORKERS})')
+    parser.add_argument('--max-memory-gb', type=float, default=None,
+                        help='memory limit for each worker (default BATCH_MAX_MEMORY_GB)')
+    parser.add_argument('--output-dir', default='headway_summaries', help='directory for the geojson files')
+    parser.add_argument('--network', action='store_true',
+                        help='summarize all routes for each date from one pass over the vehicle data')
+    parser.add_argument('--output-format', choices=headways.OUTPUT_FORMATS, default='geojson',
+                        help='geojson files, or a partitioned GeoParquet store (route=/date=) in the output directory')
+    parser.add_argument('--force', action='store_true',
+                        help='recalculate every route-date, even ones that are current in the manifest')
+    parser.add_argument('--summary', help='optional csv file to save the summary of every route-date to')
+    args = parser.parse_args()
+
+    if args.dates:
+        dates = args.dates
+    elif args.start_date and args.end_date:
+        dates = get_date_strings(args.start_date, args.end_date)
+    elif args.last_days:
+        yesterday = pd.Timestamp.today().normalize() - pd.Timedelta(days=1)
+        dates = get_date_strings(yesterday - pd.Timedelta(days=args.last_days - 1), yesterday)
+    else:
+        parser.error('give --dates, both --start-date and --end-date, or --last-days')
+
+    route_ids = args.routes
+    if route_ids == ['all']:
+        route_ids = get_bus_route_ids(args.gtfs_version)
+
+    logging.basicConfig(level=logging.INFO)
+    summary = run_batch(
+        route_ids, dates, args.gtfs_version, max_workers=args.workers,
+        max_memory_gb=args.max_memory_gb, output_dir=args.output_dir, network=args.network,
+        force=args.force, output_format=args.output_format)
+    if args.summary:
+        summary.to_csv(args.summary, index=False)
+
+    failed = summary['status'] == 'failed'
+    logger.info(
+        f"{(summary['status'] == 'ok').sum()} route-dates ok, {(summary['status'] == 'current').sum()} current,"
+        f" {(summary['status'] == 'skipped').sum()} skipped, {failed.sum()} failed")
+    return 1 if failed.any() else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
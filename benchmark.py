@@ -0,0 +1,246 @@
+# %%
+import argparse
+import datetime as dt
+import json
+import logging
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import headways
+import synthetic_data
+
+logger = logging.getLogger(__name__)
+
+
+# %%
+# Stages timed by run_benchmark(), in pipeline order.  get_chn_vehicles runs once for every
+# route, and the others run once per route (like get_stats_all_stops()), adding up.
+BENCHMARK_STAGES = [
+    'get_chn_vehicles',
+    'get_vehicle_intervals',
+    'get_actual_stoptimes',
+    'get_scheduled_stop_details',
+    'get_active_service_times_all_stops',
+    'get_scheduled_headways_all_stops',
+    'get_actual_headways_all_stops',
+    'get_headway_stats_all_stops',
+    'export',
+    ]
+
+# Directory the results are saved to by default
+BENCHMARK_RESULTS_DIR = 'benchmark_results'
+
+
+# %%
+def _git_version() -> str:
+    '''Returns the git commit of the code being benchmarked (with -dirty for local changes), or
+    None if it isn't in a git repository.'''
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'], cwd=Path(__file__).parent,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _measure(func, trace_memory:bool) -> tuple:
+    '''Runs func and returns (result, seconds, peak bytes).  The time comes from a run without
+    tracemalloc (which slows down allocations).  With trace_memory, func runs a second time to
+    measure the peak memory allocated during the stage.'''
+    start = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - start
+
+    peak = None
+    if trace_memory:
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, seconds, peak
+
+
+# %%
+def run_benchmark(
+    service_date_string:str='2023-07-26', n_routes:int=10, n_stops:int=40, n_buses:int=20, seed:int=0,
+    output_format:str='geojson', trace_memory:bool=True, data_dir:str=None) -> dict:
+    '''Parameters:\n
+    service_date_string is the service date to simulate and summarize, in 'YYYY-MM-DD' format.\n
+    n_routes, n_stops, n_buses and seed are passed to write_synthetic_data().\n
+    output_format is the format for the export stage (see export_route_summary()).\n
+    trace_memory is False to skip measuring peak memory (each stage then only runs once).\n
+    data_dir is an optional directory for the synthetic data and exports.  Defaults to a
+    temporary directory that is removed afterwards.\n
+    Data returned:\n
+    dictionary of results:  the parameters, the code version and library versions, and for
+    each stage in BENCHMARK_STAGES its wall time in seconds, the peak memory it allocated
+    (megabytes, from tracemalloc), the rows it returned and rows per second.\n
+    The synthetic data is read offline (CHN_DATA_DIR, PATTERN_STORE_DIR and GTFS_CACHE_DIR
+    are pointed at it), so nothing is downloaded and generating it isn't timed.'''
+    if data_dir is None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            return run_benchmark(
+                service_date_string, n_routes, n_stops, n_buses, seed, output_format, trace_memory, tmp_dir)
+
+    data_dir = Path(data_dir)
+    settings = synthetic_data.write_synthetic_data(
+        data_dir / 'input', service_date_string, n_routes, n_stops, n_buses, seed)
+    output_dir = data_dir / 'headway_summaries'
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    # read everything from the synthetic data, and don't save anything beyond the exports
+    headways.CHN_DATA_DIR = settings['CHN_DATA_DIR']
+    headways.PATTERN_STORE_DIR = settings['PATTERN_STORE_DIR']
+    headways.PATTERNS_OFFLINE = settings['PATTERNS_OFFLINE']
+    headways.GTFS_CACHE_DIR = settings['GTFS_CACHE_DIR']
+    headways.CHN_CACHE_DIR = None
+    headways.STOP_CROSSING_STORE_DIR = None
+    gtfs_feed = headways.get_gtfs_feed(settings['version_id'])
+
+    stages = {stage: {'seconds': 0.0, 'peak_megabytes': 0.0, 'rows': 0} for stage in BENCHMARK_STAGES}
+
+    def run_stage(stage, func):
+        result, seconds, peak = _measure(func, trace_memory)
+        stages[stage]['seconds'] += seconds
+        if peak is not None:
+            stages[stage]['peak_megabytes'] = max(stages[stage]['peak_megabytes'], peak / 1e6)
+        stages[stage]['rows'] += len(result)
+        return result
+
+    route_ids = settings['route_ids']
+    vehicles = run_stage('get_chn_vehicles', lambda: headways.get_chn_vehicles(service_date_string, routes=route_ids))
+
+    for route_id in route_ids:
+        run_stage('get_vehicle_intervals', lambda: headways.get_vehicle_intervals(vehicles, route_id))
+        actual_stoptimes = run_stage('get_actual_stoptimes', lambda: headways.get_actual_stoptimes(route_id, vehicles))
+        stop_details = run_stage(
+            'get_scheduled_stop_details',
+            lambda: headways.get_scheduled_stop_details(gtfs_feed, route_id, service_date_string))
+        active_service_times = run_stage(
+            'get_active_service_times_all_stops', lambda: headways.get_active_service_times_all_stops(stop_details))
+        scheduled_headways = run_stage(
+            'get_scheduled_headways_all_stops',
+            lambda: headways.get_scheduled_headways_all_stops(stop_details, active_service_times))
+        actual_headways = run_stage(
+            'get_actual_headways_all_stops',
+            lambda: headways.get_actual_headways_all_stops(actual_stoptimes, active_service_times))
+        headway_stats = run_stage(
+            'get_headway_stats_all_stops',
+            lambda: headways.get_headway_stats_all_stops(scheduled_headways, actual_headways))
+
+        # patterns for the summary (read from the pattern store, already timed in get_actual_stoptimes)
+        patterns = headways.get_patterns(vehicles, route_id)
+        pattern_stops = headways.get_pattern_stops(patterns)
+
+        def export():
+            stats_all_stops = headways.get_route_summary(
+                route_id, service_date_string, stop_details, actual_stoptimes, headway_stats, pattern_stops)
+            headways.export_route_summary(
+                stats_all_stops, headways.get_pattern_linestrings(patterns), route_id, service_date_string,
+                str(output_dir), output_format)
+            return stats_all_stops
+        run_stage('export', export)
+
+    for stage in stages.values():
+        stage['rows_per_second'] = round(stage['rows'] / stage['seconds']) if stage['seconds'] > 0 else None
+        stage['seconds'] = round(stage['seconds'], 4)
+        stage['peak_megabytes'] = round(stage['peak_megabytes'], 1) if trace_memory else None
+
+    return {
+        'created': dt.datetime.now().isoformat(timespec='seconds'),
+        'version': _git_version(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'parameters': {
+            'service_date': service_date_string, 'routes': n_routes, 'stops': n_stops, 'buses': n_buses,
+            'seed': seed, 'output_format': output_format, 'vehicle_rows': len(vehicles)},
+        'total_seconds': round(sum(stage['seconds'] for stage in stages.values()), 4),
+        'stages': [{'stage': name, **stage} for name, stage in stages.items()],
+        }
+
+
+# %%
+def save_results(results:dict, path:str=None) -> str:
+    '''Saves benchmark results as json, by default to BENCHMARK_RESULTS_DIR/benchmark_{created}.json,
+    and returns the path.'''
+    if path is None:
+        created = results['created'].replace(':', '').replace('-', '')
+        path = os.path.join(BENCHMARK_RESULTS_DIR, f'benchmark_{created}.json')
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=1)
+    return path
+
+
+def get_results_table(results:dict) -> pd.DataFrame:
+    '''Returns the stages of benchmark results as a dataframe, one row per stage.'''
+    return pd.DataFrame(results['stages']).set_index('stage')
+
+
+def compare_results(old_results_path:str, new_results_path:str) -> pd.DataFrame:
+    '''Parameters:\n
+    old_results_path and new_results_path are json files saved by save_results(), for example
+    from two versions of the code run with the same parameters.\n
+    Data returned:\n
+    dataframe with the seconds and peak megabytes of each stage in both results, and the
+    speedup (old seconds / new seconds).'''
+    results = {}
+    for label, path in [('old', old_results_path), ('new', new_results_path)]:
+        with open(path) as f:
+            results[label] = json.load(f)
+    if results['old']['parameters'] != results['new']['parameters']:
+        logger.warning(
+            f"The results were run with different parameters: {results['old']['parameters']} and"
+            f" {results['new']['parameters']}")
+
+    comparison = pd.concat([
+        get_results_table(label_results)[['seconds', 'peak_megabytes']].add_prefix(f'{label} ')
+        for label, label_results in results.items()], axis=1)
+    comparison['speedup'] = (comparison['old seconds'] / comparison['new seconds']).round(2)
+    return comparison
+
+
+# %%
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time each stage of the headway calculations on synthetic data, offline.')
+    parser.add_argument('--routes', type=int, default=10, help='number of synthetic routes')
+    parser.add_argument('--stops', type=int, default=40, help='stops in each direction of each route')
+    parser.add_argument('--buses', type=int, default=20, help='buses on each route')
+    parser.add_argument('--date', default='2023-07-26', help='service date to simulate (YYYY-MM-DD)')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the synthetic data')
+    parser.add_argument('--output-format', choices=headways.OUTPUT_FORMATS, default='geojson',
+                        help='format for the export stage')
+    parser.add_argument('--no-memory', action='store_true',
+                        help="don't measure peak memory (runs each stage once, without tracemalloc)")
+    parser.add_argument('--data-dir', help='keep the synthetic data and exports in this directory')
+    parser.add_argument('--output', help=f'json file for the results (default in {BENCHMARK_RESULTS_DIR}/)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two saved results files instead of running the benchmark')
+    args = parser.parse_args()
+
+    if args.compare:
+        print(compare_results(*args.compare).to_string())
+        return 0
+
+    logging.basicConfig(level=logging.INFO)
+    results = run_benchmark(
+        args.date, args.routes, args.stops, args.buses, args.seed, args.output_format,
+        trace_memory=not args.no_memory, data_dir=args.data_dir)
+    print(get_results_table(results).to_string())
+    print(f"total {results['total_seconds']} seconds for {results['parameters']['vehicle_rows']} vehicle rows")
+    logger.info(f'Results saved to {save_results(results, args.output)}')
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
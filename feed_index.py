@@ -0,0 +1,121 @@
+# %%
+from functools import cached_property
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import instrumented
+
+
+# %%
+class KeyIndex:
+    '''Row positions for each distinct key in a column, stored CSR style: the positions are
+    sorted by key, and offsets[i]:offsets[i+1] are the positions for the i-th key.\n
+
+    Parameters:\n
+
+    keys is a column (array or Series) of keys, one per row.  Missing keys are never found.
+    '''
+
+    def __init__(self, keys):
+        codes, uniques = pd.factorize(np.asarray(keys))
+        self.keys = pd.Index(uniques)
+        # missing keys go in an extra group at the end, which is never looked up
+        codes = np.where(codes < 0, len(self.keys), codes)
+        self.positions = np.argsort(codes, kind='stable')
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(self.keys) + 1))])
+
+    def ranges(self, keys) -> tuple:
+        '''Returns (starts, ends) into self.positions for each of keys that is in the index.'''
+        codes = self.keys.get_indexer(pd.Index(keys).unique())
+        codes = codes[codes >= 0]
+        return self.offsets[codes], self.offsets[codes + 1]
+
+    def rows(self, keys) -> np.ndarray:
+        '''Returns the row positions for all of keys, grouped by key (in the order of keys).'''
+        starts, ends = self.ranges(keys)
+        return self.positions[expand_ranges(starts, ends)]
+
+
+def expand_ranges(starts:np.ndarray, ends:np.ndarray) -> np.ndarray:
+    '''Returns the concatenation of np.arange(start, end) for every (start, end), without a
+    Python loop.'''
+    lengths = ends - starts
+    total = lengths.sum()
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    # the offset to add to a running count so each range starts at its own start
+    range_offsets = np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+    return np.arange(total) + range_offsets
+
+
+# %%
+class FeedIndex:
+    '''Indexes into a GTFS feed, to pull the trips and stop times for a few routes without
+    scanning the whole feed.  Use get_feed_index() to build one once per feed.\n
+
+    Parameters:\n
+
+    trips is the GTFS trips table.\n
+
+    stop_times is the GTFS stop_times table (or some of its columns, including trip_id and stop_id).\n
+
+    The stop times are stored sorted by trip (keeping their order within each trip), so the
+    stop times for a trip are one contiguous slice (trip_offsets, CSR style).  route_id -> trips
+    and stop_id -> stop times rows are KeyIndexes (the stop index is built the first time it's used).
+    '''
+
+    def __init__(self, trips:pd.DataFrame, stop_times:pd.DataFrame):
+        self.trips = trips.reset_index(drop=True)
+        self.route_index = KeyIndex(self.trips['route_id'])
+
+        trip_index = KeyIndex(stop_times['trip_id'])
+        self.stop_times = stop_times.take(trip_index.positions).reset_index(drop=True)
+        self.trip_ids = trip_index.keys
+        self.trip_offsets = trip_index.offsets
+
+    @cached_property
+    def stop_index(self) -> KeyIndex:
+        # only built if stop lookups are used
+        return KeyIndex(self.stop_times['stop_id'])
+
+    def route_trips(self, route_ids:list) -> pd.DataFrame:
+        '''Returns the trips table rows for route_ids.'''
+        return self.trips.take(self.route_index.rows(route_ids))
+
+    def trip_rows(self, trip_ids) -> np.ndarray:
+        '''Returns the positions in self.stop_times of the stop times for trip_ids.'''
+        codes = self.trip_ids.get_indexer(pd.Index(trip_ids).unique())
+        codes = codes[codes >= 0]
+        return expand_ranges(self.trip_offsets[codes], self.trip_offsets[codes + 1])
+
+    def trip_stop_times(self, trip_ids) -> pd.DataFrame:
+        '''Returns the stop times for trip_ids, grouped by trip.'''
+        return self.stop_times.take(self.trip_rows(trip_ids))
+
+    def stop_stop_times(self, stop_ids) -> pd.DataFrame:
+        '''Returns the stop times at stop_ids, grouped by stop.'''
+        return self.stop_times.take(self.stop_index.rows(stop_ids))
+
+
+@instrumented
+def get_feed_index(gtfs_feed, stop_time_columns:list=None) -> FeedIndex:
+    '''Parameters:\n
+    gtfs_feed is a GTFSFeed or a CachedGTFSFeed (from gtfs_feed_cache).\n
+    stop_time_columns is the list of stop_times columns to keep in the index (all of them if None).
+    It is only used the first time the index is built for a feed.\n
+    Data returned:\n
+    the FeedIndex for the feed.  It is built the first time and saved on the feed object, so
+    later calls for the same feed reuse it.'''
+    feed_index = getattr(gtfs_feed, 'feed_index', None)
+    if feed_index is None:
+        if hasattr(gtfs_feed, 'read_table'):
+            # cached feed: only read the needed columns
+            stop_times = gtfs_feed.read_table('stop_times', columns=stop_time_columns)
+        elif stop_time_columns is not None:
+            stop_times = gtfs_feed.stop_times[stop_time_columns]
+        else:
+            stop_times = gtfs_feed.stop_times
+        feed_index = FeedIndex(gtfs_feed.trips, stop_times)
+        gtfs_feed.feed_index = feed_index
+    return feed_index
@@ -0,0 +1,125 @@
+# %%
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import instrumentation
+
+
+# %%
+# Connection pool and retry settings shared by every request
+MAX_WORKERS = 8
+RETRIES = 3
+BACKOFF_FACTOR = 0.5
+TIMEOUT_SECONDS = 120
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    '''Returns a requests Session shared by all requests, with a connection pool sized for
+    MAX_WORKERS concurrent requests.  Failed connections and 429/5xx responses are
+    retried up to RETRIES times with exponential backoff (BACKOFF_FACTOR seconds, doubling).'''
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(
+                total=RETRIES,
+                backoff_factor=BACKOFF_FACTOR,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=['GET', 'HEAD'])
+            adapter = HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS, max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+    return _session
+
+
+# %%
+class TokenBucket:
+    '''Rate limiter allowing on average rate requests per second, with bursts of up to
+    capacity requests.\n
+
+    Parameters:\n
+
+    rate is the number of tokens added per second.\n
+
+    capacity is the most tokens the bucket can hold (defaults to rate, minimum 1).\n
+
+    Call acquire() before each request; it blocks until a token is available.  One bucket
+    can be shared by several threads.'''
+
+    def __init__(self, rate:float, capacity:float=None):
+        self.rate = rate
+        self.capacity = max(capacity if capacity is not None else rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated)*self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens)/self.rate
+            time.sleep(wait)
+
+
+# %%
+def get(url:str, rate_limiter:TokenBucket=None, stream:bool=False) -> requests.Response:
+    '''Parameters:\n
+    url is the url to request.\n
+    rate_limiter is an optional TokenBucket to wait on before sending the request.\n
+    stream is True to read the response body as it arrives (from response.raw) instead of
+    downloading all of it first.\n
+    Data returned:\n
+    the response, using the shared session.  Raises requests.HTTPError for error
+    status codes that are still failing after retries.'''
+    if rate_limiter is not None:
+        rate_limiter.acquire()
+    response = get_session().get(url, timeout=TIMEOUT_SECONDS, stream=stream)
+    response.raise_for_status()
+    instrumentation.count('http_requests')
+    # streamed bodies aren't downloaded yet, so count their announced size
+    instrumentation.count('http_bytes', int(response.headers.get('Content-Length', 0)) if stream else len(response.content))
+    return response
+
+
+def head(url:str) -> requests.Response:
+    '''Same as get() for a HEAD request, to read a file's headers (size, ETag) without downloading it.'''
+    response = get_session().head(url, timeout=TIMEOUT_SECONDS)
+    response.raise_for_status()
+    instrumentation.count('http_requests')
+    return response
+
+
+def get_json_all(urls:list, rate_limiter:TokenBucket=None, max_workers:int=MAX_WORKERS) -> list:
+    '''Parameters:\n
+    urls is a list of urls returning json.\n
+    rate_limiter is an optional TokenBucket shared by all of the requests.\n
+    max_workers is the most requests to have in flight at once.\n
+    Data returned:\n
+    list of decoded json responses, in the same order as urls.'''
+    if len(urls) == 0:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(urls))) as executor:
+        return list(executor.map(lambda url: get(url, rate_limiter).json(), urls))
+
+
+def map_concurrently(function, items:list, max_workers:int=MAX_WORKERS) -> list:
+    '''Calls function on every item in items using a thread pool (for downloads and other
+    work that waits on the network), and returns the results in the same order as items.'''
+    if len(items) == 0:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(function, items))
@@ -0,0 +1,196 @@
+# %%
+import os
+import shutil
+import tempfile
+from functools import cached_property
+from pathlib import Path
+
+import pandas as pd
+
+import instrumentation
+from instrumentation import instrumented
+
+
+# %%
+# Tables in a GTFSFeed from the ghost bus team's static_gtfs_analysis module
+GTFS_TABLES = ['stops', 'stop_times', 'routes', 'trips', 'calendar', 'calendar_dates', 'shapes']
+
+# GTFS columns that are always numbers.  Everything else from the zip file stays a string, like
+# GTFSFeed.extract_data() reads it (calendar flags, for example, are compared to "1").  Columns
+# added by format_gtfs_feed() in headways.py keep their types (datetimes and integers).
+GTFS_NUMERIC_DTYPES = {
+    'stop_sequence': 'int32',
+    'shape_pt_sequence': 'int32',
+    'stop_lat': 'float64',
+    'stop_lon': 'float64',
+    'shape_pt_lat': 'float64',
+    'shape_pt_lon': 'float64',
+    'shape_dist_traveled': 'float64',
+    'arrival_seconds': 'int32',
+    'departure_seconds': 'int32',
+    'arrival_hour': 'int8',
+    'departure_hour': 'int8',
+    }
+
+# stop_times is written sorted by trip, in row groups of this many rows, so reading the stop times
+# for a list of trips can skip most of the file
+STOP_TIMES_ROW_GROUP_ROWS = 100000
+
+
+# %%
+class CachedGTFSFeed:
+    '''A GTFS feed saved by GTFSFeedCache, with the same table attributes as GTFSFeed (stops,
+    stop_times, routes, trips, calendar, calendar_dates and shapes).\n
+
+    Parameters:\n
+
+    feed_dir is the directory with one parquet file per table.\n
+
+    version_id is the schedule version of the feed.\n
+
+    Each table is only read the first time its attribute is used.  Use read_table() to read
+    part of a table (some columns, or rows matching filters) without loading all of it, and
+    read_stop_times() to read the stop times for a list of trips.
+    '''
+
+    def __init__(self, feed_dir:str, version_id:str):
+        self.feed_dir = Path(feed_dir)
+        self.version_id = version_id
+
+    @instrumented
+    def read_table(self, table:str, columns:list=None, filters:list=None) -> pd.DataFrame:
+        '''Returns a table, or None if the feed doesn't have it.  columns and filters (in
+        pyarrow's format, e.g. [('trip_id', 'in', trip_list)]) limit the data read.'''
+        path = self.feed_dir / f'{table}.parquet'
+        if not path.exists():
+            return None
+        return pd.read_parquet(path, columns=columns, filters=filters)
+
+    @instrumented
+    def read_stop_times(self, trip_ids:list, columns:list=None) -> pd.DataFrame:
+        '''Returns the stop_times rows for trip_ids.  stop_times is saved sorted by trip_id, so
+        only the row groups that can hold these trips are read.'''
+        if len(trip_ids) == 0:
+            # no rows, just the columns
+            return self.read_table('stop_times', columns=columns, filters=[('trip_id', '<', '')])
+        # pyarrow skips row groups using the min and max, but not using the list of values alone
+        filters = [
+            ('trip_id', '>=', min(trip_ids)),
+            ('trip_id', '<=', max(trip_ids)),
+            ('trip_id', 'in', list(trip_ids))]
+        return self.read_table('stop_times', columns=columns, filters=filters)
+
+    @cached_property
+    def stops(self) -> pd.DataFrame:
+        return self.read_table('stops')
+
+    @cached_property
+    def stop_times(self) -> pd.DataFrame:
+        return self.read_table('stop_times')
+
+    @cached_property
+    def routes(self) -> pd.DataFrame:
+        return self.read_table('routes')
+
+    @cached_property
+    def trips(self) -> pd.DataFrame:
+        return self.read_table('trips')
+
+    @cached_property
+    def calendar(self) -> pd.DataFrame:
+        return self.read_table('calendar')
+
+    @cached_property
+    def calendar_dates(self) -> pd.DataFrame:
+        return self.read_table('calendar_dates')
+
+    @cached_property
+    def shapes(self) -> pd.DataFrame:
+        return self.read_table('shapes')
+
+
+# %%
+class GTFSFeedCache:
+    '''A directory of GTFS feeds converted to typed parquet files, one subdirectory per
+    schedule version_id.\n
+
+    Parameters:\n
+
+    cache_dir is the directory to keep the feeds in.  It is created if it doesn't exist.\n
+
+    Schedule versions don't change once they are published, so each one only needs to be
+    downloaded and converted once.  Later loads only read the tables (and columns) that are
+    used.
+    '''
+
+    def __init__(self, cache_dir:str):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def feed_dir(self, version_id:str) -> Path:
+        return self.cache_dir / str(version_id)
+
+    def version_ids(self) -> list:
+        '''Lists the schedule versions in the cache.'''
+        return sorted(p.name for p in self.cache_dir.iterdir() if p.is_dir() and not p.name.endswith('.tmp'))
+
+    def get(self, version_id:str) -> CachedGTFSFeed:
+        '''Returns the cached feed for version_id, or None if it isn't cached.'''
+        feed_dir = self.feed_dir(version_id)
+        if not feed_dir.exists():
+            return None
+        return CachedGTFSFeed(feed_dir, version_id)
+
+    @instrumented
+    def put(self, version_id:str, gtfs_feed) -> CachedGTFSFeed:
+        '''Saves every table of gtfs_feed (a GTFSFeed, after format_gtfs_feed() in headways.py) as
+        typed parquet, and returns the cached feed.  If another process caches the same version
+        first, its copy is kept (schedule versions don't change).'''
+        feed_dir = self.feed_dir(version_id)
+        # write to a temporary directory first so a partly written feed is never read.  The name
+        # is unique to this writer, since batch workers can download the same version at once
+        tmp_dir = Path(tempfile.mkdtemp(prefix=f'{feed_dir.name}.', suffix='.tmp', dir=self.cache_dir))
+
+        try:
+            for table in GTFS_TABLES:
+                df = getattr(gtfs_feed, table, None)
+                if df is None:
+                    continue
+                dtypes = {column: dtype for column, dtype in GTFS_NUMERIC_DTYPES.items() if column in df.columns}
+                df = df.astype(dtypes)
+                row_group_size = None
+                if table == 'stop_times':
+                    df = df.sort_values('trip_id', kind='mergesort')
+                    row_group_size = STOP_TIMES_ROW_GROUP_ROWS
+                df.to_parquet(
+                    tmp_dir / f'{table}.parquet', compression='zstd', index=False, row_group_size=row_group_size)
+        except BaseException:
+            # don't leave a partly written feed behind if a table fails or the worker is stopped
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+        try:
+            os.replace(tmp_dir, feed_dir)
+        except OSError:
+            if not feed_dir.exists():
+                raise
+            # another writer finished first
+            shutil.rmtree(tmp_dir)
+        return CachedGTFSFeed(feed_dir, version_id)
+
+    @instrumented
+    def get_feed(self, version_id:str, download_extract_format) -> CachedGTFSFeed:
+        '''Parameters:\n
+        version_id is the schedule version to load.\n
+        download_extract_format is a function taking a version_id and returning a GTFSFeed with
+        formatted dates and hours (download_gtfs_feed() in headways.py, or download_extract_format()
+        from the ghost bus team).  It is only called if the version isn't already cached.\n
+        Data returned:\n
+        the cached feed for version_id.'''
+        gtfs_feed = self.get(version_id)
+        if gtfs_feed is None:
+            instrumentation.count('gtfs_cache_misses')
+            gtfs_feed = self.put(version_id, download_extract_format(version_id))
+        else:
+            instrumentation.count('gtfs_cache_hits')
+        return gtfs_feed
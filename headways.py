@@ -1,10 +1,26 @@
 # %%
 import requests
+import hashlib
+from io import BytesIO
 from dotenv import load_dotenv
 import pandas as pd
 import geopandas as gpd
 from shapely.geometry import Point, LineString
 import datetime as dt
+from functools import cached_property
+from parquet_cache import ParquetCache
+from pattern_store import PatternStore
+from gtfs_feed_cache import GTFSFeedCache
+from feed_index import FeedIndex, KeyIndex, get_feed_index
+from scheduled_cache import get_scheduled_cache
+from summary_store import SummaryStore
+from stop_crossing_store import StopCrossingStore
+from service_calendar import ServiceCalendar
+from vehicle_archive import VehicleArchive, VehicleArrays
+from instrumentation import instrumented
+import fetch
+import instrumentation
+import time_parsing
 import numpy as np
 import pendulum
 
@@ -20,6 +36,46 @@ from scrape_data.scrape_data import *
 load_dotenv()
 API_KEY = os.getenv('API_KEY')
 
+# Where data is downloaded from.  These can be changed in the .env file, for example
+# to point at a local test server.
+CTA_API_URL = os.getenv('CTA_API_URL', 'http://www.ctabustracker.com/bustime/api/v2')
+CHN_DATA_URL = os.getenv('CHN_DATA_URL', 'https://chn-ghost-buses-public.s3.us-east-2.amazonaws.com/bus_full_day_data_v2')
+
+# Most CTA API requests per second for this API key (shared by all concurrent requests)
+CTA_API_RATE = float(os.getenv('CTA_API_RATE', 5))
+cta_rate_limiter = fetch.TokenBucket(CTA_API_RATE)
+
+# Optional local storage for chn vehicle data, also set in the .env file:
+# CHN_DATA_DIR is a directory of full-day csv files (YYYY-MM-DD.csv) to read instead of the S3 bucket.
+# CHN_CACHE_DIR is a directory where each day is saved as parquet the first time it's read.
+# CHN_CACHE_MAX_GB limits the size of CHN_CACHE_DIR (least recently used days are deleted first).
+CHN_DATA_DIR = os.getenv('CHN_DATA_DIR')
+CHN_CACHE_DIR = os.getenv('CHN_CACHE_DIR')
+CHN_CACHE_MAX_GB = float(os.getenv('CHN_CACHE_MAX_GB', 10))
+
+# Optional pattern store for CTA getpatterns data, also set in the .env file:
+# PATTERN_STORE_DIR is a directory where each pattern is saved the first time it is downloaded.
+# PATTERNS_OFFLINE=1 only uses patterns already in PATTERN_STORE_DIR and never calls the CTA API.
+PATTERN_STORE_DIR = os.getenv('PATTERN_STORE_DIR')
+PATTERNS_OFFLINE = os.getenv('PATTERNS_OFFLINE', '').lower() in ['1', 'true', 'yes']
+
+# Optional cache for GTFS feeds, also set in the .env file:
+# GTFS_CACHE_DIR is a directory where each schedule version is saved as typed parquet the first time
+# it is downloaded (see get_gtfs_feed()).
+GTFS_CACHE_DIR = os.getenv('GTFS_CACHE_DIR')
+
+# Optional store for actual stop times, also set in the .env file:
+# STOP_CROSSING_STORE_DIR is a directory where get_stats_all_stops() and get_stats_network() save
+# each route-date's actual stop times (see StopCrossingStore).
+STOP_CROSSING_STORE_DIR = os.getenv('STOP_CROSSING_STORE_DIR')
+
+# Optional timing of each stage of the calculations, also set in the .env file (see instrumentation.py):
+# INSTRUMENTATION_LOG=1 logs the time, rows and counters (downloads, cache hits) of every stage.
+# INSTRUMENTATION_FILE is a file where the same records are appended as json lines.
+instrumentation.configure(
+    log=os.getenv('INSTRUMENTATION_LOG', '').lower() in ['1', 'true', 'yes'],
+    path=os.getenv('INSTRUMENTATION_FILE'))
+
 # %%
 
 ###########
@@ -46,13 +102,73 @@ def string_to_datetime(date_string:str) -> pendulum.datetime:
 
 
 # %%
-def get_scheduled_stop_details(gtfs_feed:GTFSFeed, route_id:str, service_date_string:str) -> pd.DataFrame:
+@instrumented
+def format_gtfs_feed(gtfs_feed:GTFSFeed) -> GTFSFeed:
+    '''Parameters:\n
+    gtfs_feed is a GTFSFeed as extracted from the zip file (GTFSFeed.extract_data()).\n
+    Data returned:\n
+    the same feed with the columns added by the ghost bus team's format_dates_hours():  calendar
+    start_date_dt and end_date_dt, calendar_dates date_dt, and stop_times arrival_hour and
+    departure_hour (wrapped at 24 like get_hour()).  stop_times also gets arrival_seconds and
+    departure_seconds (seconds after the start of the service day, not wrapped).  Times are read
+    with the fixed-format parsers in time_parsing.py rather than one row at a time.'''
+    gtfs_feed.calendar['start_date_dt'] = pd.to_datetime(gtfs_feed.calendar['start_date'], format='%Y%m%d', utc=True)
+    gtfs_feed.calendar['end_date_dt'] = pd.to_datetime(gtfs_feed.calendar['end_date'], format='%Y%m%d', utc=True)
+    gtfs_feed.calendar_dates['date_dt'] = pd.to_datetime(gtfs_feed.calendar_dates['date'], format='%Y%m%d', utc=True)
+
+    for prefix in ['arrival', 'departure']:
+        seconds = time_parsing.parse_gtfs_times(gtfs_feed.stop_times[f'{prefix}_time'])
+        hours = seconds // 3600
+        gtfs_feed.stop_times[f'{prefix}_seconds'] = seconds
+        gtfs_feed.stop_times[f'{prefix}_hour'] = np.where(hours >= 24, hours - 24, hours)
+
+    return gtfs_feed
+
+
+def download_gtfs_feed(version_id:str) -> GTFSFeed:
+    '''Same as the download_extract_format() function from the ghost bus team, formatting the
+    feed with format_gtfs_feed().'''
+    return format_gtfs_feed(GTFSFeed.extract_data(download_zip(version_id), version_id=version_id))
+
+
+@instrumented
+def get_gtfs_feed(version_id:str) -> GTFSFeed:
+    '''Parameters:\n
+    version_id is the GTFS schedule version, in the format "YYYYMMDD".\n
+    Data returned:\n
+    GTFS feed data for the schedule version, downloaded and extracted with the ghost bus team's
+    functions and formatted with format_gtfs_feed().  If GTFS_CACHE_DIR is set, the feed is only
+    downloaded the first time and is loaded from the cache after that (one table at a time, when
+    it is used).'''
+    if GTFS_CACHE_DIR:
+        return GTFSFeedCache(GTFS_CACHE_DIR).get_feed(version_id, download_gtfs_feed)
+    return download_gtfs_feed(version_id)
+
+
+# Columns from the gtfs stop_times table used for the scheduled headway calcs
+SCHEDULED_STOP_TIME_COLUMNS = ['trip_id', 'arrival_time', 'arrival_seconds', 'stop_id', 'stop_sequence']
+
+
+def get_scheduled_feed_index(gtfs_feed:GTFSFeed) -> FeedIndex:
+    '''This is a helper function.\n
+    Data returned:\n
+    the feed's FeedIndex with the SCHEDULED_STOP_TIME_COLUMNS.  Feeds from the ghost bus team's
+    download_extract_format() don't have arrival_seconds, so their times are parsed once here
+    with format_gtfs_feed() rather than for every service date.'''
+    if not hasattr(gtfs_feed, 'read_table') and 'arrival_seconds' not in gtfs_feed.stop_times.columns:
+        format_gtfs_feed(gtfs_feed)
+    return get_feed_index(gtfs_feed, SCHEDULED_STOP_TIME_COLUMNS)
+
+
+# %%
+@instrumented
+def get_scheduled_stop_details_routes(gtfs_feed:GTFSFeed, route_ids:list, service_date_string:str) -> pd.DataFrame:
     
     '''Parameters:\n
 
-    gtfs_feed is obtained using the download_extract_format() function from the ghost bus team.\n
+    gtfs_feed is obtained using get_gtfs_feed() or the download_extract_format() function from the ghost bus team.\n
 
-    route_id is a route id as a string (for example, '55' for the 55 Garfield bus)\n
+    route_ids is a list of route ids as strings (for example, ['55', '63'])\n
 
     service_date_string is in the format "YYYY-MM-DD", indicating the service date to be analyzed.
     Note that service dates can include spillover into the next calendar day, for bus routes that run
@@ -60,25 +176,20 @@ def get_scheduled_stop_details(gtfs_feed:GTFSFeed, route_id:str, service_date_st
 
     Data returned:\n
 
-    DataFrame of scheduled stop information for the route and day, including scheduled
-    stop times at every bus stop with service IDs and direction of travel.'''
+    DataFrame of scheduled stop information for the routes and day, including scheduled
+    stop times at every bus stop with service IDs and direction of travel.  Trips and stop times
+    are looked up in the feed's FeedIndex (built the first time the feed is used), so getting
+    several routes in one call costs about the same as getting one.'''
 
     service_date = string_to_datetime(service_date_string)
+    feed_index = get_scheduled_feed_index(gtfs_feed)
 
-    # Get trip summary for service date using chn-ghost-buses make_trip_summary() function
-    trip_summary = make_trip_summary(gtfs_feed, service_date, service_date)
+    # Get the trips on these routes that run on the service date, one row per trip
+    service_dates = ServiceCalendar.from_feed(gtfs_feed).service_dates(service_date, service_date)
+    trip_summary = feed_index.route_trips(route_ids).merge(service_dates, on='service_id')
 
-    # filter down to the specified route
-    trip_summary = trip_summary[trip_summary['route_id'] == route_id]
-
-    # list trip ids for this route
-    trip_list = trip_summary['trip_id'].unique().tolist()
-
-    # get stop times data for the trips on this route
-    stop_times = gtfs_feed.stop_times
-
-    # filter stop times down to the relevant trips
-    stop_times = stop_times.loc[stop_times['trip_id'].isin(trip_list)]
+    # get stop times data for these trips (a slice of the index for each trip)
+    stop_times = feed_index.trip_stop_times(trip_summary['trip_id'])
 
     # Add service id, route, and direction to the stop times data
     stop_times = stop_times.merge(trip_summary[['trip_id', 'route_id', 'service_id', 'direction', 'raw_date']], on='trip_id')
@@ -87,19 +198,32 @@ def get_scheduled_stop_details(gtfs_feed:GTFSFeed, route_id:str, service_date_st
     # data from the CTA's api
     stop_times['direction'] = stop_times['direction'].apply(lambda x: f'{x}bound')
 
-    # filter stop details down to the relevant route
-    stop_times = stop_times.loc[stop_times['route_id'] == route_id]
+    # add stop time as a timestamp, from the seconds parsed once by format_gtfs_feed()
+    stop_times['stop_time'] = stop_times['raw_date'] + pd.to_timedelta(stop_times['arrival_seconds'], unit='s')
 
-    # Eliminate duplicates - every line shows up twice.
-    # TODO:  Investigate why. Is this related to the calendar_cross line in the 
-    # make_trip_summary() function? And/or the fact that I'm using the 
-    # same date as start and end date as arguments in make_trip_summary?()
-    stop_times = stop_times.drop_duplicates()
+    return stop_times
 
-    # add stop time as a timestamp
-    stop_times['stop_time'] = stop_times['raw_date'] + pd.to_timedelta(stop_times['arrival_time'])
 
-    return stop_times
+# %%
+@instrumented
+def get_scheduled_stop_details(gtfs_feed:GTFSFeed, route_id:str, service_date_string:str) -> pd.DataFrame:
+    
+    '''Parameters:\n
+
+    gtfs_feed is obtained using get_gtfs_feed() or the download_extract_format() function from the ghost bus team.\n
+
+    route_id is a route id as a string (for example, '55' for the 55 Garfield bus)\n
+
+    service_date_string is in the format "YYYY-MM-DD", indicating the service date to be analyzed.
+    Note that service dates can include spillover into the next calendar day, for bus routes that run
+    past midnight.\n
+
+    Data returned:\n
+
+    DataFrame of scheduled stop information for the route and day, including scheduled
+    stop times at every bus stop with service IDs and direction of travel.'''
+
+    return get_scheduled_stop_details_routes(gtfs_feed, [route_id], service_date_string)
 
 
 
@@ -107,12 +231,14 @@ def get_scheduled_stop_details(gtfs_feed:GTFSFeed, route_id:str, service_date_st
 
 
 # %% 
+@instrumented
 def get_scheduled_stop_ids(scheduled_stop_details):
     return set(scheduled_stop_details['stop_id'])
 
 
 
 # %%
+@instrumented
 def get_active_service_times(stop_details:pd.DataFrame, stop_id:str, direction:str) -> pd.DataFrame:
     
     '''
@@ -137,83 +263,73 @@ def get_active_service_times(stop_details:pd.DataFrame, stop_id:str, direction:s
     Note:  Some services only run one bus - these will show the same start and end time.
     '''
 
-    # dataframe to contain service time ranges
-    service_ranges = pd.DataFrame()
-
     # filter stop details to a single stop and direction of travel
     single_stop_details = stop_details.loc[
         stop_details['stop_id'] == stop_id].loc[
             stop_details['direction'] == direction]
 
-    # find service IDs that serve the stop
-    service_ids = set(single_stop_details['service_id'])
+    active_service_times = get_active_service_times_all_stops(single_stop_details)
 
-    # find times when each service starts and ends
-    for service_id in service_ids:
-        df_service = single_stop_details.loc[single_stop_details['service_id'] == service_id]
-        times = df_service['stop_time'].tolist()
-        # start and end times adjusted to allow 10 minute buffers for buses arriving
-        # slightly earlier or later than scheduled.
-        start_time = min(times)-pd.Timedelta(minutes=10)
-        end_time = max(times)+pd.Timedelta(minutes=10)
+    return active_service_times[['start_time', 'end_time']].reset_index(drop=True)
 
-        # print(f'service id {service_id}, start {start_time}, end {end_time}')
 
-        # make a 2-row dataframe containing start and end times of 
-        # one service id at this stop.
-        # The adjustment column will be used to cumulatively count the 
-        # services running at any given time.  Adding a service means an adjustment
-        # of 1, while ending a service means an adjustment of -1.
-        df = pd.DataFrame(
-            [[service_id, start_time, 1],[service_id, end_time, -1]],
-            columns=['service_id', 'time', 'adjustment'])
+# %%
+@instrumented
+def get_active_service_times_all_stops(stop_details:pd.DataFrame) -> pd.DataFrame:
+
+    '''
+    Parameters:\n
 
-        # Add this service id's times to the dataframe for all service times
-        service_ranges = pd.concat([service_ranges, df])
+    stop_details is a dataframe with information on bus stop times, generated by the
+    get_scheduled_stop_details function.  It can cover a single route or many routes
+    (for example, several routes' stop details concatenated together).\n
 
-        # sort by time
-        service_ranges.sort_values('time', inplace=True)
+    Data returned:\n
 
-        # add a column to show how many services are running (cumulative sum of the 
-        # 'adjustment' column)
-        service_ranges['services_running'] = service_ranges['adjustment'].cumsum(axis=0)
+    Pandas DataFrame with one row per in-service timeframe for every route, stop and
+    direction of travel, with columns route_id, stop_id, direction, start_time and end_time.
+    These are the same timeframes get_active_service_times() returns for a single stop,
+    calculated for every stop in one pass.\n
 
-    # reset the index
-    service_ranges.reset_index(inplace=True)
+    Each service's first and last scheduled stop times are buffered by 10 minutes.  Services
+    are then sorted by start time within each route/stop/direction, and a new timeframe starts
+    whenever a service starts after every earlier service has ended (running maximum of
+    the end times).
+    '''
 
+    keys = ['route_id', 'stop_id', 'direction']
 
-    # generate a list of start and end times when ANY service is active.
-    active_service_times = pd.DataFrame()
+    # find times when each service starts and ends at each stop
+    services = stop_details.groupby(keys + ['service_id'])['stop_time'].agg(['min', 'max']).reset_index()
 
-    # initially there is no start time and no services are running.
-    start_time = 0
-    previously_inservice = 0
+    # start and end times adjusted to allow 10 minute buffers for buses arriving
+    # slightly earlier or later than scheduled.
+    services['start_time'] = services['min'] - pd.Timedelta(minutes=10)
+    services['end_time'] = services['max'] + pd.Timedelta(minutes=10)
+    services = services.sort_values(keys + ['start_time'], ignore_index=True)
 
-    # iterate through all service id's start and end times. 
-    for idx, row in service_ranges.iterrows():
+    # latest end time of all earlier services at the same stop and direction
+    previous_end = services.groupby(keys)['end_time'].cummax().groupby(
+        [services[k] for k in keys]).shift(1)
 
-        # prevously no service, service just started: add a start time
-        if (previously_inservice == 0) & (row['adjustment'] == 1):
-            start_time = row['time']
-            # reset previously_inservice variable for the next iteration
-            previously_inservice = row['services_running']
+    # number each continuous timeframe when one or more services are running
+    timeframe = (previous_end.isnull() | (services['start_time'] > previous_end)).cumsum()
 
-        # previously there was at least one service running, and the last service just ended:  
-        # Add an end time and add the start/end times to the dataframe of all 
-        # continuous active service times.
-        elif (previously_inservice > 0) & (row['services_running'] == 0):
-            end_time = row['time']
-            df_timerange = pd.DataFrame([[start_time, end_time],], columns=['start_time','end_time'])
-            active_service_times = pd.concat([active_service_times, df_timerange])
-            # reset previously_inservice variable to zero for the next iteration
-            previously_inservice = 0
+    active_service_times = services.groupby(timeframe).agg(
+        route_id=('route_id', 'first'),
+        stop_id=('stop_id', 'first'),
+        direction=('direction', 'first'),
+        start_time=('start_time', 'min'),
+        end_time=('end_time', 'max'),
+        )
 
-    return active_service_times
+    return active_service_times.reset_index(drop=True)
 
 
 # %%
 
 # Get scheduled headways
+@instrumented
 def get_scheduled_headways(stop_details:pd.DataFrame , stop_id:str, direction:str, active_service_times:pd.DataFrame):
 
     '''
@@ -245,29 +361,112 @@ def get_scheduled_headways(stop_details:pd.DataFrame , stop_id:str, direction:st
             stop_details['direction'] == direction]
 
     # sort by arrival time
-    df = df.sort_values('arrival_time')
+    df = df.sort_values('arrival_time', kind='mergesort')
+
+    # Calculate headways within each active service period.  The first bus in
+    # each period has no headway or previous stop time (no previous arrival time to compare with)
+    df = get_headways_in_active_service_times(df, 'stop_time', [], active_service_times, [])
+    df = df.drop(['service_start_time', 'service_end_time'], axis=1)
 
-    # add previous stop times to each row
-    df['previous_stop_time'] = np.roll(df['stop_time'], shift=1)
+    return df.rename(columns={'previous_time':'previous_stop_time'})
 
-    # Calculate headways
-    df['headway'] = df['stop_time'] - df['previous_stop_time']
 
-    # Remove the first headway and previous stop time for the first
-    # bus in each active service period (no previous arrival time to compare with)
-    active_service_starts = active_service_times['start_time'].tolist()
+# %%
+@instrumented
+def get_headways_in_active_service_times(
+    arrivals:pd.DataFrame, time_column:str, arrival_keys:list,
+    active_service_times:pd.DataFrame, service_keys:list) -> pd.DataFrame:
 
-    start_filter = df['stop_time'].isin(active_service_starts)
+    '''This is a helper function.\n
+    Parameters:\n
+    arrivals is a dataframe with one row per bus arriving at a stop.\n
+    time_column is the name of the arrival time column in arrivals.\n
+    arrival_keys is a list of the arrivals columns identifying a stop and direction
+    (for example ['route_id', 'stop_id', 'direction']), or [] for a single stop.\n
+    active_service_times is a dataframe of active service timeframes obtained using 
+    get_active_service_times_all_stops() or get_active_service_times().\n
+    service_keys is a list of the active_service_times columns matching arrival_keys, in the same order.\n
+    Data returned:\n
+    The arrivals that fall inside an active service timeframe, sorted by key and time,
+    with columns added for the timeframe (service_start_time, service_end_time),
+    the previous arrival in the same timeframe (previous_time) and the headway.  The
+    first bus in each timeframe has no previous_time or headway.'''
+
+    arrivals = arrivals.sort_values(time_column, kind='mergesort')
+    active_service_times = active_service_times[service_keys + ['start_time', 'end_time']].rename(
+        columns={'start_time':'service_start_time', 'end_time':'service_end_time'})
+    for column in ['service_start_time', 'service_end_time']:
+        active_service_times[column] = active_service_times[column].astype(arrivals[time_column].dtype)
+    active_service_times = active_service_times.sort_values('service_start_time')
+
+    # join keys need matching types (for example, categorical route ids in the vehicle data)
+    for arrival_key, service_key in zip(arrival_keys, service_keys):
+        if arrivals[arrival_key].dtype != active_service_times[service_key].dtype:
+            arrivals[arrival_key] = arrivals[arrival_key].astype(object)
+            active_service_times[service_key] = active_service_times[service_key].astype(object)
+
+    # number each stop and direction, with the same numbers on both sides.  merge_asof matches
+    # on one integer key much faster than on several object keys (many routes at once).
+    by = None
+    if len(arrival_keys) > 0:
+        key_values = pd.concat([
+            arrivals[arrival_keys],
+            active_service_times[service_keys].set_axis(arrival_keys, axis=1)], ignore_index=True)
+        key_codes = key_values.groupby(arrival_keys, sort=False, dropna=False).ngroup().to_numpy()
+        by = '_key'
+        arrivals[by] = key_codes[:len(arrivals)]
+        active_service_times = active_service_times.drop(service_keys, axis=1)
+        active_service_times[by] = key_codes[len(arrivals):]
+
+    # tag each arrival with the latest active service timeframe starting at or before it
+    index = arrivals.index
+    arrivals = pd.merge_asof(
+        arrivals.reset_index(drop=True), active_service_times,
+        left_on=time_column, right_on='service_start_time', by=by)
+    arrivals.index = index
+    if by is not None:
+        arrivals = arrivals.drop(by, axis=1)
+
+    # keep only arrivals before the end of that timeframe
+    arrivals = arrivals.loc[arrivals[time_column] <= arrivals['service_end_time']]
+
+    # Calculate headways from the previous bus in the same timeframe
+    timeframe_keys = arrival_keys + ['service_start_time']
+    arrivals = arrivals.sort_values(timeframe_keys + [time_column], kind='mergesort')
+    arrivals['previous_time'] = arrivals.groupby(timeframe_keys)[time_column].shift(1)
+    arrivals['headway'] = arrivals[time_column] - arrivals['previous_time']
+
+    return arrivals
+
+
+# %%
+@instrumented
+def get_scheduled_headways_all_stops(stop_details:pd.DataFrame, active_service_times:pd.DataFrame) -> pd.DataFrame:
+
+    '''
+    Parameters:\n
+
+    stop_details is a dataframe with information on bus stop times, generated by the
+    get_scheduled_stop_details function.\n
+
+    active_service_times is a dataframe obtained using get_active_service_times_all_stops().\n
+
+    Data returned:\n
+    Scheduled headways for every route, stop and direction in stop_details, in the same format as
+    get_scheduled_headways() plus the active service timeframe each bus falls in
+    (service_start_time, service_end_time).
+    '''
 
-    df.loc[start_filter, 'headway'] = None
-    df.loc[start_filter, 'previous_stop_time'] = None
+    keys = ['route_id', 'stop_id', 'direction']
 
-    return df
+    headways = get_headways_in_active_service_times(stop_details, 'stop_time', keys, active_service_times, keys)
 
+    return headways.rename(columns={'previous_time':'previous_stop_time'})
 
 
 # %%
 
+@instrumented
 def get_headway_stats(headways:pd.DataFrame, headway_column_name:str, output_column_prefix='') -> pd.DataFrame:
     '''Parameters:\n
 
@@ -319,6 +518,101 @@ def get_headway_stats(headways:pd.DataFrame, headway_column_name:str, output_col
     return output
 
 
+# %%
+def get_integer_stat_columns(stats:pd.DataFrame) -> list:
+    '''This is a helper function.\n
+    Data returned:\n
+    the headway stats columns of stats that hold whole numbers ('total buses' and the headway
+    minutes), like get_headway_stats() returns.'''
+    return [column for column in stats.columns if column.endswith(('total buses', 'headway (minutes)'))]
+
+
+@instrumented
+def get_headway_stats_all_stops(
+    scheduled_headways:pd.DataFrame, actual_headways:pd.DataFrame, by_route:bool=False) -> pd.DataFrame:
+    '''Parameters:\n
+
+    scheduled_headways is a dataframe obtained using get_scheduled_headways_all_stops().\n
+
+    actual_headways is a dataframe obtained using get_actual_headways_all_stops().\n
+
+    by_route adds route_id to the keys, to summarize several routes at once.\n
+
+    Data returned:\n
+    One row per stop and direction (stop_id, direction), with the same statistics as
+    get_headway_stats() for the 'Actual' and 'Scheduled' sources, plus the average wait time
+    (AWT) for each source.  Column names use the source as the output_column_prefix, for
+    example 'Actual median headway (minutes)'.\n
+
+    All stops, directions and sources are summarized with a single groupby aggregation.
+    AWT = SUM(D^2)/2T, where D is each headway and T is the observation window, in minutes, like
+    get_average_wait_time():  for actual headways, from the earliest start_time to the latest
+    end_time of the vehicle intervals the buses passed the stop in, and for scheduled headways,
+    from the earliest previous_stop_time to the latest stop_time.  The total buses and minute
+    columns are nullable integers (Int64), empty where a stop has no headways from a source.'''
+
+    keys = ['stop_id', 'direction']
+    if by_route:
+        keys = ['route_id'] + keys
+
+    # combine both sources into one long dataframe of headways in minutes
+    headways = pd.concat([
+        pd.DataFrame({
+            'route_id': actual_headways.get('rt'),
+            'stop_id': actual_headways.get('stpid'),
+            'direction': actual_headways.get('rtdir'),
+            'source': 'Actual',
+            'headway': actual_headways.get('est_headway'),
+            'window_start': actual_headways.get('start_time'),
+            'window_end': actual_headways.get('end_time'),
+            }),
+        pd.DataFrame({
+            'route_id': scheduled_headways.get('route_id'),
+            'stop_id': scheduled_headways.get('stop_id'),
+            'direction': scheduled_headways.get('direction'),
+            'source': 'Scheduled',
+            'headway': scheduled_headways.get('headway'),
+            'window_start': scheduled_headways.get('previous_stop_time'),
+            'window_end': scheduled_headways.get('stop_time'),
+            }),
+        ], ignore_index=True)
+
+    # filter to actual values, not null / nat, nan, etc.
+    headways = headways.loc[headways['headway'].notnull()]
+    headways['headway'] = pd.to_timedelta(headways['headway']).dt.total_seconds()/60
+    headways['headway_squared'] = headways['headway']**2
+
+    grouped = headways.groupby(keys + ['source'])
+    stats = grouped['headway'].agg(['count', 'mean', 'median', 'sum'])
+    quantiles = grouped['headway'].quantile([0.25, 0.75]).unstack()
+    # observation window in minutes (.seconds, like get_average_wait_time())
+    window_minutes = (grouped['window_end'].max() - grouped['window_start'].min()).dt.seconds/60.0
+
+    stats = pd.DataFrame({
+        'total buses': stats['count'],
+        'mean headway (minutes)': stats['mean'],
+        '25th percentile headway (minutes)': quantiles[0.25],
+        'median headway (minutes)': stats['median'],
+        '75th percentile headway (minutes)': quantiles[0.75],
+        'average wait time (minutes)': (grouped['headway_squared'].sum() / (2*window_minutes)).round(1),
+        })
+
+    # convert to actual minutes as an integer
+    minute_columns = [c for c in stats.columns if c.endswith('headway (minutes)')]
+    stats[minute_columns] = stats[minute_columns].round(0).astype(int)
+
+    # one column per source and statistic, named like get_headway_stats() output
+    stats = stats.unstack('source')
+    stats.columns = [f'{source} {stat}' for stat, source in stats.columns]
+    ordered_columns = [
+        f'{source} {stat}'
+        for source in ['Actual', 'Scheduled']
+        for stat in ['total buses'] + minute_columns + ['average wait time (minutes)']]
+    stats = stats.reindex(columns=ordered_columns)
+
+    return stats.reset_index().astype({column: 'Int64' for column in get_integer_stat_columns(stats)})
+
+
 # %%
 ###########
 ###########
@@ -329,11 +623,106 @@ def get_headway_stats(headways:pd.DataFrame, headway_column_name:str, output_col
 
 
 # %%
-def get_chn_vehicles(date_string:str) -> pd.DataFrame:
+# Column types in the chn full-day vehicle files.  This is a compact schema: repeated strings
+# are categoricals, and integers use the smallest type that fits.  tmstmp is parsed to
+# datetime64[ns, UTC], which is stored as int64 epoch nanoseconds.
+VEHICLE_DTYPES = {
+    'vid':'int32',
+    'tmstmp':'str',
+    'lat':'float',
+    'lon':'float',
+    'hdg':'int16',
+    'pid':'int32',
+    'rt':'category',
+    'pdist':'int32',
+    'des':'category',
+    'dly':'bool',
+    'tatripid':'str',
+    'origatripno':'int32',
+    'tablockid':'category',
+    'zone':'category',
+    'scrape_file':'category',
+    'data_hour':'int8',
+    'data_date':'category'
+    }
+
+# Columns the headway calculations use
+VEHICLE_PIPELINE_COLUMNS = ['vid', 'tmstmp', 'pid', 'rt', 'pdist']
+
+# Rows read at a time when filtering vehicle files while they are read
+VEHICLE_CSV_CHUNK_ROWS = 200000
+
+
+# %%
+@instrumented
+def apply_vehicle_schema(vehicles:pd.DataFrame) -> pd.DataFrame:
+    '''This is a helper function.\n
+    Parameters:\n
+    vehicles is a dataframe of chn vehicle data.\n
+    Data returned:\n
+    vehicles with every column in VEHICLE_DTYPES converted to its compact type (except string
+    and timestamp columns, which are left as they are).  Concatenating categoricals with
+    different categories gives plain object columns, so this is applied again after
+    combining chunks or days.'''
+    dtypes = {
+        column: dtype for column, dtype in VEHICLE_DTYPES.items()
+        if column in vehicles.columns and dtype != 'str'}
+    return vehicles.astype(dtypes)
+
+
+# %%
+def get_memory_report(frames:dict) -> pd.DataFrame:
+    '''Parameters:\n
+    frames is a dictionary of dataframes by name, for example
+    {'vehicles': vehicles, 'intervals': vehicle_intervals, 'stop times': actual_stoptimes}.\n
+    Data returned:\n
+    dataframe with the number of rows, total megabytes and bytes per row of each dataframe
+    (including the contents of string columns).'''
+    report = pd.DataFrame([
+        [name, len(df), df.memory_usage(deep=True).sum()] for name, df in frames.items()],
+        columns=['name', 'rows', 'bytes'])
+    report['megabytes'] = (report['bytes']/1e6).round(1)
+    report['bytes per row'] = (report['bytes']/report['rows'].clip(lower=1)).round(1)
+    return report.drop('bytes', axis=1)
+
+
+# %%
+def get_vehicle_memory_report(vehicles:pd.DataFrame) -> pd.DataFrame:
+    '''Parameters:\n
+    vehicles is a dataframe obtained using get_chn_vehicles().\n
+    Data returned:\n
+    get_memory_report() for the vehicle data and its intervals before and after the compact
+    VEHICLE_DTYPES schema:  'before' rows use python strings and int64 columns, as the vehicle
+    data was read previously.'''
+    previous_dtypes = {
+        column: ('object' if dtype in ['category', 'str'] else 'int64' if dtype.startswith('int') else dtype)
+        for column, dtype in VEHICLE_DTYPES.items()
+        if column in vehicles.columns and column != 'tmstmp'}
+
+    frames = {}
+    for label, df in [('before', vehicles.astype(previous_dtypes)), ('after', apply_vehicle_schema(vehicles))]:
+        frames[f'vehicles ({label})'] = df
+        frames[f'intervals ({label})'] = get_vehicle_intervals(df)
+    return get_memory_report(frames)
+
+
+# %%
+@instrumented
+def get_chn_vehicles(
+    date_string:str, routes=None, start_time:pd.Timestamp=None, end_time:pd.Timestamp=None,
+    columns:list=None) -> pd.DataFrame:
     """Parameters:\n
 
     date_string in 'YYYY-MM-DD'format\n
 
+    routes is an optional route id as a string, or a list/set of route ids, to keep.\n
+
+    start_time and end_time optionally limit the data to timestamps (tmstmp) in that range,
+    inclusive.  Like tmstmp, these are local CTA times labeled as UTC.\n
+
+    columns is an optional list of columns to keep.  When routes, start_time or end_time are
+    given, this defaults to VEHICLE_PIPELINE_COLUMNS (the columns the headway calculations use).\n
+
     Data returned:\n
 
     Vehicle data scraped by the chn ghost bus team for all CTA buses running on the specified
@@ -343,58 +732,235 @@ def get_chn_vehicles(date_string:str) -> pd.DataFrame:
     pattern id (pid), and distance along the pattern (pdist) for each vehicle at 5-minute intervals 
     throughout the requested time range on the requested calendar day and the following day.
     Two days are required becuase bus schedules run past midnight.
+
+    Each day is read from CHN_DATA_DIR instead of the S3 bucket if that is set.  If CHN_CACHE_DIR
+    is set, each day is saved there as parquet after it is first read, and later calls read the
+    parquet file instead (no download or csv parsing).\n
+
+    When filtering by route or time without a cache, each file is streamed and filtered
+    VEHICLE_CSV_CHUNK_ROWS rows at a time, so memory use depends on the rows kept rather than
+    on the whole network.
     """
 
     day1 = pd.to_datetime(date_string, infer_datetime_format=True)
     day2 = day1 + pd.Timedelta(days=1)
     day2_string = day2.strftime('%Y-%m-%d')
 
-    # start_timedelta_string_expanded = start_timedelta_string + ':00'
-    # end_timedelta_string_expanded = end_timedelta_string + ':00'
+    filtered = routes is not None or start_time is not None or end_time is not None
+    if isinstance(routes, str):
+        routes = [routes]
+    elif routes is not None:
+        routes = list(routes)
+    if filtered and columns is None:
+        columns = VEHICLE_PIPELINE_COLUMNS
+    if start_time is not None:
+        start_time = pd.Timestamp(start_time)
+        start_time = start_time.tz_localize('UTC') if start_time.tz is None else start_time
+    if end_time is not None:
+        end_time = pd.Timestamp(end_time)
+        end_time = end_time.tz_localize('UTC') if end_time.tz is None else end_time
+
+    cache = None
+    if CHN_CACHE_DIR:
+        cache = ParquetCache(CHN_CACHE_DIR, max_bytes=int(CHN_CACHE_MAX_GB * 1e9))
+
+    def filter_vehicles(vehicles):
+        if routes is not None:
+            vehicles = vehicles.loc[vehicles['rt'].isin(routes)]
+        if start_time is not None:
+            vehicles = vehicles.loc[vehicles['tmstmp'] >= start_time]
+        if end_time is not None:
+            vehicles = vehicles.loc[vehicles['tmstmp'] <= end_time]
+        return vehicles
+
+    def read_vehicles_single_day(single_day_datestring, stream):
+        if CHN_DATA_DIR:
+            chn_data_source_single_day = os.path.join(CHN_DATA_DIR, f'{single_day_datestring}.csv')
+        else:
+            # download with the shared connection pool (retries with backoff on failures)
+            chn_data_url = f'{CHN_DATA_URL}/{single_day_datestring}.csv'
+            if stream:
+                response = fetch.get(chn_data_url, stream=True)
+                response.raw.decode_content = True
+                chn_data_source_single_day = response.raw
+            else:
+                chn_data_source_single_day = BytesIO(fetch.get(chn_data_url).content)
+
+        def parse(vehicles):
+            # tmstmp is in the fixed CTA format "YYYYMMDD HH:MM"
+            vehicles['tmstmp'] = time_parsing.cta_timestamps_to_datetime(vehicles['tmstmp'])
+            return vehicles
+
+        if not stream:
+            return parse(pd.read_csv(chn_data_source_single_day, dtype=VEHICLE_DTYPES))
+
+        # read the file a chunk at a time, keeping only the rows and columns needed
+        chunks = pd.read_csv(
+            chn_data_source_single_day, dtype=VEHICLE_DTYPES, usecols=columns,
+            chunksize=VEHICLE_CSV_CHUNK_ROWS)
+        vehicles_single_day = pd.concat([filter_vehicles(parse(chunk)) for chunk in chunks], ignore_index=True)
+        return apply_vehicle_schema(vehicles_single_day)
 
     def get_vehicles_single_day(single_day_datestring):
-        chn_data_source_single_day = f'https://chn-ghost-buses-public.s3.us-east-2.amazonaws.com/bus_full_day_data_v2/{single_day_datestring}.csv'
-        vehicles_single_day = pd.read_csv(
-        chn_data_source_single_day, dtype={
-            'vid':'int',
-            'tmstmp':'str',
-            'lat':'float',
-            'lon':'float',
-            'hdg':'int',
-            'pid':'int',
-            'rt':'str',
-            'pdist':'int',
-            'des':'str',
-            'dly':'bool',
-            'tatripid':'str',
-            'origatripno':'int',
-            'tablockid':'str',
-            'zone':'str',
-            'scrape_file':'str',
-            'data_hour':'int',
-            'data_date':'str'
-            }
-        )
+        if cache is None:
+            return read_vehicles_single_day(single_day_datestring, stream=filtered)
 
-        vehicles_single_day['tmstmp'] = pd.to_datetime(vehicles_single_day['tmstmp'],infer_datetime_format=True,utc=True)
-    
-        return vehicles_single_day
+        # read the cached day, filtering routes as the parquet file is read
+        parquet_filters = [('rt', 'in', routes)] if routes is not None else None
+        vehicles_single_day = cache.get(single_day_datestring, columns=columns, filters=parquet_filters)
+
+        if vehicles_single_day is None:
+            # cache the full day, then keep what was asked for
+            vehicles_single_day = read_vehicles_single_day(single_day_datestring, stream=False)
+            cache.put(single_day_datestring, vehicles_single_day)
+            if columns is not None:
+                vehicles_single_day = vehicles_single_day[columns]
+
+        return filter_vehicles(vehicles_single_day)
 
-    df_day1_vehicles = get_vehicles_single_day(date_string)
-    df_day2_vehicles = get_vehicles_single_day(day2_string)
+    # get both days at the same time
+    df_day1_vehicles, df_day2_vehicles = fetch.map_concurrently(
+        get_vehicles_single_day, [date_string, day2_string])
     
     df_both_days_vehicles = pd.concat([df_day1_vehicles, df_day2_vehicles])
+
+    # keep the compact column types after combining the days
+    df_both_days_vehicles = apply_vehicle_schema(df_both_days_vehicles)
  
     return df_both_days_vehicles
 
 
+# %%
+@instrumented
+def archive_chn_vehicles(archive:VehicleArchive, start_date:str, end_date:str) -> list:
+    '''Parameters:\n
+    archive is a VehicleArchive.\n
+    start_date and end_date are the first and last dates to archive, in 'YYYY-MM-DD' format.\n
+    Data returned:\n
+    list of the dates added.  Each chn vehicle file from start_date to end_date that isn't in
+    the archive yet is read with get_chn_vehicles() and appended, so the archive can be
+    extended day by day.  Vehicle data for a service date needs that date and the following
+    date in the archive.'''
+    dates = [
+        date.strftime('%Y-%m-%d') for date in pd.date_range(start_date, end_date)
+        if date.strftime('%Y-%m-%d') not in archive.dates()]
+
+    added = []
+    for date_string in dates:
+        if date_string in added:
+            continue
+        # get_chn_vehicles() reads this date's file and the next one, so keep both if they're needed
+        vehicles = get_chn_vehicles(date_string, columns=VEHICLE_PIPELINE_COLUMNS + ['data_date'])
+        vehicles = vehicles.loc[vehicles['data_date'].astype(str).isin(dates)]
+        vehicles = vehicles.loc[~vehicles['data_date'].astype(str).isin(archive.dates())]
+        archive.append(vehicles)
+        added.extend(sorted(set(vehicles['data_date'].astype(str))))
+    return sorted(added)
+
 
 # %%
-def get_patterns(vehicles:pd.DataFrame, rt:str) -> pd.DataFrame:
+# sha256 of local vehicle files, by (path, size, modification time), so unchanged files are only read once
+_vehicle_file_checksums = {}
+
+
+@instrumented
+def get_chn_vehicle_file_fingerprint(single_day_datestring:str) -> str:
+    '''This is a helper function.\n
+    Returns a fingerprint of one day's chn vehicle file:  the sha256 of the file in CHN_DATA_DIR
+    if that is set, otherwise the file's ETag in the S3 bucket (from a HEAD request, without
+    downloading it).  Returns 'missing' if the file doesn't exist (yet).'''
+    if CHN_DATA_DIR:
+        path = os.path.join(CHN_DATA_DIR, f'{single_day_datestring}.csv')
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return 'missing'
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        if key not in _vehicle_file_checksums:
+            digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+            _vehicle_file_checksums[key] = f'sha256:{digest.hexdigest()}'
+        return _vehicle_file_checksums[key]
+
+    try:
+        response = fetch.head(f'{CHN_DATA_URL}/{single_day_datestring}.csv')
+    except requests.HTTPError as e:
+        if e.response is not None and e.response.status_code in [403, 404]:
+            return 'missing'
+        raise
+    etag = response.headers.get('ETag')
+    if etag:
+        return f'etag:{etag.strip(chr(34))}'
+    # servers without ETags (for example a local test server)
+    return f"http:{response.headers.get('Last-Modified')}/{response.headers.get('Content-Length')}"
+
+
+@instrumented
+def get_chn_vehicle_fingerprint(date_string:str) -> str:
+    '''Parameters:\n
+    date_string in 'YYYY-MM-DD' format\n
+    Data returned:\n
+    fingerprint of the vehicle data get_chn_vehicles() reads for this service date (the files
+    for the date and the following date), to tell whether results calculated from it are
+    out of date.  See get_chn_vehicle_file_fingerprint().'''
+    day1 = pd.to_datetime(date_string)
+    day2_string = (day1 + pd.Timedelta(days=1)).strftime('%Y-%m-%d')
+    return ','.join(fetch.map_concurrently(get_chn_vehicle_file_fingerprint, [day1.strftime('%Y-%m-%d'), day2_string]))
+
+
+@instrumented
+def get_pattern_fingerprint(pid_list:list) -> str:
+    '''Parameters:\n
+    pid_list is a list of pattern ids.\n
+    Data returned:\n
+    fingerprint of these patterns in the pattern store (see PatternStore.fingerprint()), or None
+    if PATTERN_STORE_DIR isn't set (patterns come straight from the CTA API and can't be checked).'''
+    if not PATTERN_STORE_DIR:
+        return None
+    return PatternStore(PATTERN_STORE_DIR, offline=PATTERNS_OFFLINE).fingerprint(pid_list)
+
+
+
+# %%
+@instrumented
+def fetch_patterns(pid_list:list) -> list:
     '''This is a helper function.\n
     Parameters:\n
-    vehicles is a dataframe obtained using get_chn_vehicles().\n
-    rt is a route id as a string (for example, '55' for the 55 Garfield bus)\n
+    pid_list is a list of pattern ids as strings.\n
+    Data returned:\n
+    list of patterns from the CTA's bus tracker getpatterns API, one dict per pattern.'''
+
+    api_urls = []
+
+    # split pid_list into chunks of 10 (limit of the API):
+    start = 0
+    end = len(pid_list)
+    step = 10
+    for i in range(start, end, step):
+        pid_list_chunk = pid_list[i:i+step]
+        pid_string = ','.join(pid_list_chunk)
+        api_urls.append(f'{CTA_API_URL}/getpatterns?key={API_KEY}&pid={pid_string}&format=json')
+
+    # get data from CTA's feed, all chunks at the same time (within the API key's rate limit)
+    responses = fetch.get_json_all(api_urls, rate_limiter=cta_rate_limiter)
+
+    patterns = []
+    for response in responses:
+        patterns.extend(response['bustime-response']['ptr'])
+
+    return patterns
+
+
+# %%
+@instrumented
+def get_patterns(vehicles:pd.DataFrame, rt:str=None) -> pd.DataFrame:
+    '''This is a helper function.\n
+    Parameters:\n
+    vehicles is a dataframe obtained using get_chn_vehicles(), or VehicleArrays from a VehicleArchive.\n
+    rt is a route id as a string (for example, '55' for the 55 Garfield bus).  If rt is None,
+    patterns are returned for every route in the vehicles data.\n
     Data returned:\n
     patterns data from the CTA's bus tracker API is returned in a dataframe. 
     It includes all pattern ids (pid) found in the in the vehicles data for the specified
@@ -402,39 +968,38 @@ def get_patterns(vehicles:pd.DataFrame, rt:str) -> pd.DataFrame:
     The pt data for each pattern is its own dataframe with information on every point
     along the pattern. It includes columns for sequence (seq), latitude (lat),
     longitude (lon), type of points (typ) where S indicates a bus stop,
-    stop ID (stpid) for stop points, and distance along the pattern (pdist).
+    stop ID (stpid) for stop points, and distance along the pattern (pdist).\n
+    Patterns are read from the pattern store in PATTERN_STORE_DIR when that is set, so only
+    pattern ids that haven't been seen before are requested from the API.
      '''
     
-    df_output = pd.DataFrame()
-
     # filter vehicles to the specified route
-    rt_vehicles = vehicles.loc[vehicles['rt'] == rt]
+    if rt is None:
+        rt_vehicles = vehicles
+    elif isinstance(vehicles, VehicleArrays):
+        rt_vehicles = vehicles.select_routes([rt])
+    else:
+        rt_vehicles = vehicles.loc[vehicles['rt'] == rt]
 
     # list pid values included in the route
-    pid_list = list(rt_vehicles['pid'].unique())
+    pid_list = list(pd.unique(rt_vehicles['pid']))
 
     # convert pids to strings
     pid_list = [str(i) for i in pid_list]
 
-    # split pid_list into chunks of 10 (limit of the API):
-    start = 0
-    end = len(pid_list)
-    step = 10
-    for i in range(start, end, step):
-        pid_list_chunk = pid_list[i:i+step]
-        pid_string = ','.join(pid_list_chunk)
-
-        # get data from CTA's feed
-        api_url = f'http://www.ctabustracker.com/bustime/api/v2/getpatterns?key={API_KEY}&pid={pid_string}&format=json'
-        response = requests.get(api_url)
-        patterns = response.json()
-
-        # convert json to dataframe
-        df_patterns = pd.DataFrame(patterns['bustime-response']['ptr'])
+    # no vehicle data for the route (for example, no service that day)
+    if len(pid_list) == 0:
+        return pd.DataFrame(columns=['pid', 'pt'])
 
-        # add to the output dataframe
-        df_output = pd.concat([df_output, df_patterns])
+    # get patterns from the pattern store if one is set up, otherwise from CTA's feed
+    if PATTERN_STORE_DIR:
+        pattern_store = PatternStore(PATTERN_STORE_DIR, offline=PATTERNS_OFFLINE)
+        patterns = pattern_store.get_patterns(pid_list, fetch_patterns)
+    else:
+        patterns = fetch_patterns(pid_list)
 
+    # convert json to dataframe
+    df_output = pd.DataFrame(patterns)
 
     # convert pt column values to dataframes for each pattern containing that pattern's points
     df_output['pt'] = df_output['pt'].apply(lambda x: pd.DataFrame(x))
@@ -444,6 +1009,7 @@ def get_patterns(vehicles:pd.DataFrame, rt:str) -> pd.DataFrame:
 
 
 # %%
+@instrumented
 def get_pattern_linestrings(patterns:pd.DataFrame) -> gpd.GeoDataFrame:
     '''This is for future use and visualization - not neccessary to generate
     headway information.\n
@@ -475,6 +1041,7 @@ def get_pattern_linestrings(patterns:pd.DataFrame) -> gpd.GeoDataFrame:
 
 
 # %%
+@instrumented
 def get_pattern_stops(patterns) -> gpd.GeoDataFrame:
         '''This is a helper function.\n
         Parameters:\n
@@ -490,32 +1057,35 @@ def get_pattern_stops(patterns) -> gpd.GeoDataFrame:
         # get patterns for the route
         df_patterns = patterns.copy()
 
-        # set up a geodataframe to contain stops
-        gdf_route_stops = gpd.GeoDataFrame()
-
-        # consider the pid column (pattern ID) and the pt column (dataframe contaning
-        # points along the pattern)
-        for pid, pt in zip(df_patterns['pid'],df_patterns['pt']):
-                # sort points sequentially
-                pt.sort_values('seq', inplace=True)
-                # add the pattern id to each point's data
-                pt['pid']=pid
-                # add the pattern direction to each point's data
-                rtdir = df_patterns['rtdir'].loc[df_patterns['pid'] == pid].tolist()[0]
-                pt['rtdir'] = rtdir
-                # filter to only show stop points
-                stops = pt[pt['typ']=='S']
-                # zip lat/lon data to get coordinate pairs
-                coords = list(zip(stops['lon'],stops['lat']))
-                # turn coordinates into point geometry
-                geometry = [Point(c) for c in coords]
-                # generate a geodataframe for the stops in this pattern
-                gdf_pattern_stops = gpd.GeoDataFrame(stops,geometry=geometry).set_crs(epsg=4326)
-                # add this pattern's stops to the dataframe containing all stops on the route
-                gdf_route_stops = pd.concat([gdf_route_stops, gdf_pattern_stops])
-                # # change stpid and rtrid columns to strings
-                # gdf_route_stops['stpid'] = gdf_route_stops['stpid'].astype('string')
-                # gdf_route_stops['rtdir'] = gdf_route_stops['rtdir'].astype('string')
+        if len(df_patterns) == 0:
+                return gpd.GeoDataFrame()
+
+        # direction of each pattern (the first row for each pid)
+        pattern_rtdirs = df_patterns.drop_duplicates('pid').set_index('pid')['rtdir']
+
+        # the pt column has a dataframe of points along each pattern.  Combine the points for
+        # every pattern at once, numbering the patterns so each point knows its pattern.
+        points = pd.concat(list(df_patterns['pt']))
+        pattern_numbers = np.repeat(np.arange(len(df_patterns)), [len(pt) for pt in df_patterns['pt']])
+
+        # sort points sequentially within each pattern
+        order = np.lexsort((points['seq'].to_numpy(), pattern_numbers))
+        points = points.iloc[order]
+        pids = df_patterns['pid'].to_numpy()[pattern_numbers[order]]
+
+        # add the pattern id and pattern direction to each point's data
+        points['pid'] = pids
+        points['rtdir'] = pattern_rtdirs.loc[pids].to_numpy()
+
+        # filter to only show stop points
+        stops = points[points['typ']=='S']
+
+        # turn lat/lon data into point geometry for every stop on the route
+        geometry = gpd.points_from_xy(stops['lon'], stops['lat'])
+        gdf_route_stops = gpd.GeoDataFrame(stops, geometry=geometry).set_crs(epsg=4326)
+        # # change stpid and rtrid columns to strings
+        # gdf_route_stops['stpid'] = gdf_route_stops['stpid'].astype('string')
+        # gdf_route_stops['rtdir'] = gdf_route_stops['rtdir'].astype('string')
 
         return gdf_route_stops
 
@@ -523,63 +1093,100 @@ def get_pattern_stops(patterns) -> gpd.GeoDataFrame:
 
 
 # %%
-def get_vehicle_intervals(vehicles:pd.DataFrame, rt:str) -> pd.DataFrame:
+@instrumented
+def get_vehicle_intervals(vehicles:pd.DataFrame, rt:str=None) -> pd.DataFrame:
 
     '''This is a helper function.\n
     Parameters:\n
-    vehicles is a dataframe obtained using get_chn_vehicles().\n
+    vehicles is a dataframe obtained using get_chn_vehicles(), or VehicleArrays from a VehicleArchive.\n
+    rt is a route id as a string (for example, '55' for the 55 Garfield bus).  If rt is None,
+    intervals are built for every route in the vehicles data in a single pass.\n
     Data returned:\n
     Intervals are returned as a dataframe, with each row representing
     an interval between two points in time and space for one vehicle. 
     Columns are added to the vehicles data for each interval's 
-    start time, end time, start pdist, and end pdist.'''
+    start time, end time, start pdist, and end pdist.\n
+    Rows are grouped by vehicle and then by pattern, in the order each first appears in
+    the vehicles data, and sorted by time within each vehicle/pattern.\n
+    If vehicles is VehicleArrays from a VehicleArchive, the intervals are returned as
+    VehicleArrays too (see get_vehicle_interval_arrays()).'''
 
-    df_vehicles = vehicles.copy()
+    if isinstance(vehicles, VehicleArrays):
+        return get_vehicle_interval_arrays(vehicles, rt)
 
     # filter to the specified route
-    df_vehicles = df_vehicles.loc[df_vehicles['rt'] == rt]
+    if rt is None:
+        df_vehicles = vehicles.copy()
+    else:
+        df_vehicles = vehicles.loc[vehicles['rt'] == rt].copy()
 
-    # Set up dataframe to contain final fomratted data
-    df_output = pd.DataFrame()
+    if len(df_vehicles) == 0:
+        return pd.DataFrame()
 
-    # End time for each interval as a timestamp
-    # df_vehicles['end_time'] = pd.to_datetime(df_vehicles['tmstmp'],infer_datetime_format=True)
+    # End time and location for each interval
     df_vehicles['end_time'] = df_vehicles['tmstmp']
-    vid_list = df_vehicles['vid'].unique().tolist()
-
-    # End location for each interval
     df_vehicles['end_pdist'] = df_vehicles['pdist']
 
-    for vid in vid_list:
+    # Number each vehicle, and each vehicle/pattern combination, in order of first appearance.
+    # Patterns belong to a single route, so these groups never span routes.
+    vid_codes = pd.factorize(df_vehicles['vid'])[0]
+    vehicle_pattern_codes = df_vehicles.groupby(['vid', 'pid'], sort=False).ngroup().to_numpy()
 
-        # pare data down to a single vehicle
-        df_vehicle = df_vehicles.loc[df_vehicles['vid'] == vid]
+    # sort once by vehicle, pattern and time
+    end_ns = df_vehicles['end_time'].to_numpy(dtype='datetime64[ns]').view('int64')
+    order = np.lexsort((end_ns, vehicle_pattern_codes, vid_codes))
+    df_vehicles = df_vehicles.iloc[order]
+    vehicle_pattern_codes = vehicle_pattern_codes[order]
 
-        # handle each pattern separately
-        pid_list = df_vehicle['pid'].unique().tolist()
-        for p in pid_list:
-            df_vehicle_pattern = df_vehicle.loc[df_vehicle['pid']==p].copy()
-            # sort by time (it should be sorted already, but just in case)
-            df_vehicle_pattern.sort_values(by=['end_time'], inplace=True)
+    # Create a start time and start pattern distance from the previous
+    # timestamp and pdist of the same vehicle on the same pattern
+    previous = df_vehicles[['end_time', 'end_pdist']].groupby(vehicle_pattern_codes).shift(1)
+    df_vehicles['start_time'] = previous['end_time']
+    df_vehicles['start_pdist'] = previous['end_pdist']
 
-            # Create a start time based on the previous timestamp
-            end_times = df_vehicle_pattern['end_time'].tolist()
-            start_times = np.roll(end_times,shift=1)
-            df_vehicle_pattern['start_time'] = start_times
+    # Remove the first interval for each vehicle and pattern since we don't have real start
+    # time or location data for it
+    df_vehicles = df_vehicles.loc[df_vehicles['start_time'].notnull()]
+    df_vehicles['start_pdist'] = df_vehicles['start_pdist'].astype(df_vehicles['end_pdist'].dtype)
 
-            # Create a start pattern distance based on the previous pdist
-            end_distances = df_vehicle_pattern['end_pdist'].tolist()
-            start_distances = np.roll(end_distances,shift=1)
-            df_vehicle_pattern['start_pdist'] = start_distances
+    return df_vehicles
 
-            # Remove the first interval since we don't have real start
-            # time or location data for it
-            df_vehicle_pattern = df_vehicle_pattern.iloc[1:]
 
-            # add data to the full output dataframe
-            df_output = pd.concat([df_output, df_vehicle_pattern])
 
-    return df_output
+# %%
+@instrumented
+def get_vehicle_interval_arrays(vehicles:VehicleArrays, rt:str=None) -> VehicleArrays:
+
+    '''This is a helper function.\n
+    Parameters:\n
+    vehicles is VehicleArrays from a VehicleArchive.\n
+    rt is an optional route id as a string.  If rt is None, intervals are built for every route.\n
+    Data returned:\n
+    VehicleArrays of intervals with the same columns as get_vehicle_intervals() (end_time,
+    end_pdist, start_time and start_pdist added to the vehicle columns, times in epoch
+    seconds), grouped by route, pattern and vehicle and sorted by time within each
+    vehicle/pattern.  Only the numpy columns are used, so no dataframe is built.'''
+
+    if rt is not None:
+        vehicles = vehicles.select_routes([rt])
+
+    # sort once by route, pattern, vehicle and time
+    order = np.lexsort((vehicles['tmstmp'], vehicles['vid'], vehicles['pid'], vehicles['rt']))
+
+    # each row after the first of a vehicle/pattern ends an interval started by the row before it
+    same_group = np.ones(max(len(order) - 1, 0), dtype=bool)
+    for column in ['rt', 'pid', 'vid']:
+        values = vehicles[column][order]
+        same_group &= values[1:] == values[:-1]
+    end_positions = order[1:][same_group]
+    start_positions = order[:-1][same_group]
+
+    intervals = vehicles.take(end_positions)
+    intervals.columns['end_time'] = intervals['tmstmp']
+    intervals.columns['end_pdist'] = intervals['pdist']
+    intervals.columns['start_time'] = vehicles['tmstmp'][start_positions]
+    intervals.columns['start_pdist'] = vehicles['pdist'][start_positions]
+    return intervals
 
 
 
@@ -618,11 +1225,156 @@ def interpolate_stop_time(
 
 
 # %%
+@instrumented
+def interpolate_stop_times(
+    stop_pdist:np.ndarray,
+    start_time:pd.Series,
+    end_time:pd.Series,
+    start_pdist:np.ndarray,
+    end_pdist:np.ndarray
+    ) -> pd.Series:
+
+    '''This is a helper function.\n
+    Array version of interpolate_stop_time(), used to estimate stop times for many
+    intervals at once.\n
+    Parameters:\n
+    stop_pdist, start_pdist and end_pdist are arrays of distances along a pattern
+    (one value per interval).\n
+    start_time and end_time are timestamp series for the beginning and end of each interval.\n
+    Data returned:\n
+    Series of estimated times each vehicle reached its stop, indexed like start_time.
+    Values match interpolate_stop_time() exactly:  the math is done on int64 nanoseconds,
+    truncating the interpolated offset the same way pd.Timedelta does before rounding
+    to the nearest second.
+    '''
+
+    start_ns = start_time.to_numpy(dtype='datetime64[ns]').view('int64')
+    end_ns = end_time.to_numpy(dtype='datetime64[ns]').view('int64')
+
+    # How far into the interval distance is the bus stop?
+    dist_ratio = (stop_pdist - start_pdist) / (end_pdist - start_pdist)
+
+    # estimated bus stop time, assuming it traveled at a steady
+    # speed throughout the interval
+    est_ns = start_ns + (dist_ratio * (end_ns - start_ns)).astype('int64')
+
+    est_stop_time = pd.Series(est_ns.view('datetime64[ns]'), index=start_time.index)
+    if getattr(start_time.dtype, 'tz', None) is not None:
+        est_stop_time = est_stop_time.dt.tz_localize('UTC').dt.tz_convert(start_time.dtype.tz)
+
+    # round estimated stop time to the nearest second
+    return est_stop_time.dt.round('1s')
+
+
+# %%
+@instrumented
+def get_stop_crossings(vehicle_intervals:pd.DataFrame, pattern_stops:pd.DataFrame) -> pd.DataFrame:
+
+    '''This is a helper function.\n
+    Parameters:\n
+    vehicle_intervals is a dataframe obtained using get_vehicle_intervals(), or VehicleArrays
+    of intervals from a VehicleArchive.\n
+    pattern_stops is a dataframe obtained using get_pattern_stops().\n
+    Data returned:\n
+    One row per interval where a bus passed a stop:  the interval's columns plus
+    stpid, stop_pdist, rtdir and est_stop_time, in the same format as get_actual_stoptimes().\n
+    Rows are ordered by stop (in pattern_stops order), then by interval.  Each pattern's
+    stop distances are sorted once and matched against every interval with a binary
+    search, so the cost does not grow with stops x intervals.'''
+
+    if len(vehicle_intervals) == 0 or len(pattern_stops) == 0:
+        return pd.DataFrame()
+
+    stops = pd.DataFrame({
+        'stpid': pattern_stops['stpid'].to_numpy(),
+        'pid': pattern_stops['pid'].to_numpy(),
+        'rtdir': pattern_stops['rtdir'].to_numpy(),
+        'pdist': pattern_stops['pdist'].to_numpy(),
+        })
+
+    # A stop listed more than once on a pattern is matched using its first pdist
+    stops['pdist'] = stops.groupby(['stpid', 'pid'], sort=False)['pdist'].transform('first')
+
+    # intervals grouped by pattern, so each pattern's intervals are found without scanning
+    # every interval (vehicle_intervals can cover the whole network)
+    interval_pid_index = KeyIndex(vehicle_intervals['pid'])
+    interval_start_pdist = np.asarray(vehicle_intervals['start_pdist'])
+    interval_end_pdist = np.asarray(vehicle_intervals['end_pdist'])
+
+    # (stop row, interval row) pairs for every bus passing a stop
+    stop_positions = []
+    interval_positions = []
+
+    for pid, pattern_stop_positions in stops.groupby('pid', sort=False).indices.items():
+
+        # find the intervals that are on this pattern
+        pattern_interval_positions = interval_pid_index.rows([pid])
+        if len(pattern_interval_positions) == 0:
+            continue
+
+        # sort the pattern's stops by distance along the pattern
+        pattern_stop_pdists = stops['pdist'].to_numpy()[pattern_stop_positions]
+        order = np.argsort(pattern_stop_pdists, kind='stable')
+        sorted_pdists = pattern_stop_pdists[order]
+
+        # Intervals start ahead of a stop and end at or beyond it:
+        # start_pdist < stop pdist <= end_pdist
+        first = np.searchsorted(sorted_pdists, interval_start_pdist[pattern_interval_positions], side='right')
+        last = np.searchsorted(sorted_pdists, interval_end_pdist[pattern_interval_positions], side='right')
+        counts = np.maximum(last - first, 0)
+        if counts.sum() == 0:
+            continue
+
+        # expand each interval into one row per stop it passed
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        sorted_positions = np.repeat(first, counts) + offsets
+
+        stop_positions.append(pattern_stop_positions[order[sorted_positions]])
+        interval_positions.append(np.repeat(pattern_interval_positions, counts))
+
+    if len(stop_positions) == 0:
+        return pd.DataFrame()
+
+    stop_positions = np.concatenate(stop_positions)
+    interval_positions = np.concatenate(interval_positions)
+
+    # order by stop, then by interval
+    order = np.lexsort((interval_positions, stop_positions))
+    stop_positions = stop_positions[order]
+    interval_positions = interval_positions[order]
+
+    if isinstance(vehicle_intervals, VehicleArrays):
+        # only the crossing intervals become a dataframe
+        df_output = vehicle_intervals.take(interval_positions).to_frame()
+    else:
+        df_output = vehicle_intervals.iloc[interval_positions].copy()
+
+    # Add stpid, pdist, and rtdir to the data
+    stop_pdist = stops['pdist'].to_numpy()[stop_positions]
+    df_output['stpid'] = stops['stpid'].to_numpy()[stop_positions]
+    df_output['stop_pdist'] = stop_pdist.astype('int64')
+    df_output['rtdir'] = stops['rtdir'].to_numpy()[stop_positions]
+
+    # Estimate time each bus passed the stop (interpolated based on data at start and
+    # end of the interval)
+    df_output['est_stop_time'] = interpolate_stop_times(
+        stop_pdist,
+        df_output['start_time'],
+        df_output['end_time'],
+        df_output['start_pdist'].to_numpy(),
+        df_output['end_pdist'].to_numpy()
+        )
+
+    return df_output
+
+
+# %%
+@instrumented
 def get_actual_stoptimes(rt:str, vehicles:pd.DataFrame) -> pd.DataFrame:
 
     '''This is a helper function.\n
     Parameters:\n
-    vehicles is a dataframe obtained using get_chn_vehicles().\n
+    vehicles is a dataframe obtained using get_chn_vehicles(), or VehicleArrays from a VehicleArchive.\n
     rt is a route id as a string (for example, '55' for the 55 Garfield bus)\n
     Data returned:\n
     Columns are added to the vehicles dataframe indicating the start and end time
@@ -631,9 +1383,6 @@ def get_actual_stoptimes(rt:str, vehicles:pd.DataFrame) -> pd.DataFrame:
     each bus actually arrived at the stop (est_stop_time) is also added.\n
     The dataframe returned covers all buses at all stops on the specified route'''
  
-    # set up a dataframe to contain the output data
-    df_output = pd.DataFrame()
-
     # turn vehicle data into intervals between vehicles
     vehicle_intervals = get_vehicle_intervals(vehicles, rt)
 
@@ -643,65 +1392,11 @@ def get_actual_stoptimes(rt:str, vehicles:pd.DataFrame) -> pd.DataFrame:
     # get all stops on this route, including all patterns
     gdf_stops = get_pattern_stops(df_patterns)
 
-    # Consider each combination of stop and pattern
-    for stpid, pid, rtdir in list(zip(gdf_stops['stpid'],gdf_stops['pid'], gdf_stops['rtdir'])):
-
-        # get a single stop on a single pattern
-        gdf_this_stop_pattern = gdf_stops.loc[(gdf_stops['stpid'] == stpid) & (gdf_stops['pid'] == pid)].copy()
-        if len(gdf_this_stop_pattern) == 0:
-            continue
-            
-        # Find the bus stop's distance along the pattern
-        pdist_this_stop = gdf_this_stop_pattern['pdist'].tolist()[0]
-
-        # find the intervals that are on this pattern
-        df_this_pattern_intervals = vehicle_intervals.loc[vehicle_intervals['pid'] == pid].copy()
-        if len(df_this_pattern_intervals) == 0:
-            continue
-
-        # Filter for intervals that start ahead of the stop location and end at or beyond the stop
-        def filter_intervals(stop_dist:int, start_pdist:int, end_pdist:int):
-            return (start_pdist < stop_dist) & (end_pdist >= stop_dist)
-    
-        # Create filter for the intervals we're working on
-        interval_filter = df_this_pattern_intervals.apply(
-            lambda x: filter_intervals(pdist_this_stop, x['start_pdist'], x['end_pdist']), axis=1
-            )
-        
-        # apply the filter
-        df_this_pattern_stop_intervals = df_this_pattern_intervals.loc[interval_filter].copy()
-        if len(df_this_pattern_stop_intervals) == 0:
-            continue
-
-        # Add stpid, pdist, and rtdir to the data
-        df_this_pattern_stop_intervals['stpid'] = stpid
-        df_this_pattern_stop_intervals['stop_pdist'] = int(pdist_this_stop)
-        df_this_pattern_stop_intervals['rtdir'] = rtdir
-
-
-        # Estimate time each bus passed the stop (interpolated based on data at start and
-        # end of the interval)
-        df_this_pattern_stop_intervals['est_stop_time'] = df_this_pattern_stop_intervals.apply(
-            lambda x: interpolate_stop_time(
-                pdist_this_stop, 
-                x['start_time'], 
-                x['end_time'], 
-                x['start_pdist'], 
-                x['end_pdist']), axis=1
-            )
-
-        # Add the intervals with stop times to the full output dataframe
-        df_output = pd.concat([df_output, df_this_pattern_stop_intervals])
-
-        # # change to strings - why to they keep popping up as objects
-        # # by the end of each function?
-        # df_output['rt'] = df_output['rt'].astype('string')
-        # df_output['stpid'] = df_output['stpid'].astype('string')
-        # df_output['rtdir'] = df_output['rtdir'].astype('string')
-
-    return df_output
+    # find every interval where a bus passed a stop, for all stops and patterns at once
+    return get_stop_crossings(vehicle_intervals, gdf_stops)
 
 # %%
+@instrumented
 def get_actual_stop_ids(actual_stoptimes):
     return set(actual_stoptimes['stpid'])
 
@@ -710,9 +1405,10 @@ def get_actual_stop_ids(actual_stoptimes):
 # %%
 # %%
 
+@instrumented
 def get_actual_headways(
     vehicles:pd.DataFrame, rt:str, stop_id:str, direction:str, 
-    active_service_times:list) -> pd.DataFrame:
+    active_service_times:list, actual_stoptimes:pd.DataFrame=None) -> pd.DataFrame:
 
         '''
         Parameters:\n
@@ -730,6 +1426,10 @@ def get_actual_headways(
         scheduled to be in service at a given stop. This list is generated
         by the get_active_service_times() function.\n
 
+        actual_stoptimes is an optional dataframe obtained using get_actual_stoptimes() for
+        this route and vehicle data.  Pass it in when calling this function for many stops
+        so the stop times are not recalculated for every stop.\n
+
         Data returned:\n
         Columns are added to the vehicles dataframe indicating :\n
         - the start and end time and the start and end distances along a pattern for each interval where a bus
@@ -744,7 +1444,9 @@ def get_actual_headways(
         df_output = pd.DataFrame()
 
         # Times buses stopped at each stop on the route
-        df_stoptimes = get_actual_stoptimes(rt, vehicles).copy()
+        if actual_stoptimes is None:
+            actual_stoptimes = get_actual_stoptimes(rt, vehicles)
+        df_stoptimes = actual_stoptimes.copy()
 
         # Filter to buses stopping at the specified stop in the specified direction
         df_stop_direction = df_stoptimes.loc[
@@ -805,6 +1507,37 @@ def get_actual_headways(
 
 
 # %%
+@instrumented
+def get_actual_headways_all_stops(actual_stoptimes:pd.DataFrame, active_service_times:pd.DataFrame) -> pd.DataFrame:
+
+    '''
+    Parameters:\n
+
+    actual_stoptimes is a dataframe obtained using get_actual_stoptimes() or get_stop_crossings().\n
+
+    active_service_times is a dataframe obtained using get_active_service_times_all_stops().\n
+
+    Data returned:\n
+    Actual headways for every route, stop and direction in actual_stoptimes, in the same
+    format as get_actual_headways() plus the active service timeframe each bus falls in
+    (service_start_time, service_end_time).  Buses arriving outside the active service
+    times for their stop are dropped, and the first bus in each timeframe has no headway.
+    '''
+
+    if len(actual_stoptimes) == 0:
+        return pd.DataFrame()
+
+    headways = get_headways_in_active_service_times(
+        actual_stoptimes, 'est_stop_time', ['rt', 'stpid', 'rtdir'],
+        active_service_times, ['route_id', 'stop_id', 'direction'])
+
+    headways = headways.drop('previous_time', axis=1)
+
+    return headways.rename(columns={'headway':'est_headway'})
+
+
+# %%
+@instrumented
 def get_average_wait_time(headways:pd.DataFrame) -> pd.DataFrame:
     '''Parameters:\n
     headways is a dataframe obtained using get_actual_headways().\n
@@ -813,125 +1546,452 @@ def get_average_wait_time(headways:pd.DataFrame) -> pd.DataFrame:
 
     # AWT = SUM(D^2)/2T, where D = the duration between arrivals and T = the timeframe duration.
     # When D=T, this simplifies to AWT = D/T
+    grouped = headways.groupby('stpid', sort=False)
+
+    timeframe_duration = (grouped['end_time'].max() - grouped['start_time'].min()).dt.seconds/60.0
+
+    headway_minutes = headways['est_headway'].dt.total_seconds()/60
+    headway_minutes_grouped = headway_minutes.groupby(headways['stpid'], sort=False)
+
     stops = pd.DataFrame()
     stops['stpid'] = headways['stpid'].unique()
-    
-    AWTs = []
-    mean = []
-    for stop in stops['stpid']:
-        stop_visits = headways[headways['stpid'] == stop]
-        
-        start = stop_visits['start_time'].min()
-        end = stop_visits['end_time'].max()
-        timeframe_duration = pd.Timedelta(end-start).seconds/60.0
+    stops['AWT'] = ((headway_minutes**2).groupby(headways['stpid'], sort=False).sum()
+        / (2*timeframe_duration)).to_numpy()
+    stops['mean_headway'] = headway_minutes_grouped.mean().to_numpy()
+    return stops
 
-        headway_minutes = stop_visits['est_headway'].dt.total_seconds()/60
-        AWT = ((headway_minutes)**2).sum()/(2*timeframe_duration)
-        AWTs.append(AWT)
+# %%
+@instrumented
+def get_scheduled_key(gtfs_feed:GTFSFeed, route_ids:list, service_date_string:str) -> tuple:
+    '''This is a helper function.\n
+    Data returned:\n
+    (feed version, tuple of route_ids, frozenset of the routes' service ids that run on the
+    service date).  The scheduled results for the routes only depend on this, not on the date itself.'''
+    service_date = string_to_datetime(service_date_string)
+    active_service_ids = ServiceCalendar.from_feed(gtfs_feed).active_service_ids(service_date)
+    route_service_ids = get_scheduled_feed_index(gtfs_feed).route_trips(route_ids)['service_id']
+    return (
+        getattr(gtfs_feed, 'version_id', None),
+        tuple(route_ids),
+        frozenset(route_service_ids[route_service_ids.isin(active_service_ids)]))
 
-        mean.append(headway_minutes.mean())
 
-    stops['AWT'] = AWTs
-    stops['mean_headway'] = mean
-    return stops
+@instrumented
+def get_scheduled_results(gtfs_feed:GTFSFeed, route_ids:list, service_date_string:str) -> dict:
+    '''This is a helper function.\n
+    Parameters:\n
+    gtfs_feed, route_ids and service_date_string are the same as get_scheduled_stop_details_routes().\n
+    Data returned:\n
+    dictionary with the scheduled stop details ('stop_details'), active service times
+    ('active_service_times') and scheduled headways ('scheduled_headways') for every stop on the
+    routes.  Results for another date with the same services are reused from the feed's
+    ScheduledCache, moved onto this date.'''
+    scheduled_cache = get_scheduled_cache(gtfs_feed)
+    scheduled_key = get_scheduled_key(gtfs_feed, route_ids, service_date_string)
+    raw_date = pd.Timestamp(service_date_string, tz='UTC')
+    results = scheduled_cache.get(scheduled_key, raw_date)
+    if results is None:
+        stop_details = get_scheduled_stop_details_routes(gtfs_feed, route_ids, service_date_string)
+        active_service_times = get_active_service_times_all_stops(stop_details)
+        results = {
+            'stop_details': stop_details,
+            'active_service_times': active_service_times,
+            'scheduled_headways': get_scheduled_headways_all_stops(stop_details, active_service_times)}
+        scheduled_cache.put(scheduled_key, raw_date, results)
+    return results
+
 
 # %%
+class RouteDay:
+    '''Shared data for a single route on a single service day.\n
 
-## Get summary headway stats for every stop on a single route for a single service day
+    Parameters:\n
+
+    gtfs_feed is obtained using get_gtfs_feed() or the download_extract_format() function from the ghost bus team.\n
+
+    route_id is a route id as a string (for example, '55' for the 55 Garfield bus)\n
 
-def get_stats_all_stops(gtfs_feed, route_id, service_date_string):
+    service_date_string is in the format "YYYY-MM-DD", indicating the service date to be analyzed.\n
+
+    vehicles is an optional dataframe obtained using get_chn_vehicles() for this service date.
+    Pass it in to reuse vehicle data already loaded for another route.  Otherwise only this
+    route's vehicle data is loaded.  VehicleArrays from VehicleArchive.get_vehicles() can be
+    passed instead, for example when working through many dates.\n
+
+    Each of the expensive inputs (vehicles, vehicle intervals, CTA patterns, pattern stops,
+    actual stop times and scheduled stop details) is calculated the first time it is used
+    and then kept, so per-stop calculations for every stop on the route share the same data
+    instead of rebuilding it and calling the CTA API again for each stop.  The scheduled
+    results (stop details, active service times and scheduled headways) are also shared
+    with other dates that have the same services on this route, through the feed's
+    ScheduledCache.
     '''
-    Returns a geodataframe of every bus stop on a specified route, with stats on 
-    actual and scheduled headways for a single service day.  This data is also exported as a
-    geojson.\n
+
+    def __init__(self, gtfs_feed:GTFSFeed, route_id:str, service_date_string:str, vehicles:pd.DataFrame=None):
+        self.gtfs_feed = gtfs_feed
+        self.route_id = route_id
+        self.service_date_string = service_date_string
+        if vehicles is not None:
+            # seed the cached property so vehicle data isn't downloaded again
+            self.__dict__['vehicles'] = vehicles
+
+    @cached_property
+    def _scheduled_results(self) -> dict:
+        return get_scheduled_results(self.gtfs_feed, [self.route_id], self.service_date_string)
+
+    @cached_property
+    def scheduled_stop_details(self) -> pd.DataFrame:
+        return self._scheduled_results['stop_details']
+
+    @cached_property
+    def vehicles(self) -> pd.DataFrame:
+        return get_chn_vehicles(self.service_date_string, routes=self.route_id)
+
+    @cached_property
+    def vehicle_intervals(self) -> pd.DataFrame:
+        return get_vehicle_intervals(self.vehicles, self.route_id)
+
+    @cached_property
+    def patterns(self) -> pd.DataFrame:
+        return get_patterns(self.vehicles, self.route_id)
+
+    @cached_property
+    def pattern_stops(self) -> gpd.GeoDataFrame:
+        return get_pattern_stops(self.patterns)
+
+    @cached_property
+    def actual_stoptimes(self) -> pd.DataFrame:
+        return get_stop_crossings(self.vehicle_intervals, self.pattern_stops)
+
+    @cached_property
+    def active_service_times_all_stops(self) -> pd.DataFrame:
+        return self._scheduled_results['active_service_times']
+
+    @cached_property
+    def _active_service_times_by_stop(self) -> dict:
+        return {
+            key: df[['start_time', 'end_time']].reset_index(drop=True)
+            for key, df in self.active_service_times_all_stops.groupby(['stop_id', 'direction'])}
+
+    @cached_property
+    def scheduled_headways_all_stops(self) -> pd.DataFrame:
+        return self._scheduled_results['scheduled_headways']
+
+    @cached_property
+    def actual_headways_all_stops(self) -> pd.DataFrame:
+        return get_actual_headways_all_stops(self.actual_stoptimes, self.active_service_times_all_stops)
+
+    def active_service_times(self, stop_id:str, direction:str) -> pd.DataFrame:
+        '''Same as get_active_service_times() for one stop and direction on this route-day.'''
+        return self._active_service_times_by_stop.get(
+            (stop_id, direction), pd.DataFrame(columns=['start_time', 'end_time']))
+
+    def scheduled_headways(self, stop_id:str, direction:str, active_service_times:pd.DataFrame=None) -> pd.DataFrame:
+        '''Same as get_scheduled_headways() for one stop and direction on this route-day.'''
+        if active_service_times is None:
+            active_service_times = self.active_service_times(stop_id, direction)
+        return get_scheduled_headways(self.scheduled_stop_details, stop_id, direction, active_service_times)
+
+    def actual_headways(self, stop_id:str, direction:str, active_service_times:pd.DataFrame=None) -> pd.DataFrame:
+        '''Same as get_actual_headways() for one stop and direction on this route-day.'''
+        if active_service_times is None:
+            active_service_times = self.active_service_times(stop_id, direction)
+        return get_actual_headways(
+            self.vehicles, self.route_id, stop_id, direction, active_service_times,
+            actual_stoptimes=self.actual_stoptimes)
+
+
+class NetworkDay:
+    '''Shared data for every route on a single service day, calculated in one pass over the
+    vehicle data instead of once per route.\n
 
     Parameters:\n
 
-    gtfs_feed is obtained using the download_extract_format() function from the ghost bus team.\n
+    gtfs_feed is obtained using get_gtfs_feed() or the download_extract_format() function from the ghost bus team.\n
 
-    route_id is a route id as a string (for example, '55' for the 55 Garfield bus)\n
+    service_date_string is in the format "YYYY-MM-DD", indicating the service date to be analyzed.\n
 
-    service_date_string is in the format "YYYY-MM-DD", indicating the service date to be analyzed.
-    Note that service dates can include spillover into the next calendar day, for bus routes that run
-    past midnight.\n
+    route_ids is an optional list of route ids as strings.  Defaults to every route in the vehicle data.\n
 
-    Data returned:\n
+    vehicles is an optional dataframe obtained using get_chn_vehicles() for this service date.
+    Otherwise the vehicle data for route_ids (or the whole network) is loaded.\n
 
-    Returns a geodataframe containing all stops with actual and scheduled headway statistics.\n
-    
-    Exports the headway summary data for each stop as a geojson to the headway_summaries directory.\n
-    Also exports a linestring for the selected route as a geojson.
+    Vehicle intervals, CTA patterns, pattern stops and actual stop times are built for all
+    routes at once, and the scheduled results for all routes come from one lookup in the
+    feed (see get_scheduled_results()).  Each table is then split by route once, and
+    route_summary() summarizes a route from its own rows, the same way get_stats_all_stops() does.
     '''
 
-    # dataframe to contain final summary data for each stop
-    stats_all_stops = gpd.GeoDataFrame()
+    def __init__(self, gtfs_feed:GTFSFeed, service_date_string:str, route_ids:list=None, vehicles:pd.DataFrame=None):
+        self.gtfs_feed = gtfs_feed
+        self.service_date_string = service_date_string
+        if route_ids is not None:
+            self.__dict__['route_ids'] = [str(route_id) for route_id in route_ids]
+        if vehicles is not None:
+            if route_ids is not None:
+                vehicles = vehicles.loc[vehicles['rt'].isin(self.route_ids)]
+            # seed the cached property so vehicle data isn't downloaded again
+            self.__dict__['vehicles'] = vehicles
+
+    @cached_property
+    def vehicles(self) -> pd.DataFrame:
+        if 'route_ids' in self.__dict__:
+            return get_chn_vehicles(self.service_date_string, routes=self.route_ids)
+        return get_chn_vehicles(self.service_date_string, columns=VEHICLE_PIPELINE_COLUMNS)
+
+    @cached_property
+    def route_ids(self) -> list:
+        return sorted(self.vehicles['rt'].dropna().astype(str).unique())
+
+    @cached_property
+    def vehicle_intervals(self) -> pd.DataFrame:
+        return get_vehicle_intervals(self.vehicles)
+
+    @cached_property
+    def patterns(self) -> pd.DataFrame:
+        return get_patterns(self.vehicles)
+
+    @cached_property
+    def pattern_stops(self) -> gpd.GeoDataFrame:
+        return get_pattern_stops(self.patterns)
+
+    @cached_property
+    def actual_stoptimes(self) -> pd.DataFrame:
+        return get_stop_crossings(self.vehicle_intervals, self.pattern_stops)
+
+    @cached_property
+    def _scheduled_results(self) -> dict:
+        return get_scheduled_results(self.gtfs_feed, self.route_ids, self.service_date_string)
+
+    @cached_property
+    def scheduled_stop_details(self) -> pd.DataFrame:
+        return self._scheduled_results['stop_details']
+
+    @cached_property
+    def active_service_times_all_stops(self) -> pd.DataFrame:
+        return self._scheduled_results['active_service_times']
+
+    @cached_property
+    def scheduled_headways_all_stops(self) -> pd.DataFrame:
+        return self._scheduled_results['scheduled_headways']
+
+    @cached_property
+    def actual_headways_all_stops(self) -> pd.DataFrame:
+        return get_actual_headways_all_stops(self.actual_stoptimes, self.active_service_times_all_stops)
+
+    @cached_property
+    def headway_stats(self) -> pd.DataFrame:
+        # stats for every route, stop and direction in one aggregation.  Rows without headways
+        # (first bus in each active service time) are not counted.
+        return get_headway_stats_all_stops(
+            self.scheduled_headways_all_stops, self.actual_headways_all_stops, by_route=True)
+
+    @cached_property
+    def _by_route(self) -> dict:
+        # every table split by route with a single groupby each
+        return {
+            'route_pids': {
+                route_id: set(df['pid'])
+                for route_id, df in split_by_route(self.vehicles[['rt', 'pid']].drop_duplicates(), 'rt').items()},
+            'stop_details': split_by_route(self.scheduled_stop_details, 'route_id'),
+            'actual_stoptimes': split_by_route(self.actual_stoptimes, 'rt'),
+            'headway_stats': split_by_route(self.headway_stats, 'route_id'),
+            }
 
-    # get scheduled stop details
-    scheduled_stop_details = get_scheduled_stop_details(gtfs_feed, route_id, service_date_string)
-    # get scheduled stop ids
-    scheduled_stop_ids = get_scheduled_stop_ids(scheduled_stop_details)
+    def route_summary(self, route_id:str) -> tuple:
+        '''Returns (stats_all_stops, route_linestring) for one route, the same as
+        get_stats_all_stops() calculates them, or None if the route has no scheduled stops
+        or no actual stop times on this day.'''
+        by_route = self._by_route
+        if route_id not in by_route['stop_details'] or route_id not in by_route['actual_stoptimes']:
+            return None
+
+        route_pids = by_route['route_pids'].get(route_id, set())
+        pattern_stops = self.pattern_stops.loc[self.pattern_stops['pid'].isin(route_pids)]
+        patterns = self.patterns.loc[self.patterns['pid'].isin(route_pids)]
+
+        stats_all_stops = get_route_summary(
+            route_id, self.service_date_string,
+            by_route['stop_details'][route_id],
+            by_route['actual_stoptimes'][route_id],
+            by_route['headway_stats'].get(route_id, self.headway_stats.iloc[:0]).drop('route_id', axis=1),
+            pattern_stops)
+        return stats_all_stops, get_pattern_linestrings(patterns)
+
+
+@instrumented
+def split_by_route(df:pd.DataFrame, route_column:str) -> dict:
+    '''This is a helper function.\n
+    Returns a dictionary of route id (as a string) -> the rows of df for that route, grouping df once.'''
+    if len(df) == 0:
+        return {}
+    groups = df.groupby(route_column, sort=False, observed=True).indices
+    return {str(route_id): df.take(positions) for route_id, positions in groups.items()}
 
 
-    # get vehicles
-    vehicles = get_chn_vehicles(service_date_string)
-    # get actual stop times
-    actual_stoptimes = get_actual_stoptimes(route_id, vehicles)
-    # get actual stop ids
-    actual_stop_ids = get_actual_stop_ids(actual_stoptimes)
-                                          
-    # get stops found in both the live data and the gtfs schedule data
-    common_stops = actual_stop_ids.intersection(scheduled_stop_ids)
+# %%
+
+## Get summary headway stats for every stop on every route for a single service day
+
+@instrumented
+def get_stats_network(
+    gtfs_feed, service_date_string, route_ids=None, vehicles=None, output_dir='headway_summaries',
+    output_format='geojson') -> gpd.GeoDataFrame:
+    '''
+    Network version of get_stats_all_stops():  summarizes every route for a single service day
+    from one pass over the vehicle data (see NetworkDay).\n
 
-    for stop_id in common_stops:
+    Parameters:\n
+
+    gtfs_feed is obtained using get_gtfs_feed() or the download_extract_format() function from the ghost bus team.\n
+
+    service_date_string is in the format "YYYY-MM-DD", indicating the service date to be analyzed.\n
+
+    route_ids is an optional list of route ids as strings.  Defaults to every route in the vehicle data.\n
+
+    vehicles is an optional dataframe obtained using get_chn_vehicles() for this service date.\n
+
+    output_dir is the directory to export the geojson files to.\n
 
-        # list directions found in the data for this stop
-        directions = actual_stoptimes.loc[actual_stoptimes['stpid'] == stop_id]['rtdir'].unique().tolist()
+    output_format is 'geojson' (the default) or 'geoparquet' to save to a SummaryStore in
+    output_dir instead (see export_route_summary()).\n
 
-        for direction in directions:
+    Data returned:\n
+
+    Returns a geodataframe containing all stops on every route with actual and scheduled headway
+    statistics (the get_stats_all_stops() rows for every route).  Routes without scheduled
+    stops or actual stop times that day are skipped.\n
+
+    Exports the same geojson files as get_stats_all_stops() for each route (and saves their actual
+    stop times if STOP_CROSSING_STORE_DIR is set).
+    '''
+
+    network_day = NetworkDay(gtfs_feed, service_date_string, route_ids=route_ids, vehicles=vehicles)
 
-            # get active service times
-            active_service_times = get_active_service_times(scheduled_stop_details,stop_id, direction)
+    route_summaries = []
+    for route_id in network_day.route_ids:
+        summary = network_day.route_summary(route_id)
+        if summary is None:
+            continue
+        stats_all_stops, route_linestring = summary
+        export_route_summary(
+            stats_all_stops, route_linestring, route_id, service_date_string, output_dir, output_format)
+        if STOP_CROSSING_STORE_DIR:
+            StopCrossingStore(STOP_CROSSING_STORE_DIR).put(
+                network_day._by_route['actual_stoptimes'][route_id], route_id, service_date_string)
+        route_summaries.append(stats_all_stops)
 
-            # get scheduled headway stats
-            scheduled_headways = get_scheduled_headways(scheduled_stop_details, stop_id, direction, active_service_times)
-            # Remove rows without headways (first bus in each active service time)
-            scheduled_headways = scheduled_headways[scheduled_headways['headway'].notnull()]
-            scheduled_headway_stats = get_headway_stats(scheduled_headways, 'headway', 'Scheduled')
+    if len(route_summaries) == 0:
+        return gpd.GeoDataFrame()
+    return gpd.GeoDataFrame(pd.concat(route_summaries, ignore_index=True))
 
 
-            # get actual headway stats within active service times
-            actual_headways = get_actual_headways(vehicles, route_id, stop_id, direction, active_service_times)
-            # Remove rows without headways (first bus in each active service time)
-            actual_headways = actual_headways[actual_headways['est_headway'].notnull()]
-            actual_headway_stats = get_headway_stats(actual_headways, 'est_headway', 'Actual')
+# %%
+@instrumented
+def write_geojson(gdf:gpd.GeoDataFrame, filepath:str):
+    '''Writes gdf to filepath as geojson.  The file is written in a temporary directory first and
+    then moved into place, so a file being written by another process (for example, the same
+    route linestring in a batch run) is never read half written.'''
+    # same file name in the temporary directory, since the geojson layer name comes from it
+    tmp_dir = os.path.join(os.path.dirname(filepath), f'.tmp{os.getpid()}')
+    os.makedirs(tmp_dir, exist_ok=True)
+    tmp_filepath = os.path.join(tmp_dir, os.path.basename(filepath))
+    gdf.to_file(tmp_filepath, driver='GeoJSON')
+    os.replace(tmp_filepath, filepath)
+    os.rmdir(tmp_dir)
+
+
+# Formats the headway summaries can be exported in:  geojson files (route{route_id}_{date}.json and
+# route{route_id}_linestring.json), or a GeoParquet SummaryStore (route={route_id}/date={date}) in
+# the output directory
+OUTPUT_FORMATS = ['geojson', 'geoparquet']
+
+
+@instrumented
+def get_route_summary_files(route_id:str, service_date_string:str, output_format:str='geojson') -> list:
+    '''Returns the files export_route_summary() writes for a route-date summary, relative to the
+    output directory (not including the route linestring).'''
+    if output_format == 'geoparquet':
+        return [SummaryStore.relative_path(route_id, service_date_string)]
+    return [f'route{route_id}_{service_date_string}.json']
+
+
+@instrumented
+def export_route_summary(
+    stats_all_stops:gpd.GeoDataFrame, route_linestring:gpd.GeoDataFrame, route_id:str,
+    service_date_string:str, output_dir:str='headway_summaries', output_format:str='geojson'):
+    '''Exports a route's headway summary (from get_route_summary()) and linestring to output_dir,
+    as geojson files or to a GeoParquet SummaryStore (output_format, one of OUTPUT_FORMATS).'''
+
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f'output_format must be one of {OUTPUT_FORMATS}, not {output_format!r}')
+
+    if output_format == 'geoparquet':
+        summary_store = SummaryStore(output_dir)
+        summary_store.put(stats_all_stops, route_id, service_date_string)
+        summary_store.put_linestring(route_linestring, route_id)
+        return
+
+    # Export stop data to geojson
+    json_filepath_stops = os.path.join(output_dir, f'route{route_id}_{service_date_string}.json')
+    write_geojson(stats_all_stops, json_filepath_stops)
+
+    # export route linestring data to geojson
+    json_filepath_linestring = os.path.join(output_dir, f'route{route_id}_linestring.json')
+    write_geojson(route_linestring, json_filepath_linestring)
+
+
+# %%
+@instrumented
+def get_route_summary(
+    route_id:str, service_date_string:str, scheduled_stop_details:pd.DataFrame, actual_stoptimes:pd.DataFrame,
+    headway_stats:pd.DataFrame, pattern_stops:gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    '''This is a helper function.\n
+    Parameters:\n
+    route_id and service_date_string are the route and service date being summarized.\n
+    scheduled_stop_details, actual_stoptimes and pattern_stops are this route's data for the
+    service date (see RouteDay or NetworkDay).\n
+    headway_stats is this route's headway stats from get_headway_stats_all_stops().\n
+    Data returned:\n
+    geodataframe of every stop on the route with actual and scheduled headway statistics, in the
+    format returned by get_stats_all_stops().'''
+
+    # dataframe to contain final summary data for each stop
+    stats_all_stops = pd.DataFrame()
 
-            # get basic stop info
-            stop_df = pd.DataFrame()
-            stop_df['stop_id'] = [stop_id]
-            stop_df['route_id'] = [route_id]
-            # date
-            stop_df['date'] = [service_date_string]
-            # day of week
-            stop_df['day'] = pd.to_datetime(stop_df['date'],infer_datetime_format=True).dt.day_name()
-            stop_df['direction'] = [direction]
+    # get scheduled stop ids
+    scheduled_stop_ids = get_scheduled_stop_ids(scheduled_stop_details)
 
-            # add headway data to stop info
-            stats_for_one_stop_df = pd.concat([stop_df, actual_headway_stats, scheduled_headway_stats], axis=1)
-            # stats_for_one_stop_df.reset_index(inplace=True, drop=True)
+    # get actual stop ids
+    actual_stop_ids = get_actual_stop_ids(actual_stoptimes)
+                                          
+    # get stops found in both the live data and the gtfs schedule data
+    common_stops = actual_stop_ids.intersection(scheduled_stop_ids)
 
-            # add stop info to the dataframe containing info on all stops
-            stats_all_stops = pd.concat([stats_all_stops, stats_for_one_stop_df], axis = 0)
-            # stats_all_stops.reset_index(inplace=True, drop=True)
-            # print(stats_all_stops.columns)
+    # stops and directions found in both the live data and the gtfs schedule data
+    stop_directions = actual_stoptimes[['stpid', 'rtdir']].drop_duplicates()
+    stop_directions = stop_directions.loc[stop_directions['stpid'].isin(common_stops)]
+
+    # get basic stop info
+    stats_all_stops['stop_id'] = stop_directions['stpid'].to_numpy()
+    stats_all_stops['route_id'] = route_id
+    # date
+    stats_all_stops['date'] = service_date_string
+    # day of week
+    stats_all_stops['day'] = pd.to_datetime(service_date_string).day_name()
+    stats_all_stops['direction'] = stop_directions['rtdir'].to_numpy()
+
+    # add headway data to stop info.  Stops without headways get empty values, so keep the
+    # counts and minutes as integers rather than letting the merge make them floats
+    stats_all_stops = stats_all_stops.merge(headway_stats, on=['stop_id', 'direction'], how='left')
+    stats_all_stops = stats_all_stops.astype(
+        {column: 'Int64' for column in get_integer_stat_columns(stats_all_stops)})
 
     # combine bus stop geospatial info with the stats dataframe
     # to generate a geojson with stats for every stop point
-    patterns = get_patterns(vehicles, route_id)
-    stops = get_pattern_stops(patterns)
-    route_linestring = get_pattern_linestrings(patterns)
 
     # merge stop geodataframe with headway stats
-    df_stops = gpd.GeoDataFrame(stops[['stpid', 'stpnm', 'geometry']])
+    df_stops = gpd.GeoDataFrame(pattern_stops[['stpid', 'stpnm', 'geometry']])
     stats_all_stops = stats_all_stops.merge(df_stops, left_on='stop_id', right_on='stpid')
 
     stats_all_stops = stats_all_stops.drop('stpid', axis=1)
@@ -939,13 +1999,71 @@ def get_stats_all_stops(gtfs_feed, route_id, service_date_string):
     stats_all_stops.reset_index(inplace = True, drop = True)
     stats_all_stops = gpd.GeoDataFrame(stats_all_stops)
 
-    # Export stop data to geojson
-    json_filepath_stops = f'headway_summaries/route{route_id}_{service_date_string}.json'
-    stats_all_stops.to_file(filename=json_filepath_stops, driver='GeoJSON')
+    return stats_all_stops
 
-    # export route linestring data to geojson
-    json_filepath_linestring = f'headway_summaries/route{route_id}_linestring.json'
-    route_linestring.to_file(json_filepath_linestring, driver='GeoJSON')
+
+# %%
+
+## Get summary headway stats for every stop on a single route for a single service day
+
+@instrumented
+def get_stats_all_stops(
+    gtfs_feed, route_id, service_date_string, vehicles=None, output_dir='headway_summaries', output_format='geojson'):
+    '''
+    Returns a geodataframe of every bus stop on a specified route, with stats on 
+    actual and scheduled headways for a single service day.  This data is also exported as a
+    geojson.\n
+
+    Parameters:\n
+
+    gtfs_feed is obtained using get_gtfs_feed() or the download_extract_format() function from the ghost bus team.\n
+
+    route_id is a route id as a string (for example, '55' for the 55 Garfield bus)\n
+
+    service_date_string is in the format "YYYY-MM-DD", indicating the service date to be analyzed.
+    Note that service dates can include spillover into the next calendar day, for bus routes that run
+    past midnight.\n
+
+    vehicles is an optional dataframe obtained using get_chn_vehicles() for this service date
+    (for example, shared by several routes).  Otherwise this route's vehicle data is loaded.\n
+
+    output_dir is the directory to export the geojson files to.\n
+
+    output_format is 'geojson' (the default) or 'geoparquet' to save to a SummaryStore in
+    output_dir instead (see export_route_summary()).\n
+
+    Data returned:\n
+
+    Returns a geodataframe containing all stops with actual and scheduled headway statistics.\n
+    
+    Exports the headway summary data for each stop as a geojson to the headway_summaries directory.\n
+    Also exports a linestring for the selected route as a geojson.  If STOP_CROSSING_STORE_DIR is
+    set, the route's actual stop times are saved there too.  If the route has no vehicle data for
+    the service date, an empty geodataframe is returned and nothing is exported.
+    '''
+
+    # vehicles, patterns and stop times are calculated once and shared by every stop
+    route_day = RouteDay(gtfs_feed, route_id, service_date_string, vehicles=vehicles)
+
+    # nothing to summarize without any buses on the route
+    if len(route_day.patterns) == 0:
+        return gpd.GeoDataFrame()
+
+    # actual and scheduled headway stats for every stop and direction.  Rows without 
+    # headways (first bus in each active service time) are not counted.
+    headway_stats = get_headway_stats_all_stops(
+        route_day.scheduled_headways_all_stops, route_day.actual_headways_all_stops)
+
+    stats_all_stops = get_route_summary(
+        route_id, service_date_string, route_day.scheduled_stop_details, route_day.actual_stoptimes,
+        headway_stats, route_day.pattern_stops)
+    route_linestring = get_pattern_linestrings(route_day.patterns)
+
+    export_route_summary(stats_all_stops, route_linestring, route_id, service_date_string, output_dir, output_format)
+
+    # keep the actual stop times so headways can be recalculated later without the vehicle data
+    if STOP_CROSSING_STORE_DIR:
+        StopCrossingStore(STOP_CROSSING_STORE_DIR).put(route_day.actual_stoptimes, route_id, service_date_string)
 
     return stats_all_stops
 
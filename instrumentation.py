@@ -0,0 +1,248 @@
+# %%
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+# %%
+# Sinks that receive a record for every timed stage.  Instrumentation is off while this is
+# empty, and instrumented functions then only check the list before calling through.
+_sinks = []
+
+# Running totals of the counters (HTTP requests, bytes downloaded, cache hits and misses),
+# shared by every thread so downloads in a thread pool count towards the stage that started them
+_counters = Counter()
+_counters_lock = threading.Lock()
+
+# Names of the stages running in each thread, for the parent and depth of nested stages
+_stages = threading.local()
+
+
+# %%
+def is_enabled() -> bool:
+    '''Returns True if any sink is added (stages are timed and counters are kept).'''
+    return len(_sinks) > 0
+
+
+def add_sink(sink):
+    '''Adds a sink (an object with a write(record) method, such as LoggingSink, JsonLinesSink or
+    MemorySink) and returns it.  Adding the first sink turns instrumentation on.'''
+    _sinks.append(sink)
+    return sink
+
+
+def remove_sink(sink):
+    '''Removes a sink added with add_sink().  Removing the last sink turns instrumentation off.'''
+    _sinks.remove(sink)
+
+
+def clear_sinks():
+    '''Removes every sink, turning instrumentation off.'''
+    _sinks.clear()
+
+
+def configure(log:bool=False, path:str=None):
+    '''Adds a LoggingSink if log is True and a JsonLinesSink if path is set (both from the .env
+    file in headways.py:  INSTRUMENTATION_LOG and INSTRUMENTATION_FILE).'''
+    if log:
+        add_sink(LoggingSink())
+    if path:
+        add_sink(JsonLinesSink(path))
+
+
+# %%
+def count(name:str, value:int=1):
+    '''Adds value to the counter name (for example 'http_requests').  Does nothing while
+    instrumentation is off.'''
+    if not _sinks:
+        return
+    with _counters_lock:
+        _counters[name] += value
+
+
+def get_counters() -> dict:
+    '''Returns the counter totals since the last reset_counters().'''
+    with _counters_lock:
+        return dict(_counters)
+
+
+def reset_counters():
+    with _counters_lock:
+        _counters.clear()
+
+
+def get_rows(value) -> int:
+    '''Returns the number of rows in a dataframe, series, numpy array or VehicleArrays, or None
+    for anything else.'''
+    shape = getattr(value, 'shape', None)
+    if shape is not None:
+        return shape[0] if len(shape) > 0 else None
+    if hasattr(value, 'columns') and hasattr(value, '__len__'):
+        # VehicleArrays
+        return len(value)
+    return None
+
+
+def _count_rows(values) -> int:
+    '''Returns the total rows of the values that have rows, or None if none of them do.'''
+    rows = [get_rows(value) for value in values]
+    rows = [n for n in rows if n is not None]
+    return sum(rows) if len(rows) > 0 else None
+
+
+# %%
+@contextmanager
+def stage(name:str, **fields):
+    '''Times the code in a with block as a stage of the pipeline and sends a record to every sink.\n
+    Parameters:\n
+    name is the stage name.\n
+    fields are added to the record (for example route_id).  The with statement returns the
+    dictionary of fields, so the block can add more (such as rows_out).\n
+    Each record has the stage name, its parent stage (the stage it ran inside of, in the same
+    thread), depth, start time (epoch seconds), wall time in seconds, process id, the fields,
+    the change in every counter while the stage ran, and the exception name if it failed.
+    While instrumentation is off the block just runs.'''
+    if not _sinks:
+        yield fields
+        return
+
+    running = getattr(_stages, 'names', None)
+    if running is None:
+        running = _stages.names = []
+    parent = running[-1] if running else None
+    running.append(name)
+    counters_start = get_counters()
+    start = time.time()
+    start_counter = time.perf_counter()
+    error = None
+    try:
+        yield fields
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        seconds = time.perf_counter() - start_counter
+        running.pop()
+        counters = {
+            counter: total - counters_start.get(counter, 0)
+            for counter, total in get_counters().items() if total != counters_start.get(counter, 0)}
+        record = {
+            'stage': name, 'parent': parent, 'depth': len(running), 'start': round(start, 6),
+            'seconds': round(seconds, 6), 'pid': os.getpid(), **fields, 'counters': counters}
+        if error is not None:
+            record['error'] = error
+        _emit(record)
+
+
+def instrumented(func=None, *, name:str=None):
+    '''Decorator timing every call of a function with stage().  The stage is named after the
+    function (or name), and the record has rows_in (the total rows of the dataframe and array
+    arguments) and rows_out (the rows returned), or None when they have no rows.  While
+    instrumentation is off, calls go straight to the function.'''
+    if func is None:
+        return functools.partial(instrumented, name=name)
+    stage_name = name or func.__qualname__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _sinks:
+            return func(*args, **kwargs)
+        with stage(stage_name, rows_in=_count_rows([*args, *kwargs.values()])) as fields:
+            result = func(*args, **kwargs)
+            fields['rows_out'] = get_rows(result)
+            return result
+    return wrapper
+
+
+def _emit(record:dict):
+    for sink in list(_sinks):
+        try:
+            sink.write(record)
+        except Exception:
+            # a failing sink shouldn't stop the calculations
+            logger.exception(f'Instrumentation sink {sink!r} failed')
+
+
+# %%
+class LoggingSink:
+    '''Logs one line per stage (indented by depth) with its time, rows and counters.\n
+
+    Parameters:\n
+
+    log is the logger to use (this module's logger by default).\n
+
+    level is the logging level of the messages.
+    '''
+
+    def __init__(self, log:logging.Logger=None, level:int=logging.INFO):
+        self.log = log or logger
+        self.level = level
+
+    def write(self, record:dict):
+        if not self.log.isEnabledFor(self.level):
+            return
+        details = [f"{record['seconds']:.3f}s"]
+        if record.get('rows_in') is not None or record.get('rows_out') is not None:
+            details.append(f"rows {record.get('rows_in')} -> {record.get('rows_out')}")
+        details += [f'{counter}={value}' for counter, value in record['counters'].items()]
+        if 'error' in record:
+            details.append(f"failed ({record['error']})")
+        self.log.log(self.level, f"{'  ' * record['depth']}{record['stage']}: {', '.join(details)}")
+
+
+class JsonLinesSink:
+    '''Appends one json record per line to a file, for example to keep timings from every
+    nightly batch run and load them with pd.read_json(path, lines=True).\n
+
+    Parameters:\n
+
+    path is the file to append to.  Its directory is created if it doesn't exist.
+    '''
+
+    def __init__(self, path:str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+
+    def write(self, record:dict):
+        line = json.dumps(record, default=str) + '\n'
+        # open for every record, so batch worker processes each get their own file handle and
+        # every line is appended whole
+        with self._lock, open(self.path, 'a') as f:
+            f.write(line)
+
+
+class MemorySink:
+    '''Keeps the records in a list (records), for checking them in a notebook or test.'''
+
+    def __init__(self):
+        self.records = []
+
+    def write(self, record:dict):
+        self.records.append(record)
+
+    def clear(self):
+        self.records.clear()
+
+    def get_summary(self) -> pd.DataFrame:
+        '''Returns a dataframe with one row per stage name:  the number of calls, total and
+        mean seconds, total rows in and out and the total of each counter, slowest first.'''
+        records = pd.DataFrame(
+            [{**{key: value for key, value in record.items() if key != 'counters'}, **record['counters']}
+             for record in self.records])
+        if len(records) == 0:
+            return pd.DataFrame()
+        counter_columns = sorted({counter for record in self.records for counter in record['counters']})
+        summary = records.groupby('stage').agg(
+            calls=('seconds', 'size'), seconds=('seconds', 'sum'), mean_seconds=('seconds', 'mean'),
+            **{column: (column, 'sum') for column in ['rows_in', 'rows_out'] + counter_columns if column in records})
+        return summary.sort_values('seconds', ascending=False)
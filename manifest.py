@@ -0,0 +1,68 @@
+# %%
+import datetime as dt
+import json
+import os
+from pathlib import Path
+
+
+# %%
+# Name of the manifest file kept next to the headway summary files
+MANIFEST_FILENAME = 'manifest.json'
+
+
+class Manifest:
+    '''Record of the route-dates calculated into an output directory, and the inputs each one
+    was calculated from, saved as a json file.\n
+
+    Parameters:\n
+
+    path is the manifest file.  It is read if it exists.\n
+
+    Each entry is keyed by route id and date, and holds the status ('ok', or 'skipped' for a
+    route with nothing to summarize that day), the input fingerprints (for example the GTFS
+    version, a checksum of the vehicle files and a fingerprint of the patterns used), the
+    pattern ids used and the output files written.  A route-date is current if it has an
+    entry with the same fingerprints and its output files still exist, so a daily run only
+    needs to calculate new or changed route-dates.  Call save() to write changes.
+    '''
+
+    def __init__(self, path:str):
+        self.path = Path(path)
+        self.entries = {}
+        if self.path.exists():
+            with open(self.path) as f:
+                self.entries = json.load(f)
+
+    @staticmethod
+    def key(route_id:str, date:str) -> str:
+        return f'{route_id}/{date}'
+
+    def get(self, route_id:str, date:str) -> dict:
+        '''Returns the entry for a route-date, or None if it has never been recorded.'''
+        return self.entries.get(self.key(route_id, date))
+
+    def put(self, route_id:str, date:str, status:str, fingerprints:dict, pids:list=None, outputs:list=None):
+        '''Records a completed route-date.  outputs are file names relative to the manifest's directory.'''
+        self.entries[self.key(route_id, date)] = {
+            'route_id': route_id,
+            'date': date,
+            'status': status,
+            'fingerprints': fingerprints,
+            'pids': sorted(str(pid) for pid in (pids or [])),
+            'outputs': outputs or [],
+            'completed': dt.datetime.now().isoformat(timespec='seconds'),
+            }
+
+    def is_current(self, route_id:str, date:str, fingerprints:dict) -> bool:
+        '''True if the route-date was recorded with these fingerprints and its outputs still exist.'''
+        entry = self.get(route_id, date)
+        if entry is None or entry['fingerprints'] != fingerprints:
+            return False
+        return all((self.path.parent / output).exists() for output in entry['outputs'])
+
+    def save(self):
+        # write to a temporary file first so a partly written manifest is never read
+        tmp_path = self.path.with_suffix('.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,84 @@
+# %%
+import os
+import tempfile
+from pathlib import Path
+
+import pandas as pd
+
+import instrumentation
+
+
+# %%
+class ParquetCache:
+    '''A directory of DataFrames saved as compressed Parquet files, one file per key.\n
+
+    Parameters:\n
+
+    cache_dir is the directory to keep the files in.  It is created if it doesn't exist.\n
+
+    max_bytes is the total size the cache is allowed to grow to.  When a new file pushes
+    the cache over this size, the least recently used files are deleted.  None means no limit.\n
+
+    Reading a file marks it as recently used (by updating its modification time), so
+    files that are read often stay in the cache.
+    '''
+
+    def __init__(self, cache_dir:str, max_bytes:int=None):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def path(self, key:str) -> Path:
+        return self.cache_dir / f'{key}.parquet'
+
+    def get(self, key:str, columns:list=None, filters:list=None) -> pd.DataFrame:
+        '''Returns the cached DataFrame for key, or None if it isn't cached.  columns and
+        filters (in pyarrow's format, e.g. [('rt', 'in', ['55'])]) limit the data read.'''
+        path = self.path(key)
+        try:
+            df = pd.read_parquet(path, columns=columns, filters=filters)
+            # mark as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            instrumentation.count('parquet_cache_misses')
+            return None
+        instrumentation.count('parquet_cache_hits')
+        return df
+
+    def put(self, key:str, df:pd.DataFrame):
+        '''Saves df under key, then evicts least recently used files if the cache is too big.'''
+        path = self.path(key)
+        # write to a temporary file first so a partly written file is never read.  The name is
+        # unique to this writer, since batch workers (or download threads) can cache the same key
+        # at the same time
+        fd, tmp_path = tempfile.mkstemp(prefix=f'{path.name}.', suffix='.tmp', dir=self.cache_dir)
+        os.close(fd)
+        try:
+            df.to_parquet(tmp_path, compression='zstd', index=False)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self.evict(keep=path)
+
+    def evict(self, keep:Path=None):
+        '''Deletes least recently used files until the cache fits in max_bytes.  The file
+        at keep (usually the one just written) is never deleted.'''
+        if self.max_bytes is None:
+            return
+        files = []
+        for p in self.cache_dir.glob('*.parquet'):
+            try:
+                stat = p.stat()
+            except FileNotFoundError:
+                # deleted by another reader/writer in the meantime
+                continue
+            files.append((stat.st_mtime, stat.st_size, p))
+        total_bytes = sum(size for _, size, _ in files)
+        for _, size, p in sorted(files, key=lambda f: f[0]):
+            if total_bytes <= self.max_bytes:
+                break
+            if p == keep:
+                continue
+            p.unlink(missing_ok=True)
+            total_bytes -= size
@@ -0,0 +1,109 @@
+# %%
+import hashlib
+import json
+import os
+import tempfile
+import warnings
+from pathlib import Path
+
+import instrumentation
+
+
+# %%
+class PatternStore:
+    '''On-disk store of CTA bus patterns from the getpatterns API, one json file per pattern id.\n
+
+    Parameters:\n
+
+    store_dir is the directory to keep the pattern files in.  It is created if it doesn't exist.\n
+
+    offline is True to never call the CTA API.  Pattern ids that aren't in the store are
+    skipped with a warning.\n
+
+    Each file holds the pattern exactly as the API returns it (pid, ln, rtdir and the pt list of
+    points), so CTA pattern ids only need to be downloaded once.  The whole store can be
+    copied to a single json snapshot file with export_snapshot() and loaded into another
+    store with import_snapshot(), for example to run offline on another machine.
+    '''
+
+    def __init__(self, store_dir:str, offline:bool=False):
+        self.store_dir = Path(store_dir)
+        self.offline = offline
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+
+    def path(self, pid:str) -> Path:
+        return self.store_dir / f'{pid}.json'
+
+    def pids(self) -> list:
+        '''Lists the pattern ids in the store.'''
+        return sorted(p.stem for p in self.store_dir.glob('*.json'))
+
+    def get(self, pid:str) -> dict:
+        '''Returns the stored pattern for pid, or None if it isn't stored.'''
+        path = self.path(pid)
+        if not path.exists():
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def put(self, pattern:dict):
+        '''Saves a pattern from the getpatterns API, keyed by its pid.'''
+        path = self.path(pattern['pid'])
+        # write to a temporary file first so a partly written file is never read.  The name is
+        # unique to this writer, since batch workers can fetch the same missing pattern at once
+        fd, tmp_path = tempfile.mkstemp(prefix=f'{path.name}.', suffix='.tmp', dir=self.store_dir)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(pattern, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def get_patterns(self, pid_list:list, fetch_patterns) -> list:
+        '''Parameters:\n
+        pid_list is a list of pattern ids as strings.\n
+        fetch_patterns is a function taking a list of pattern ids and returning a list of
+        patterns from the getpatterns API.  It is only called for pattern ids that aren't
+        already stored, and never in offline mode.\n
+        Data returned:\n
+        list of patterns (dicts in the getpatterns API format), in pid_list order.'''
+
+        patterns = {pid: self.get(pid) for pid in pid_list}
+        missing_pids = [pid for pid, pattern in patterns.items() if pattern is None]
+        instrumentation.count('pattern_store_hits', len(patterns) - len(missing_pids))
+        instrumentation.count('pattern_store_misses', len(missing_pids))
+
+        if len(missing_pids) > 0:
+            if self.offline:
+                warnings.warn(f'Patterns not in the pattern store (offline): {missing_pids}')
+            else:
+                for pattern in fetch_patterns(missing_pids):
+                    self.put(pattern)
+                    patterns[str(pattern['pid'])] = pattern
+
+        return [pattern for pattern in patterns.values() if pattern is not None]
+
+    def fingerprint(self, pid_list:list) -> str:
+        '''Returns a short hash of the stored patterns for pid_list (including which of them are
+        missing).  It only changes if one of those patterns is added or changed, so results
+        calculated from these patterns can be checked against it later.'''
+        digest = hashlib.sha256()
+        for pid in sorted(str(pid) for pid in pid_list):
+            path = self.path(pid)
+            pattern_digest = hashlib.sha256(path.read_bytes()).hexdigest() if path.exists() else 'missing'
+            digest.update(f'{pid}:{pattern_digest}\n'.encode())
+        return digest.hexdigest()[:16]
+
+    def export_snapshot(self, snapshot_path:str):
+        '''Writes every stored pattern to a single json file, keyed by pid.'''
+        snapshot = {pid: self.get(pid) for pid in self.pids()}
+        with open(snapshot_path, 'w') as f:
+            json.dump(snapshot, f)
+
+    def import_snapshot(self, snapshot_path:str):
+        '''Adds every pattern in a json snapshot file (from export_snapshot()) to the store.'''
+        with open(snapshot_path) as f:
+            snapshot = json.load(f)
+        for pattern in snapshot.values():
+            self.put(pattern)
@@ -0,0 +1,71 @@
+# %%
+from collections import OrderedDict
+
+import pandas as pd
+
+import instrumentation
+
+
+# %%
+class ScheduledCache:
+    '''In-memory cache of scheduled results for a route (stop times, active service times,
+    headways) that only depend on which services run, not on the date.\n
+
+    Parameters:\n
+
+    max_entries is the most results to keep.  The least recently used are dropped first.\n
+
+    Results are keyed by (feed version, route id, frozenset of active service ids), so for
+    example every weekday with the same services shares one entry.  Timestamps are stored as
+    offsets from the service date (raw_date) and re-stamped onto the requested date by get().
+    '''
+
+    def __init__(self, max_entries:int=64):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, key:tuple, raw_date:pd.Timestamp) -> dict:
+        '''Returns the cached dictionary of DataFrames for key with timestamps on raw_date, or None
+        if key isn't cached.'''
+        entry = self.entries.get(key)
+        if entry is None:
+            instrumentation.count('scheduled_cache_misses')
+            return None
+        instrumentation.count('scheduled_cache_hits')
+        self.entries.move_to_end(key)
+        return {name: restamp(df, datetime_columns, raw_date) for name, (df, datetime_columns) in entry.items()}
+
+    def put(self, key:tuple, raw_date:pd.Timestamp, results:dict):
+        '''Saves a dictionary of DataFrames with timestamps on raw_date under key.'''
+        self.entries[key] = {name: to_offsets(df, raw_date) for name, df in results.items()}
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+def to_offsets(df:pd.DataFrame, raw_date:pd.Timestamp) -> tuple:
+    '''Returns a copy of df with every datetime column changed to a timedelta from raw_date, and
+    the list of those columns.'''
+    df = df.copy()
+    datetime_columns = [column for column in df.columns if pd.api.types.is_datetime64_any_dtype(df[column])]
+    for column in datetime_columns:
+        df[column] = df[column] - raw_date
+    return df, datetime_columns
+
+
+def restamp(df:pd.DataFrame, datetime_columns:list, raw_date:pd.Timestamp) -> pd.DataFrame:
+    '''Reverses to_offsets() for a (possibly different) raw_date.'''
+    df = df.copy()
+    for column in datetime_columns:
+        df[column] = raw_date + df[column]
+    return df
+
+
+def get_scheduled_cache(gtfs_feed) -> ScheduledCache:
+    '''Returns the ScheduledCache for a feed (GTFSFeed or CachedGTFSFeed).  It is created the first
+    time and saved on the feed object, so cached results never outlive the feed they came from.'''
+    scheduled_cache = getattr(gtfs_feed, 'scheduled_cache', None)
+    if scheduled_cache is None:
+        scheduled_cache = ScheduledCache()
+        gtfs_feed.scheduled_cache = scheduled_cache
+    return scheduled_cache
@@ -0,0 +1,79 @@
+# %%
+import calendar
+
+import numpy as np
+import pandas as pd
+
+
+# %%
+class ServiceCalendar:
+    '''Index of the GTFS services that run on each date, built from the calendar and
+    calendar_dates tables of a feed.  Looking up a date only checks the calendar rows and the
+    exceptions for that date, instead of cross joining every calendar row with every date the
+    calendar covers.\n
+
+    Parameters:\n
+
+    calendar is the feed's calendar table (service_id, start_date and end_date as "YYYYMMDD",
+    and one column per day of the week holding "1" when the service runs that day).\n
+
+    calendar_dates is the feed's calendar_dates table (service_id, date as "YYYYMMDD" and
+    exception_type "1" for added service or "2" for removed service), or None.\n
+
+    Use ServiceCalendar.from_feed() to build one for a GTFSFeed or CachedGTFSFeed.
+    '''
+
+    def __init__(self, calendar_table:pd.DataFrame, calendar_dates:pd.DataFrame=None):
+        self.service_ids = calendar_table['service_id'].to_numpy()
+        # dates as integers in the form YYYYMMDD
+        self.start_dates = calendar_table['start_date'].astype(int).to_numpy()
+        self.end_dates = calendar_table['end_date'].astype(int).to_numpy()
+        # one row per service, one column per day of the week (Monday first)
+        self.weekdays = np.column_stack([
+            calendar_table[day.lower()].astype(str).to_numpy() == '1' for day in calendar.day_name])
+
+        # calendar_dates exceptions:  {YYYYMMDD: set of service ids}
+        self.added = {}
+        self.removed = {}
+        if calendar_dates is not None:
+            for date, service_id, exception_type in zip(
+                    calendar_dates['date'].astype(int), calendar_dates['service_id'],
+                    calendar_dates['exception_type'].astype(str)):
+                exceptions = self.added if exception_type == '1' else self.removed
+                exceptions.setdefault(date, set()).add(service_id)
+
+    @classmethod
+    def from_feed(cls, gtfs_feed) -> 'ServiceCalendar':
+        '''Returns the ServiceCalendar for a GTFSFeed or CachedGTFSFeed.'''
+        return cls(gtfs_feed.calendar, gtfs_feed.calendar_dates)
+
+    def active_service_ids(self, date) -> list:
+        '''Parameters:\n
+        date is the service date (a datetime, pendulum datetime or timestamp).\n
+        Data returned:\n
+        sorted list of the service ids that run on the date.  A service runs if the calendar has
+        it on this day of the week between its start and end dates and calendar_dates doesn't
+        remove it for the date, or if calendar_dates adds it for the date.'''
+        date_int = date.year*10000 + date.month*100 + date.day
+        runs = (self.start_dates <= date_int) & (self.end_dates >= date_int) & self.weekdays[:, date.weekday()]
+        service_ids = set(self.service_ids[runs])
+        service_ids -= self.removed.get(date_int, set())
+        service_ids |= self.added.get(date_int, set())
+        return sorted(service_ids)
+
+    def service_dates(self, start_date, end_date) -> pd.DataFrame:
+        '''Parameters:\n
+        start_date and end_date are the first and last dates to look up (inclusive).\n
+        Data returned:\n
+        dataframe with one row per date and service that runs on that date, with columns
+        raw_date (midnight UTC) and service_id.'''
+        start = pd.Timestamp(start_date)
+        end = pd.Timestamp(end_date)
+        if start.tzinfo is not None:
+            start, end = start.tz_convert('UTC'), end.tz_convert('UTC')
+        # only whole dates between the start and end are included
+        dates = pd.date_range(start.tz_localize(None).ceil('D'), end.tz_localize(None).floor('D'))
+        rows = [(date, service_id) for date in dates for service_id in self.active_service_ids(date)]
+        service_dates = pd.DataFrame(rows, columns=['raw_date', 'service_id'])
+        service_dates['raw_date'] = pd.to_datetime(service_dates['raw_date']).dt.tz_localize('UTC')
+        return service_dates
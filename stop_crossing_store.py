@@ -0,0 +1,281 @@
+# %%
+import datetime as dt
+import json
+import os
+import shutil
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+try:
+    import fcntl
+except ImportError:
+    # no file locking on Windows:  don't write the same route from two processes at once there
+    fcntl = None
+
+
+# %%
+# Fixed-width column types in the store.  est_stop_time, and start_time and end_time (the vehicle
+# interval the bus passed the stop in, used for the average wait time), are epoch seconds (of the
+# CTA local times labeled as UTC, like tmstmp) and date is the service date as days since 1970-01-01.
+STOP_CROSSING_DTYPES = {
+    'est_stop_time': 'int64',
+    'start_time': 'int64',
+    'end_time': 'int64',
+    'vid': 'int32',
+    'pid': 'int32',
+    'date': 'int32',
+    }
+
+
+# Columns of epoch seconds, converted back to timestamps by read() and query()
+TIME_COLUMNS = ['est_stop_time', 'start_time', 'end_time']
+
+
+# %%
+class StopCrossingStore:
+    '''A directory of actual stop times (the stop crossings from get_actual_stoptimes(), one row
+    per bus passing a stop), partitioned by route and month of the service date, so headways
+    can be recalculated for any stops and time windows without the vehicle data.\n
+
+    Parameters:\n
+
+    store_dir is the directory to keep the stop crossings in.  It is created if it doesn't exist.\n
+
+    Each partition route={route_id}/month={YYYY-MM} holds one .npy file per column in
+    STOP_CROSSING_DTYPES, sorted by stop id, direction and estimated stop time, plus keys.json
+    (every stop id and direction in the partition, in sorted order) and index.npy (the first
+    row of each of them).  A stop's crossings between two times are found with a binary
+    search of the keys and then of that stop's times, reading only those rows from the
+    memory-mapped files.  Use put() to save a route-date, query() to find crossings at a stop
+    and read() to load whole route-dates in the get_actual_stoptimes() format.
+    '''
+
+    def __init__(self, store_dir:str):
+        self.store_dir = Path(store_dir)
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+
+    def partition_dir(self, route_id:str, month:str) -> Path:
+        return self.store_dir / f'route={route_id}' / f'month={month}'
+
+    def partitions(self, route_ids:list=None, start_month:str=None, end_month:str=None) -> list:
+        '''Lists the (route_id, month) partitions in the store, optionally limited to route_ids and
+        months from start_month to end_month (inclusive, "YYYY-MM").'''
+        route_ids = None if route_ids is None else {str(route_id) for route_id in route_ids}
+        partitions = []
+        # every partition has a lock file, which (unlike the partition directory) is never
+        # missing while the partition is being rewritten
+        for path in self.store_dir.glob('route=*/month=*.lock'):
+            route_id = path.parent.name[len('route='):]
+            month = path.stem[len('month='):]
+            if route_ids is not None and route_id not in route_ids:
+                continue
+            if (start_month is not None and month < start_month) or (end_month is not None and month > end_month):
+                continue
+            partitions.append((route_id, month))
+        return sorted(partitions)
+
+    @contextmanager
+    def _lock(self, route_id:str, month:str, shared:bool=False):
+        # one writer per partition at a time (for example batch workers saving different dates).
+        # Readers take a shared lock, since the partition directory is briefly missing while a
+        # writer swaps in the new one
+        lock_path = self.store_dir / f'route={route_id}' / f'month={month}.lock'
+        lock_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(lock_path, 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            yield
+
+    def _open_shared(self, route_id:str, month:str) -> tuple:
+        '''Same as _open() while holding a shared lock on the partition, or None if the partition
+        has no data yet (its first write is still in progress).  The memory-mapped columns stay
+        readable after the lock is released, even if a writer replaces the partition.'''
+        with self._lock(route_id, month, shared=True):
+            if not (self.partition_dir(route_id, month) / 'keys.json').exists():
+                return None
+            return self._open(route_id, month)
+
+    def _open(self, route_id:str, month:str) -> tuple:
+        '''Returns the memory-mapped columns, the (stpid, rtdir) keys and the key offsets of a partition.'''
+        partition_dir = self.partition_dir(route_id, month)
+        with open(partition_dir / 'keys.json') as f:
+            keys = json.load(f)
+        stpids = np.array([stpid for stpid, _ in keys], dtype=object)
+        rtdirs = np.array([rtdir for _, rtdir in keys], dtype=object)
+        offsets = np.load(partition_dir / 'index.npy')
+        columns = {column: np.load(partition_dir / f'{column}.npy', mmap_mode='r') for column in STOP_CROSSING_DTYPES}
+        return columns, stpids, rtdirs, offsets
+
+    def _read_partition(self, route_id:str, month:str, partition:tuple=None) -> pd.DataFrame:
+        '''Returns a partition's rows as stored (times and dates as numbers), from partition (the
+        result of _open()) if given.'''
+        columns, stpids, rtdirs, offsets = partition or self._open(route_id, month)
+        counts = np.diff(offsets)
+        df = pd.DataFrame({'stpid': np.repeat(stpids, counts), 'rtdir': np.repeat(rtdirs, counts)})
+        for column, values in columns.items():
+            df[column] = np.asarray(values)
+        return df
+
+    def _write_partition(self, route_id:str, month:str, df:pd.DataFrame):
+        # sort by stop id, direction and time, and index where each stop id and direction starts
+        df = df.sort_values(['stpid', 'rtdir', 'est_stop_time'], kind='stable')
+        new_key = np.ones(len(df), dtype=bool)
+        new_key[1:] = (df['stpid'].to_numpy()[1:] != df['stpid'].to_numpy()[:-1]) | \
+            (df['rtdir'].to_numpy()[1:] != df['rtdir'].to_numpy()[:-1])
+        starts = np.flatnonzero(new_key)
+        keys = df[['stpid', 'rtdir']].to_numpy()[starts].tolist()
+        offsets = np.append(starts, len(df)).astype('int64')
+
+        # write to a temporary directory first so a partly written partition is never read
+        partition_dir = self.partition_dir(route_id, month)
+        tmp_dir = partition_dir.with_name(f'{partition_dir.name}.{os.getpid()}.tmp')
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        for column, dtype in STOP_CROSSING_DTYPES.items():
+            np.save(tmp_dir / f'{column}.npy', df[column].to_numpy().astype(dtype))
+        np.save(tmp_dir / 'index.npy', offsets)
+        with open(tmp_dir / 'keys.json', 'w') as f:
+            json.dump(keys, f)
+
+        old_dir = partition_dir.with_name(f'{partition_dir.name}.{os.getpid()}.old')
+        if partition_dir.exists():
+            os.replace(partition_dir, old_dir)
+        os.replace(tmp_dir, partition_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+    def put(self, actual_stoptimes:pd.DataFrame, route_id:str, service_date_string:str):
+        '''Saves a route's actual stop times for a service date, from get_actual_stoptimes() (it
+        needs stpid, rtdir, est_stop_time, start_time, end_time, vid and pid), replacing any saved earlier for that
+        date.  Rows without an est_stop_time are left out.'''
+        month = service_date_string[:7]
+        date = (dt.date.fromisoformat(service_date_string) - dt.date(1970, 1, 1)).days
+
+        crossings = pd.DataFrame(columns=['stpid', 'rtdir'] + list(STOP_CROSSING_DTYPES))
+        if len(actual_stoptimes) > 0:
+            actual_stoptimes = actual_stoptimes.loc[actual_stoptimes['est_stop_time'].notnull()]
+            crossings = pd.DataFrame({
+                'stpid': actual_stoptimes['stpid'].astype(str).to_numpy(),
+                'rtdir': actual_stoptimes['rtdir'].astype(str).to_numpy(),
+                **{column: actual_stoptimes[column].to_numpy(dtype='datetime64[ns]').view('int64') // 10**9
+                   for column in TIME_COLUMNS},
+                'vid': actual_stoptimes['vid'].to_numpy(),
+                'pid': actual_stoptimes['pid'].to_numpy(),
+                'date': date,
+                })
+
+        with self._lock(route_id, month):
+            if (self.partition_dir(route_id, month) / 'keys.json').exists():
+                # keep the partition's other dates
+                existing = self._read_partition(route_id, month)
+                crossings = pd.concat([existing.loc[existing['date'] != date], crossings], ignore_index=True)
+            self._write_partition(route_id, month, crossings)
+
+    def _to_stoptimes(self, df:pd.DataFrame, route_id:str) -> pd.DataFrame:
+        '''Converts stored rows to the get_actual_stoptimes() column types, with rt and the service date.'''
+        stoptimes = pd.DataFrame({'rt': route_id, 'stpid': df['stpid'], 'rtdir': df['rtdir']})
+        for column in TIME_COLUMNS:
+            stoptimes[column] = pd.DatetimeIndex(
+                (df[column].to_numpy().astype('int64') * 10**9).view('datetime64[ns]')).tz_localize('UTC')
+        stoptimes['vid'] = df['vid'].to_numpy()
+        stoptimes['pid'] = df['pid'].to_numpy()
+        stoptimes['date'] = (np.datetime64('1970-01-01') + df['date'].to_numpy().astype('timedelta64[D]')).astype(str)
+        return stoptimes
+
+    def read(self, route_ids:list=None, start_date:str=None, end_date:str=None) -> pd.DataFrame:
+        '''Parameters:\n
+        route_ids is an optional list of route ids to read (all routes if None).\n
+        start_date and end_date optionally limit the service dates read, inclusive ("YYYY-MM-DD").\n
+        Data returned:\n
+        dataframe of the stop crossings for the selected routes and service dates, with rt,
+        stpid, rtdir, est_stop_time, start_time, end_time, vid and pid (as in
+        get_actual_stoptimes()) and the service date, sorted by route, stop id, direction and
+        time.  It can be passed to
+        get_actual_headways_all_stops() with the active service times of the same service date.'''
+        partitions = self.partitions(
+            route_ids, start_date[:7] if start_date else None, end_date[:7] if end_date else None)
+
+        epoch = dt.date(1970, 1, 1)
+        first = (dt.date.fromisoformat(start_date) - epoch).days if start_date else None
+        last = (dt.date.fromisoformat(end_date) - epoch).days if end_date else None
+
+        stoptimes = []
+        for route_id, month in partitions:
+            partition = self._open_shared(route_id, month)
+            if partition is None:
+                continue
+            df = self._read_partition(route_id, month, partition)
+            if first is not None:
+                df = df.loc[df['date'] >= first]
+            if last is not None:
+                df = df.loc[df['date'] <= last]
+            stoptimes.append(self._to_stoptimes(df, route_id))
+
+        if len(stoptimes) == 0:
+            return pd.DataFrame()
+        stoptimes = pd.concat(stoptimes, ignore_index=True)
+        return stoptimes.sort_values(['rt', 'stpid', 'rtdir', 'est_stop_time'], kind='stable', ignore_index=True)
+
+    def query(
+        self, stop_id:str, direction:str=None, start_time:pd.Timestamp=None, end_time:pd.Timestamp=None,
+        route_ids:list=None) -> pd.DataFrame:
+        '''Parameters:\n
+        stop_id is the stop id of a single bus stop as a string.\n
+        direction is an optional direction of travel, for example 'Northbound' (all directions if None).\n
+        start_time and end_time optionally limit the estimated stop times, inclusive.  Like
+        est_stop_time, these are local CTA times labeled as UTC.\n
+        route_ids is an optional list of route ids (all routes if None).\n
+        Data returned:\n
+        dataframe of every bus that passed the stop in that time window, in the read() format,
+        sorted by time.  Only the months that can hold those times are opened, and each is
+        searched with a binary search on the stop and then on the times.'''
+        start_seconds = end_seconds = None
+        start_month = end_month = None
+        if start_time is not None:
+            start_time = pd.Timestamp(start_time)
+            start_time = start_time.tz_localize('UTC') if start_time.tz is None else start_time
+            start_seconds = start_time.value // 10**9
+            # buses after midnight belong to the previous service date, which may be last month
+            start_month = (start_time - pd.Timedelta(days=1)).strftime('%Y-%m')
+        if end_time is not None:
+            end_time = pd.Timestamp(end_time)
+            end_time = end_time.tz_localize('UTC') if end_time.tz is None else end_time
+            end_seconds = end_time.value // 10**9
+            end_month = end_time.strftime('%Y-%m')
+
+        stoptimes = []
+        for route_id, month in self.partitions(route_ids, start_month, end_month):
+            partition = self._open_shared(route_id, month)
+            if partition is None:
+                continue
+            columns, stpids, rtdirs, offsets = partition
+
+            # keys are sorted by stop id, then direction
+            first = np.searchsorted(stpids, stop_id, side='left')
+            last = np.searchsorted(stpids, stop_id, side='right')
+            rows = []
+            row_rtdirs = []
+            for key in range(first, last):
+                if direction is not None and rtdirs[key] != direction:
+                    continue
+                # each stop id and direction's times are sorted
+                times = columns['est_stop_time'][offsets[key]:offsets[key + 1]]
+                start = 0 if start_seconds is None else np.searchsorted(times, start_seconds, side='left')
+                end = len(times) if end_seconds is None else np.searchsorted(times, end_seconds, side='right')
+                rows.append(np.arange(offsets[key] + start, offsets[key] + end))
+                row_rtdirs.append(np.repeat(rtdirs[key], end - start))
+            if len(rows) == 0:
+                continue
+
+            rows = np.concatenate(rows)
+            df = pd.DataFrame({
+                'stpid': stop_id,
+                'rtdir': np.concatenate(row_rtdirs),
+                **{column: values[rows] for column, values in columns.items()}})
+            stoptimes.append(self._to_stoptimes(df, route_id))
+
+        if len(stoptimes) == 0:
+            return pd.DataFrame()
+        stoptimes = pd.concat(stoptimes, ignore_index=True)
+        return stoptimes.sort_values('est_stop_time', kind='stable', ignore_index=True)
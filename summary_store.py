@@ -0,0 +1,121 @@
+# %%
+import json
+import os
+from pathlib import Path
+
+import geopandas as gpd
+import pyarrow.dataset as ds
+from pyproj import CRS
+
+
+# %%
+class SummaryStore:
+    '''A directory of headway summaries (the output of get_stats_all_stops()) saved as GeoParquet,
+    partitioned by route and date:  store_dir/route={route_id}/date={YYYY-MM-DD}/part-0.parquet.\n
+
+    Parameters:\n
+
+    store_dir is the directory to keep the summaries in.  It is created if it doesn't exist.\n
+
+    Each route-date is one file with the same columns as the GeoJSON summary (including route_id
+    and date), and route linestrings are kept in store_dir/_linestrings.  Use read() to load any
+    routes and date range, reading only the partitions, columns and row groups needed, and
+    export_geojson() to write the usual GeoJSON files from the store.
+    '''
+
+    def __init__(self, store_dir:str):
+        self.store_dir = Path(store_dir)
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def relative_path(route_id:str, date:str) -> str:
+        '''The path of a route-date's file within the store.'''
+        return f'route={route_id}/date={date}/part-0.parquet'
+
+    def path(self, route_id:str, date:str) -> Path:
+        return self.store_dir / self.relative_path(route_id, date)
+
+    def linestring_path(self, route_id:str) -> Path:
+        # an underscore keeps it out of the route= partitions
+        return self.store_dir / '_linestrings' / f'route={route_id}.parquet'
+
+    def _write(self, gdf:gpd.GeoDataFrame, path:Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file first so a partly written file is never read
+        tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        gdf.to_parquet(tmp_path, compression='zstd', index=False)
+        os.replace(tmp_path, path)
+
+    def put(self, stats_all_stops:gpd.GeoDataFrame, route_id:str, date:str):
+        '''Saves a route-date summary from get_stats_all_stops(), replacing any earlier one.'''
+        self._write(stats_all_stops, self.path(route_id, date))
+
+    def put_linestring(self, route_linestring:gpd.GeoDataFrame, route_id:str):
+        '''Saves a route's linestrings from get_pattern_linestrings().'''
+        self._write(route_linestring, self.linestring_path(route_id))
+
+    def partitions(self, route_ids:list=None, start_date:str=None, end_date:str=None) -> list:
+        '''Lists the (route_id, date) partitions in the store, optionally limited to route_ids and
+        dates from start_date to end_date (inclusive, "YYYY-MM-DD").'''
+        route_ids = None if route_ids is None else {str(route_id) for route_id in route_ids}
+        partitions = []
+        for path in self.store_dir.glob('route=*/date=*/part-0.parquet'):
+            route_id = path.parent.parent.name[len('route='):]
+            date = path.parent.name[len('date='):]
+            if route_ids is not None and route_id not in route_ids:
+                continue
+            if (start_date is not None and date < start_date) or (end_date is not None and date > end_date):
+                continue
+            partitions.append((route_id, date))
+        return sorted(partitions)
+
+    def read(
+        self, route_ids:list=None, start_date:str=None, end_date:str=None, columns:list=None,
+        filter:ds.Expression=None) -> gpd.GeoDataFrame:
+        '''Parameters:\n
+        route_ids is an optional list of route ids to read (all routes if None).\n
+        start_date and end_date optionally limit the dates read, inclusive ("YYYY-MM-DD").\n
+        columns is an optional list of columns to read.  The geometry column is always included.\n
+        filter is an optional pyarrow dataset expression on the summary columns, for example
+        ds.field('Actual median headway (minutes)') > 15.  Row groups that can't match (from
+        their min/max statistics) are skipped without being read.\n
+        Data returned:\n
+        geodataframe of the matching rows of every matching route-date, in route then date order.
+        Only the files for the selected routes and dates are opened.'''
+        paths = [str(self.path(route_id, date)) for route_id, date in self.partitions(route_ids, start_date, end_date)]
+        if len(paths) == 0:
+            return gpd.GeoDataFrame()
+
+        dataset = ds.dataset(paths, format='parquet')
+        geo = json.loads(dataset.schema.metadata[b'geo'])
+        geometry_column = geo['primary_column']
+        if columns is not None and geometry_column not in columns:
+            columns = list(columns) + [geometry_column]
+        table = dataset.to_table(columns=columns, filter=filter)
+
+        # geometry is stored as WKB, with the crs in the GeoParquet metadata
+        df = table.to_pandas()
+        crs = geo['columns'][geometry_column].get('crs')
+        df[geometry_column] = gpd.GeoSeries.from_wkb(
+            df[geometry_column], index=df.index, crs=CRS.from_json_dict(crs) if crs else None)
+        return gpd.GeoDataFrame(df, geometry=geometry_column)
+
+    def read_linestring(self, route_id:str) -> gpd.GeoDataFrame:
+        '''Returns a route's linestrings, or None if they aren't stored.'''
+        path = self.linestring_path(route_id)
+        if not path.exists():
+            return None
+        return gpd.read_parquet(path)
+
+    def export_geojson(self, output_dir:str, route_ids:list=None, start_date:str=None, end_date:str=None):
+        '''Writes the GeoJSON files get_stats_all_stops() exports (route{route_id}_{date}.json and
+        route{route_id}_linestring.json) for the selected routes and dates, from the store.'''
+        os.makedirs(output_dir, exist_ok=True)
+        partitions = self.partitions(route_ids, start_date, end_date)
+        for route_id, date in partitions:
+            stats_all_stops = gpd.read_parquet(self.path(route_id, date))
+            stats_all_stops.to_file(os.path.join(output_dir, f'route{route_id}_{date}.json'), driver='GeoJSON')
+        for route_id in sorted({route_id for route_id, _ in partitions}):
+            route_linestring = self.read_linestring(route_id)
+            if route_linestring is not None:
+                route_linestring.to_file(os.path.join(output_dir, f'route{route_id}_linestring.json'), driver='GeoJSON')
@@ -0,0 +1,318 @@
+# %%
+import datetime as dt
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import headways
+from gtfs_feed_cache import GTFSFeedCache
+from pattern_store import PatternStore
+
+
+# %%
+# Synthetic routes are straight lines with a stop about every STOP_SPACING_FEET, served from
+# SERVICE_START_HOUR to SERVICE_END_HOUR (past midnight, like the owl routes) at speeds around
+# BUS_SPEED_FEET_PER_SECOND (about 10 mph with stops), with a layover at each end of the line.
+STOP_SPACING_FEET = 1300
+SERVICE_START_HOUR = 4.5
+SERVICE_END_HOUR = 25
+BUS_SPEED_FEET_PER_SECOND = 15
+LAYOVER_SECONDS = 600
+
+# latitude/longitude degrees per foot (near Chicago)
+DEGREES_PER_FOOT = 1 / 364000
+
+# Directions of the two patterns on east-west and north-south routes
+ROUTE_DIRECTIONS = [('Eastbound', 'Westbound'), ('Northbound', 'Southbound')]
+
+# Schedule version the synthetic GTFS feed is saved as
+SYNTHETIC_VERSION_ID = '20230701'
+
+
+# %%
+def make_patterns(n_routes:int=10, n_stops:int=40, seed:int=0) -> list:
+    '''Parameters:\n
+    n_routes is the number of bus routes.  Route ids are '1', '2', ... as strings.\n
+    n_stops is the number of stops in each direction of each route.\n
+    seed seeds the random stop spacing.\n
+    Data returned:\n
+    list of patterns in the format the CTA getpatterns API returns (pid, ln, rtdir and pt, a
+    list of points with seq, lat, lon, typ, stpid, stpnm and pdist), two per route:  one in
+    each direction, with a waypoint between each pair of stops.'''
+    rng = np.random.default_rng(seed)
+    patterns = []
+    for route_number in range(1, n_routes + 1):
+        # stop distances along the line, about STOP_SPACING_FEET apart
+        spacing = rng.integers(int(STOP_SPACING_FEET * 0.6), int(STOP_SPACING_FEET * 1.4), n_stops - 1)
+        stop_feet = np.concatenate([[0], np.cumsum(spacing)]).astype(float)
+        length = stop_feet[-1]
+
+        # routes alternate between east-west and north-south lines, spread around the city
+        directions = ROUTE_DIRECTIONS[route_number % 2]
+        origin_lat = 41.7 + 0.3 * rng.random()
+        origin_lon = -87.8 + 0.2 * rng.random()
+
+        for direction_number, rtdir in enumerate(directions):
+            def location(pdist):
+                # the return pattern runs the same line backwards, from the far end
+                along = (pdist if direction_number == 0 else length - pdist) * DEGREES_PER_FOOT
+                return (origin_lat, origin_lon + along) if directions[0] == 'Eastbound' else (origin_lat + along, origin_lon)
+
+            points = []
+            for stop_number, pdist in enumerate(stop_feet):
+                lat, lon = location(pdist)
+                # stops in each direction have their own ids (across the street)
+                stpid = str(route_number * 1000 + direction_number * 500 + stop_number)
+                points.append({
+                    'seq': len(points) + 1, 'lat': lat, 'lon': lon, 'typ': 'S', 'stpid': stpid,
+                    'stpnm': f'Route {route_number} stop {stop_number}', 'pdist': pdist})
+                if stop_number < n_stops - 1:
+                    # waypoint halfway to the next stop
+                    waypoint_pdist = (pdist + stop_feet[stop_number + 1]) / 2
+                    lat, lon = location(waypoint_pdist)
+                    points.append({'seq': len(points) + 1, 'lat': lat, 'lon': lon, 'typ': 'W', 'pdist': waypoint_pdist})
+            patterns.append({
+                'pid': route_number * 10 + direction_number, 'ln': length, 'rtdir': rtdir,
+                'rt': str(route_number), 'pt': points})
+    return patterns
+
+
+# %%
+def make_blocks(patterns:list, n_buses:int=20, seed:int=0) -> pd.DataFrame:
+    '''Parameters:\n
+    patterns is a list of patterns from make_patterns().\n
+    n_buses is the number of buses on each route.\n
+    seed seeds the random running times.\n
+    Data returned:\n
+    dataframe of every scheduled trip for one service day, one row per trip:  route_id, bus
+    (numbered across all routes), trip_id, pid, start_seconds (after midnight of the service
+    date) and run_seconds.  Each bus runs back and forth along its route all day, and the
+    buses on a route are spread evenly around the round trip, which sets the headways.'''
+    rng = np.random.default_rng(seed)
+    patterns_by_route = {}
+    for pattern in patterns:
+        patterns_by_route.setdefault(pattern['rt'], []).append(pattern)
+
+    blocks = []
+    for route_number, (route_id, route_patterns) in enumerate(patterns_by_route.items()):
+        run_seconds = [int(pattern['ln'] / BUS_SPEED_FEET_PER_SECOND) for pattern in route_patterns]
+        round_trip_seconds = sum(run_seconds) + LAYOVER_SECONDS * len(route_patterns)
+
+        for bus_number in range(n_buses):
+            bus = route_number * n_buses + bus_number
+            start = SERVICE_START_HOUR * 3600 + round_trip_seconds * bus_number / n_buses
+            # a late start or early finish for some buses, like peak-only service
+            end = SERVICE_END_HOUR * 3600 - rng.integers(0, 3) * 3600
+            trip_number = 0
+            while start < end:
+                direction_number = trip_number % len(route_patterns)
+                blocks.append([
+                    route_id, bus, f'{route_id}_{bus}_{trip_number}', route_patterns[direction_number]['pid'],
+                    int(start), run_seconds[direction_number]])
+                start += run_seconds[direction_number] + LAYOVER_SECONDS
+                trip_number += 1
+
+    return pd.DataFrame(blocks, columns=['route_id', 'bus', 'trip_id', 'pid', 'start_seconds', 'run_seconds'])
+
+
+# %%
+def make_gtfs_feed(
+    patterns:list, blocks:pd.DataFrame, start_date:str='2023-07-01', end_date:str='2023-08-31'):
+    '''Parameters:\n
+    patterns is a list of patterns from make_patterns().\n
+    blocks is a dataframe of scheduled trips from make_blocks().\n
+    start_date and end_date are the dates the schedule runs, in 'YYYY-MM-DD' format.\n
+    Data returned:\n
+    GTFSFeed with stops, routes, trips, stop_times, calendar and calendar_dates (after
+    format_gtfs_feed()), with every trip in blocks running every day between the dates.
+    Stop times are interpolated along each trip from the stops' pdist.'''
+    patterns_by_pid = {pattern['pid']: pattern for pattern in patterns}
+
+    stops, stop_times = [], []
+    for pattern in patterns:
+        for point in pattern['pt']:
+            if point['typ'] == 'S':
+                stops.append([point['stpid'], point['stpnm'], str(point['lat']), str(point['lon'])])
+
+    trips = blocks.copy()
+    trips['service_id'] = 'ALL'
+    trips['shape_id'] = trips['pid'].astype(str)
+    trips['direction'] = trips['pid'].map(
+        {pid: pattern['rtdir'].replace('bound', '') for pid, pattern in patterns_by_pid.items()})
+
+    for pid, pattern_trips in trips.groupby('pid'):
+        pattern = patterns_by_pid[pid]
+        stop_points = [point for point in pattern['pt'] if point['typ'] == 'S']
+        stop_fraction = np.array([point['pdist'] for point in stop_points]) / pattern['ln']
+        # one row per trip and stop
+        seconds = (
+            pattern_trips['start_seconds'].to_numpy()[:, None]
+            + stop_fraction[None, :] * pattern_trips['run_seconds'].to_numpy()[:, None]).astype(int)
+        stop_times.append(pd.DataFrame({
+            'trip_id': np.repeat(pattern_trips['trip_id'].to_numpy(), len(stop_points)),
+            'seconds': seconds.ravel(),
+            'stop_id': np.tile([point['stpid'] for point in stop_points], len(pattern_trips)),
+            'stop_sequence': np.tile(np.arange(1, len(stop_points) + 1).astype(str), len(pattern_trips)),
+            }))
+    stop_times = pd.concat(stop_times, ignore_index=True)
+
+    # GTFS times are HH:MM:SS, with hours past 24 for trips after midnight
+    seconds = stop_times.pop('seconds')
+    stop_times.insert(1, 'arrival_time', (
+        (seconds // 3600).map('{:02d}'.format) + ':' + (seconds % 3600 // 60).map('{:02d}'.format)
+        + ':' + (seconds % 60).map('{:02d}'.format)))
+    stop_times.insert(2, 'departure_time', stop_times['arrival_time'])
+
+    route_ids = list(dict.fromkeys(blocks['route_id']))
+    gtfs_feed = headways.GTFSFeed(
+        stops=pd.DataFrame(stops, columns=['stop_id', 'stop_name', 'stop_lat', 'stop_lon']),
+        stop_times=stop_times,
+        routes=pd.DataFrame({
+            'route_id': route_ids, 'route_short_name': route_ids,
+            'route_long_name': [f'Route {route_id}' for route_id in route_ids], 'route_type': '3'}),
+        trips=trips[['route_id', 'service_id', 'trip_id', 'direction', 'shape_id']],
+        calendar=pd.DataFrame([{
+            'service_id': 'ALL', 'monday': '1', 'tuesday': '1', 'wednesday': '1', 'thursday': '1',
+            'friday': '1', 'saturday': '1', 'sunday': '1',
+            'start_date': start_date.replace('-', ''), 'end_date': end_date.replace('-', '')}]),
+        calendar_dates=pd.DataFrame(columns=['service_id', 'date', 'exception_type']),
+        shapes=pd.DataFrame(columns=['shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence']))
+    return headways.format_gtfs_feed(gtfs_feed)
+
+
+# %%
+def format_times(times:pd.DatetimeIndex, date_format:str) -> np.ndarray:
+    '''This is a helper function.\n
+    Returns times formatted as strings, formatting each distinct time only once (pings share
+    a few thousand distinct minutes).'''
+    codes, unique_times = pd.factorize(times)
+    return unique_times.strftime(date_format).to_numpy()[codes]
+
+
+# %%
+def make_vehicles(
+    patterns:list, blocks:pd.DataFrame, service_date_string:str, cadence_minutes:int=5, seed:int=0) -> pd.DataFrame:
+    '''Parameters:\n
+    patterns is a list of patterns from make_patterns().\n
+    blocks is a dataframe of scheduled trips from make_blocks().\n
+    service_date_string is the service date to simulate, in 'YYYY-MM-DD' format.\n
+    cadence_minutes is the time between pings from each bus.\n
+    seed seeds the random delays and speeds.\n
+    Data returned:\n
+    dataframe in the chn vehicle file format (the columns in VEHICLE_DTYPES, with tmstmp as
+    "YYYYMMDD HH:MM" strings), one row per ping.  Each bus runs its scheduled trips with a
+    random delay and speed, and between trips waits at the start of its next pattern.
+    data_date is the calendar date of each ping, so buses after midnight are in the next
+    day's file.'''
+    rng = np.random.default_rng(seed)
+    patterns_by_pid = {pattern['pid']: pattern for pattern in patterns}
+    service_date = pd.Timestamp(service_date_string)
+
+    # delays build up over the day, and each trip runs a little faster or slower than scheduled
+    blocks = blocks.sort_values(['bus', 'start_seconds'])
+    delay = np.maximum(rng.normal(60, 120, len(blocks)), -60)
+    start = blocks['start_seconds'].to_numpy() + delay
+    run = blocks['run_seconds'].to_numpy() * rng.uniform(0.85, 1.2, len(blocks))
+    length = blocks['pid'].map({pid: pattern['ln'] for pid, pattern in patterns_by_pid.items()}).to_numpy()
+
+    pings = []
+    for bus, trip_positions in blocks.groupby('bus', sort=False).indices.items():
+        # pings every cadence_minutes, starting at a random minute
+        first = start[trip_positions[0]] - LAYOVER_SECONDS
+        last = start[trip_positions[-1]] + run[trip_positions[-1]]
+        ping_seconds = np.arange(first + rng.integers(0, cadence_minutes) * 60, last, cadence_minutes * 60)
+
+        # the trip each ping belongs to:  the one in progress, or the next one during a layover
+        current = np.searchsorted(start[trip_positions], ping_seconds, side='right') - 1
+        trip = trip_positions[np.maximum(current, 0)]
+        in_layover = (current < 0) | (ping_seconds > start[trip] + run[trip])
+        next_trip = trip_positions[np.minimum(current + 1, len(trip_positions) - 1)]
+        trip = np.where(in_layover & (current + 1 < len(trip_positions)), next_trip, trip)
+        progress = np.clip((ping_seconds - start[trip]) / run[trip], 0, 1)
+        pings.append(pd.DataFrame({
+            'bus': bus, 'position': trip, 'seconds': ping_seconds, 'pdist': (progress * length[trip]).astype(int)}))
+    pings = pd.concat(pings, ignore_index=True)
+
+    trips = blocks.iloc[pings['position'].to_numpy()]
+    pids = trips['pid'].to_numpy()
+    tmstmp = (service_date + pd.to_timedelta(pings['seconds'].to_numpy(), unit='s')).floor('min')
+
+    # position along each pattern's line, for lat/lon and heading
+    origin = {pid: pattern['pt'][0] for pid, pattern in patterns_by_pid.items()}
+    rtdir = pd.Series(pids).map({pid: pattern['rtdir'] for pid, pattern in patterns_by_pid.items()}).to_numpy()
+    sign = np.where(np.isin(rtdir, ['Eastbound', 'Northbound']), 1, -1)
+    along = sign * pings['pdist'].to_numpy() * DEGREES_PER_FOOT
+    north_south = np.isin(rtdir, ['Northbound', 'Southbound'])
+    lat = pd.Series(pids).map({pid: point['lat'] for pid, point in origin.items()}).to_numpy() + np.where(north_south, along, 0)
+    lon = pd.Series(pids).map({pid: point['lon'] for pid, point in origin.items()}).to_numpy() + np.where(north_south, 0, along)
+
+    vehicles = pd.DataFrame({
+        'vid': 1000 + pings['bus'].to_numpy(),
+        'tmstmp': format_times(tmstmp, '%Y%m%d %H:%M'),
+        'lat': lat.round(6),
+        'lon': lon.round(6),
+        'hdg': pd.Series(rtdir).map({'Eastbound': 90, 'Westbound': 270, 'Northbound': 0, 'Southbound': 180}).to_numpy(),
+        'pid': pids,
+        'rt': trips['route_id'].to_numpy(),
+        'pdist': pings['pdist'].to_numpy(),
+        'des': rtdir,
+        'dly': rng.random(len(pings)) < 0.02,
+        'tatripid': trips['trip_id'].to_numpy(),
+        'origatripno': trips.index.to_numpy(),
+        'tablockid': trips['bus'].astype(str).to_numpy(),
+        'zone': '',
+        'scrape_file': format_times(tmstmp, '%Y-%m-%d %H.json'),
+        'data_hour': tmstmp.hour,
+        'data_date': format_times(tmstmp, '%Y-%m-%d'),
+        })
+    return vehicles
+
+
+# %%
+def write_synthetic_data(
+    data_dir:str, service_date_string:str='2023-07-26', n_routes:int=10, n_stops:int=40, n_buses:int=20,
+    seed:int=0) -> dict:
+    '''Parameters:\n
+    data_dir is the directory to write the data to.\n
+    service_date_string is the service date to simulate, in 'YYYY-MM-DD' format.  The following
+    date is simulated too, so the vehicle files for the service date are complete.\n
+    n_routes, n_stops and n_buses are the number of routes, the stops in each direction of
+    each route and the buses on each route.\n
+    seed seeds the random data.\n
+    Data returned:\n
+    dictionary of the settings to run the headway calculations offline on the data:
+    CHN_DATA_DIR (vehicle csv files, one per calendar date), PATTERN_STORE_DIR (the patterns,
+    with PATTERNS_OFFLINE), GTFS_CACHE_DIR and the schedule version_id, and the route_ids.'''
+    data_dir = Path(data_dir)
+    patterns = make_patterns(n_routes, n_stops, seed)
+    blocks = make_blocks(patterns, n_buses, seed)
+
+    # patterns in a pattern store, so no CTA API calls are needed
+    pattern_store = PatternStore(data_dir / 'patterns', offline=True)
+    for pattern in patterns:
+        pattern_store.put({key: value for key, value in pattern.items() if key != 'rt'})
+
+    # the schedule in a GTFS feed cache, so get_gtfs_feed() doesn't download it
+    service_date = dt.date.fromisoformat(service_date_string)
+    GTFSFeedCache(data_dir / 'gtfs').put(SYNTHETIC_VERSION_ID, make_gtfs_feed(
+        patterns, blocks, (service_date - dt.timedelta(days=7)).isoformat(),
+        (service_date + dt.timedelta(days=7)).isoformat()))
+
+    # vehicle csv files by calendar date, like the chn-ghost-buses bucket
+    vehicles = pd.concat([
+        make_vehicles(patterns, blocks, (service_date + dt.timedelta(days=days)).isoformat(), seed=seed + days)
+        for days in range(2)], ignore_index=True)
+    chn_dir = data_dir / 'chn'
+    chn_dir.mkdir(parents=True, exist_ok=True)
+    for data_date, day_vehicles in vehicles.groupby('data_date'):
+        day_vehicles.to_csv(chn_dir / f'{data_date}.csv', index=False)
+
+    return {
+        'CHN_DATA_DIR': str(chn_dir),
+        'PATTERN_STORE_DIR': str(data_dir / 'patterns'),
+        'PATTERNS_OFFLINE': True,
+        'GTFS_CACHE_DIR': str(data_dir / 'gtfs'),
+        'version_id': SYNTHETIC_VERSION_ID,
+        'route_ids': list(dict.fromkeys(blocks['route_id'])),
+        }
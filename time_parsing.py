@@ -0,0 +1,142 @@
+# %%
+import numpy as np
+import pandas as pd
+
+
+# %%
+# Fixed-format parsers for the two kinds of time strings in the pipeline.  They read the digits
+# straight out of the string bytes with numpy instead of having pandas work out the format:
+#
+# - CTA Bus Tracker timestamps (tmstmp in the chn vehicle data): "YYYYMMDD HH:MM" or "YYYYMMDD HH:MM:SS"
+# - GTFS stop times (arrival_time/departure_time): "HH:MM:SS" (or "H:MM:SS"), where hours can
+#   be 24 or more for trips running past midnight
+#
+# Time strings repeat a lot (a day of vehicle data has at most 1440 distinct minutes), so
+# only the distinct strings are parsed and the results are expanded back to every value.
+
+NANOSECONDS_PER_SECOND = 1_000_000_000
+SECONDS_PER_DAY = 86400
+
+
+def _format_error(values, bad:np.ndarray, kind:str) -> ValueError:
+    return ValueError(f'Unexpected {kind} format: {values[bad][0]!r}')
+
+
+def _parse_distinct(values, parse) -> np.ndarray:
+    '''Runs parse on the distinct values only, and expands the results back to one per value.'''
+    codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+    if (codes < 0).any():
+        raise ValueError('Missing time values')
+    return parse(np.asarray(uniques, dtype=object))[codes]
+
+
+def _char_matrix(strings:np.ndarray) -> np.ndarray:
+    '''Returns strings as a 2d array of byte codes, one row per string.  Shorter strings are
+    padded with zero bytes on the right.'''
+    strings = strings.astype('S')
+    return strings.view(np.uint8).reshape(len(strings), strings.dtype.itemsize).astype(np.int64)
+
+
+def _days_from_civil(year:np.ndarray, month:np.ndarray, day:np.ndarray) -> np.ndarray:
+    '''Days since 1970-01-01 for each (year, month, day) in the Gregorian calendar.'''
+    year = year - (month <= 2)
+    era = np.floor_divide(year, 400)
+    year_of_era = year - era*400
+    day_of_year = (153*(month + np.where(month > 2, -3, 9)) + 2)//5 + day - 1
+    day_of_era = year_of_era*365 + year_of_era//4 - year_of_era//100 + day_of_year
+    return era*146097 + day_of_era - 719468
+
+
+# %%
+def _parse_cta_distinct(values:np.ndarray) -> np.ndarray:
+    chars = _char_matrix(values)
+    if chars.shape[1] not in (14, 17):
+        raise _format_error(values, np.ones(len(values), dtype=bool), 'CTA timestamp')
+
+    # fixed width: check every separator and digit position at once
+    separators = {8: ord(' '), 11: ord(':'), 14: ord(':')}
+    separator_columns = [column for column in separators if column < chars.shape[1]]
+    digit_columns = [column for column in range(chars.shape[1]) if column not in separators]
+    digits = chars[:, digit_columns] - ord('0')
+    bad = (
+        (chars[:, separator_columns] != [separators[column] for column in separator_columns]).any(axis=1)
+        | ((digits < 0) | (digits > 9)).any(axis=1))
+    if bad.any():
+        raise _format_error(values, bad, 'CTA timestamp')
+
+    def number(*columns):
+        result = 0
+        for column in columns:
+            result = result*10 + digits[:, column]
+        return result
+
+    # digit columns: YYYYMMDD = 0-7, HH = 8-9, MM = 10-11, SS = 12-13
+    seconds = number(8, 9)*3600 + number(10, 11)*60
+    if len(digit_columns) == 14:
+        seconds = seconds + number(12, 13)
+    days = _days_from_civil(number(0, 1, 2, 3), number(4, 5), number(6, 7))
+    return (days*SECONDS_PER_DAY + seconds)*NANOSECONDS_PER_SECOND
+
+
+def parse_cta_timestamps(values) -> np.ndarray:
+    '''Parameters:\n
+    values is a list, array or Series of CTA Bus Tracker timestamp strings in the format
+    "YYYYMMDD HH:MM" (or "YYYYMMDD HH:MM:SS").\n
+    Data returned:\n
+    numpy int64 array of nanoseconds since 1970-01-01, reading the local times as if they
+    were UTC (the same as pd.to_datetime(..., utc=True) on the strings).  Raises ValueError
+    for missing values or strings in any other format.'''
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return _parse_distinct(values, _parse_cta_distinct)
+
+
+def cta_timestamps_to_datetime(values) -> pd.DatetimeIndex:
+    '''Same as parse_cta_timestamps(), returned as a datetime64[ns, UTC] DatetimeIndex.'''
+    return pd.DatetimeIndex(parse_cta_timestamps(values).view('datetime64[ns]')).tz_localize('UTC')
+
+
+# %%
+def _parse_gtfs_distinct(values:np.ndarray) -> np.ndarray:
+    chars = _char_matrix(np.char.strip(values.astype('S')))
+
+    # hours can have 1 or more digits, so read each string right to left from its last character
+    lengths = (chars != 0).sum(axis=1)
+    if (lengths < 7).any():
+        raise _format_error(values, lengths < 7, 'GTFS time')
+    rows = np.arange(len(chars))
+
+    def char_at(offset):
+        positions = lengths - offset
+        return np.where(positions >= 0, chars[rows, np.maximum(positions, 0)], ord('0'))
+
+    digit_offsets = [1, 2, 4, 5] + list(range(7, chars.shape[1] + 1))
+    digits = {offset: char_at(offset) - ord('0') for offset in digit_offsets}
+    bad = (char_at(3) != ord(':')) | (char_at(6) != ord(':'))
+    for digit in digits.values():
+        bad |= (digit < 0) | (digit > 9)
+    if bad.any():
+        raise _format_error(values, bad, 'GTFS time')
+
+    hours = 0
+    for place, offset in enumerate(range(7, chars.shape[1] + 1)):
+        hours = hours + digits[offset]*10**place
+    return hours*3600 + (digits[5]*10 + digits[4])*60 + digits[2]*10 + digits[1]
+
+
+def parse_gtfs_times(values) -> np.ndarray:
+    '''Parameters:\n
+    values is a list, array or Series of GTFS time strings in the format "HH:MM:SS" (or
+    "H:MM:SS"), like arrival_time and departure_time in stop_times.txt.  Hours can be 24 or
+    more, for times after midnight at the end of a service day.\n
+    Data returned:\n
+    numpy int64 array of seconds after the start of the service day.  Raises ValueError for
+    missing values or strings in any other format.'''
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return _parse_distinct(values, _parse_gtfs_distinct)
+
+
+def gtfs_times_to_timedelta(values) -> pd.TimedeltaIndex:
+    '''Same as parse_gtfs_times(), returned as a TimedeltaIndex to add to a service date.'''
+    return pd.to_timedelta(parse_gtfs_times(values), unit='s')
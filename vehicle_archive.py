@@ -0,0 +1,255 @@
+# %%
+import datetime as dt
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+# %%
+# Fixed-width column types in the archive.  Times are epoch seconds (of the CTA local times
+# labeled as UTC, like tmstmp), and routes are stored as codes into the archive's route list.
+ARCHIVE_DTYPES = {
+    'vid': 'int32',
+    'tmstmp': 'int64',
+    'pid': 'int32',
+    'rt': 'int16',
+    'pdist': 'int32',
+    }
+
+# Columns of epoch seconds, converted back to timestamps by VehicleArrays.to_frame()
+TIME_COLUMNS = ['tmstmp', 'start_time', 'end_time']
+
+
+# %%
+class VehicleArrays:
+    '''Columns of vehicle data (or vehicle intervals) as numpy arrays, for example the arrays
+    loaded from a VehicleArchive.  get_vehicle_intervals(), get_patterns() and
+    get_stop_crossings() in headways.py accept these in place of a dataframe.\n
+
+    Parameters:\n
+
+    columns is a dictionary of equal length arrays by column name, in the ARCHIVE_DTYPES
+    types:  times are epoch seconds and rt holds route codes.\n
+
+    route_ids is an array of route ids as strings, indexed by route code.
+    '''
+
+    def __init__(self, columns:dict, route_ids):
+        self.columns = columns
+        self.route_ids = np.asarray(route_ids, dtype=object)
+
+    def __len__(self) -> int:
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    def __getitem__(self, column:str) -> np.ndarray:
+        return self.columns[column]
+
+    def take(self, positions:np.ndarray) -> 'VehicleArrays':
+        '''Returns the rows at positions (a copy of just those rows).'''
+        return VehicleArrays({column: values[positions] for column, values in self.columns.items()}, self.route_ids)
+
+    def route_codes(self, route_ids:list) -> np.ndarray:
+        '''Returns the codes of the route ids that have one.'''
+        codes = pd.Index(self.route_ids).get_indexer([str(route_id) for route_id in route_ids])
+        return codes[codes >= 0]
+
+    def select_routes(self, route_ids:list) -> 'VehicleArrays':
+        '''Returns the rows for route_ids.  Returns self, without copying, if every row is on one of them.'''
+        in_routes = np.isin(self.columns['rt'], self.route_codes(route_ids))
+        if in_routes.all():
+            return self
+        return self.take(np.flatnonzero(in_routes))
+
+    def to_frame(self) -> pd.DataFrame:
+        '''Returns the columns as a dataframe in the same types as get_chn_vehicles():  times as
+        datetime64[ns, UTC] timestamps and rt as a categorical of route ids.'''
+        df = pd.DataFrame(index=pd.RangeIndex(len(self)))
+        for column, values in self.columns.items():
+            if column in TIME_COLUMNS:
+                nanoseconds = values.astype('int64') * 10**9
+                df[column] = pd.DatetimeIndex(nanoseconds.view('datetime64[ns]')).tz_localize('UTC')
+            elif column == 'rt':
+                df[column] = pd.Categorical.from_codes(values, categories=self.route_ids).remove_unused_categories()
+            else:
+                df[column] = values
+        return df
+
+
+# %%
+class VehicleArchive:
+    '''An append-only archive of chn vehicle pings, for analysis over many days or months
+    without reading each day's vehicle data into a dataframe.\n
+
+    Parameters:\n
+
+    archive_dir is the directory to keep the archive in.  It is created if it doesn't exist.\n
+
+    Each day of vehicle data (one chn vehicle file, by data_date) is a segment directory
+    date={YYYY-MM-DD} holding one .npy file per column in ARCHIVE_DTYPES (vid, epoch seconds,
+    pid, route code and pdist), sorted by route, pid and time, and index.npy with the row
+    range of every route and pid in the segment.  Columns are opened memory-mapped, so
+    loading a route for a day is a slice of the files (zero copy) and only the pages for
+    that route are read from disk.  archive.json holds the route ids (route codes index into
+    it) and the row count of each segment.  Add days with append() (or
+    archive_chn_vehicles() in headways.py) and load them with load() or get_vehicles().
+    '''
+
+    def __init__(self, archive_dir:str):
+        self.archive_dir = Path(archive_dir)
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+        self.metadata_path = self.archive_dir / 'archive.json'
+        self.metadata = {'routes': [], 'segments': {}}
+        if self.metadata_path.exists():
+            with open(self.metadata_path) as f:
+                self.metadata = json.load(f)
+        # memory-mapped columns and index of each segment opened so far
+        self._segments = {}
+
+    @property
+    def route_ids(self) -> np.ndarray:
+        return np.asarray(self.metadata['routes'], dtype=object)
+
+    def dates(self) -> list:
+        '''Lists the dates archived.'''
+        return sorted(self.metadata['segments'])
+
+    def segment_dir(self, date:str) -> Path:
+        return self.archive_dir / f'date={date}'
+
+    def _save_metadata(self):
+        # write to a temporary file first so a partly written file is never read
+        tmp_path = self.metadata_path.with_suffix('.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.metadata, f, indent=1)
+        os.replace(tmp_path, self.metadata_path)
+
+    def append(self, vehicles:pd.DataFrame):
+        '''Adds vehicle data from get_chn_vehicles() (it needs vid, tmstmp, pid, rt and pdist) as
+        one segment per day:  by data_date (the chn file each row came from) if it is a column,
+        otherwise by the date of tmstmp.  Rows missing any of those columns are left out.
+        Raises ValueError if any of the days is already archived.'''
+        vehicles = vehicles.dropna(subset=list(ARCHIVE_DTYPES))
+        if 'data_date' in vehicles.columns:
+            days = vehicles['data_date'].astype(str)
+        else:
+            # format each distinct day once rather than every timestamp
+            day_codes, unique_days = pd.factorize(vehicles['tmstmp'].dt.floor('D'))
+            days = pd.Series(unique_days.strftime('%Y-%m-%d')[day_codes], index=vehicles.index)
+
+        archived_days = sorted(set(days) & set(self.metadata['segments']))
+        if len(archived_days) > 0:
+            raise ValueError(f'Dates already in the vehicle archive: {archived_days}')
+
+        # add any new routes to the end of the route list, so existing codes don't change
+        routes = self.metadata['routes']
+        new_routes = sorted(set(vehicles['rt'].astype(str)) - set(routes))
+        if len(routes) + len(new_routes) > np.iinfo(ARCHIVE_DTYPES['rt']).max:
+            raise ValueError('Too many routes for the vehicle archive route codes')
+        routes.extend(new_routes)
+
+        for day, day_vehicles in vehicles.groupby(days, sort=True):
+            self._write_segment(day, day_vehicles)
+            self.metadata['segments'][day] = len(day_vehicles)
+            # save after every day, so the archive is usable if a later day fails
+            self._save_metadata()
+
+    def _write_segment(self, date:str, vehicles:pd.DataFrame):
+        columns = {
+            'vid': vehicles['vid'].to_numpy(),
+            'tmstmp': vehicles['tmstmp'].to_numpy(dtype='datetime64[ns]').view('int64') // 10**9,
+            'pid': vehicles['pid'].to_numpy(),
+            'rt': pd.Index(self.metadata['routes']).get_indexer(vehicles['rt'].astype(str)),
+            'pdist': vehicles['pdist'].to_numpy(),
+            }
+        columns = {column: values.astype(ARCHIVE_DTYPES[column]) for column, values in columns.items()}
+
+        # sort by route, pid and time
+        order = np.lexsort((columns['tmstmp'], columns['pid'], columns['rt']))
+        columns = {column: values[order] for column, values in columns.items()}
+
+        # index rows: route code, pid, first row and end row of each route and pid
+        keys = np.stack([columns['rt'], columns['pid']], axis=1).astype('int64')
+        new_key = np.ones(len(keys), dtype=bool)
+        new_key[1:] = (keys[1:] != keys[:-1]).any(axis=1)
+        starts = np.flatnonzero(new_key)
+        ends = np.append(starts[1:], len(keys))
+        index = np.column_stack([keys[starts], starts, ends])
+
+        # write to a temporary directory first so a partly written segment is never read
+        segment_dir = self.segment_dir(date)
+        tmp_dir = segment_dir.with_name(f'{segment_dir.name}.{os.getpid()}.tmp')
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        for column, values in columns.items():
+            np.save(tmp_dir / f'{column}.npy', values)
+        np.save(tmp_dir / 'index.npy', index)
+        if segment_dir.exists():
+            # left behind by an append that failed before it was recorded
+            shutil.rmtree(segment_dir)
+        os.replace(tmp_dir, segment_dir)
+
+    def _segment(self, date:str) -> tuple:
+        '''Returns the memory-mapped columns and the index of a segment.'''
+        if date not in self._segments:
+            segment_dir = self.segment_dir(date)
+            columns = {column: np.load(segment_dir / f'{column}.npy', mmap_mode='r') for column in ARCHIVE_DTYPES}
+            self._segments[date] = columns, np.load(segment_dir / 'index.npy')
+        return self._segments[date]
+
+    def _route_ranges(self, date:str, route_codes:np.ndarray) -> list:
+        '''Returns (start, end) row ranges of a segment for route_codes, merging adjacent routes.'''
+        _, index = self._segment(date)
+        # the index is sorted by route code, so each route's pids are found with a binary search
+        route_codes = np.sort(route_codes)
+        first = np.searchsorted(index[:, 0], route_codes, side='left')
+        last = np.searchsorted(index[:, 0], route_codes, side='right')
+        ranges = []
+        for first_pid, last_pid in zip(first[last > first], last[last > first]):
+            start, end = index[first_pid, 2], index[last_pid - 1, 3]
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+        return ranges
+
+    def iter_slices(self, route_ids:list=None, start_date:str=None, end_date:str=None):
+        '''Yields (date, VehicleArrays) for each archived date from start_date to end_date
+        (inclusive, "YYYY-MM-DD") and each run of rows for route_ids (all routes if None).
+        Every VehicleArrays is a view into the memory-mapped files, so nothing is copied.'''
+        route_codes = np.arange(len(self.metadata['routes'])) if route_ids is None else \
+            VehicleArrays({}, self.route_ids).route_codes(route_ids)
+        for date in self.dates():
+            if (start_date is not None and date < start_date) or (end_date is not None and date > end_date):
+                continue
+            columns, _ = self._segment(date)
+            for start, end in self._route_ranges(date, route_codes):
+                yield date, VehicleArrays({column: values[start:end] for column, values in columns.items()}, self.route_ids)
+
+    def load(self, route_ids:list=None, start_date:str=None, end_date:str=None) -> VehicleArrays:
+        '''Parameters:\n
+        route_ids is an optional list of route ids to load (all routes if None).\n
+        start_date and end_date optionally limit the dates loaded, inclusive ("YYYY-MM-DD").\n
+        Data returned:\n
+        VehicleArrays for the selected routes and dates, sorted by date, then by route, pid and
+        time.  When the selection is a single run of rows (for example one route on one day),
+        the arrays are views into the memory-mapped files; otherwise only the selected rows
+        are copied into one set of arrays.'''
+        slices = [vehicle_arrays for _, vehicle_arrays in self.iter_slices(route_ids, start_date, end_date)]
+        if len(slices) == 0:
+            return VehicleArrays({column: np.zeros(0, dtype) for column, dtype in ARCHIVE_DTYPES.items()}, self.route_ids)
+        if len(slices) == 1:
+            return slices[0]
+        return VehicleArrays(
+            {column: np.concatenate([s[column] for s in slices]) for column in ARCHIVE_DTYPES}, self.route_ids)
+
+    def get_vehicles(self, service_date_string:str, routes=None) -> VehicleArrays:
+        '''Returns the archived vehicle data for a service date (that date and the following
+        date, like get_chn_vehicles()), for routes (a route id or a list of them, all routes if
+        None).'''
+        if isinstance(routes, str):
+            routes = [routes]
+        day2_string = (dt.date.fromisoformat(service_date_string) + dt.timedelta(days=1)).isoformat()
+        return self.load(routes, service_date_string, day2_string)